@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Runs without a display, must be set before Qt is imported
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6 import __version__ as pyside_version
+from PySide6.QtCore import QPoint, QPointF, Qt
+from PySide6.QtGui import QColor, QImage, QImageWriter, QPainter, QWheelEvent
+from PySide6.QtWidgets import QApplication
+
+import projectFile
+from changeJournal import ChangeJournal
+from main import MainWindow
+from markers import MarkerItem
+from recentMaps import RecentMaps
+from tilePyramid import TilePyramid
+
+# Usage:
+#   python benchmark.py --output results.json
+#   python benchmark.py --save-baseline            run and store the results as the baseline
+#   python benchmark.py --baseline baseline.json   run and fail if anything got slower than the tolerance
+DEFAULT_SIZES = "2000,8000,20000"
+DEFAULT_MARKERS = "100,1000,10000,100000"
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+# Cold start in a fresh interpreter: imports, the window and its first paint
+STARTUP_SCRIPT = """
+from PySide6.QtWidgets import QApplication
+from main import MainWindow
+app = QApplication([])
+window = MainWindow()
+window.show()
+app.processEvents()
+"""
+
+
+def peakRss():
+    # Peak resident set size in MB since the last resetPeakRss
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def resetPeakRss():
+    # Linux resets the high water mark when 5 is written to clear_refs, elsewhere the peak of the whole run is reported
+    try:
+        with open("/proc/self/clear_refs", 'w') as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def makeMap(path, width, height):
+    # Random shapes over a gradient, so that the image compresses like a real map and not like a flat color
+    image = QImage(width, height, QImage.Format.Format_RGB888)
+    image.fill(QColor(205, 190, 150))
+    painter = QPainter(image)
+    generator = random.Random(width)
+    painter.setPen(Qt.PenStyle.NoPen)
+    for _ in range(2000):
+        painter.setBrush(QColor(generator.randrange(256), generator.randrange(256), generator.randrange(256)))
+        radius = generator.uniform(0.005, 0.05) * width
+        painter.drawEllipse(QPointF(generator.uniform(0, width), generator.uniform(0, height)), radius, radius)
+    painter.end()
+
+    writer = QImageWriter(path)
+    writer.setQuality(90)
+    if not writer.write(image):
+        raise IOError("Could not write the benchmark map: " + writer.errorString())
+
+
+def makeRecords(count, width, height):
+    generator = random.Random(count)
+    categories = list(MarkerItem.PathsByCategory.keys())
+    records = []
+    for index in range(count):
+        records.append({
+            'id': index + 1,
+            'x': generator.uniform(0, width),
+            'y': generator.uniform(0, height),
+            'category': categories[index % len(categories)],
+            'icon': None,
+            'imgInd': index % 8,
+            'name': "Marker " + str(index % 1000),
+            'desc': "Description of marker " + str(index) if index % 4 == 0 else "",
+            'showing': index % 3 == 0,
+            'color': "#ff000000"
+        })
+    return records
+
+
+def wheelEvent(view, angle):
+    center = QPointF(view.viewport().rect().center())
+    return QWheelEvent(center, view.mapToGlobal(center), QPoint(), QPoint(0, angle), Qt.MouseButton.NoButton,
+                       Qt.KeyboardModifier.NoModifier, Qt.ScrollPhase.NoScrollPhase, False)
+
+
+class Benchmark:
+    def __init__(self, work_dir, repeat):
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.results = []
+
+        self.app = QApplication.instance() or QApplication([])
+        self.window = MainWindow()
+        self.window.resize(1280, 800)
+        self.window.show()
+        self.app.processEvents()
+
+    def measure(self, name, params, operation, setup=None):
+        runs = []
+        peak = 0.0
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            self.app.processEvents()
+            resetPeakRss()
+            start = time.perf_counter()
+            operation()
+            runs.append(time.perf_counter() - start)
+            peak = max(peak, peakRss())
+
+        result = {'name': name, 'params': params, 'seconds': statistics.median(runs), 'runs': runs,
+                  'peak_rss_mb': round(peak, 1)}
+        self.results.append(result)
+        print("%-16s %-32s %10.4f s %10.1f MB" % (name, formatParams(params), result['seconds'], peak), flush=True)
+
+    def openMap(self, path):
+        self.window.new_map(path)
+        self.waitForMap()
+
+    def leaveMap(self):
+        self.window.stash_map()
+        self.window.map_cache.clear()
+
+    def waitForMap(self):
+        # The image is decoded on a worker thread, its result is handed over with the next processed events
+        self.window.map_loader.wait()
+        self.app.processEvents()
+
+    def repaint(self):
+        self.window.graphics_view.viewport().repaint()
+
+    def finishJournal(self):
+        # Writes of the journal thread are part of the timed operation
+        if self.window.journal is not None:
+            self.window.journal.sync()
+
+    def mapPath(self, size):
+        path = os.path.join(self.work_dir, "map_%d.jpg" % size)
+        if not os.path.exists(path):
+            makeMap(path, size, size // 2)
+        return path
+
+    def runStartup(self):
+        directory = os.path.dirname(os.path.abspath(__file__))
+        self.measure("startup", {}, lambda: subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=directory,
+                                                           check=True))
+
+    def runMaps(self, sizes):
+        for size in sizes:
+            path = self.mapPath(size)
+            params = {'size': size}
+            tile_dir = os.path.join(self.work_dir, "tiles")
+
+            # Every run of the cold case builds the tile pyramid of large maps again
+            self.measure("new_map", params, lambda: self.openMap(path),
+                         setup=lambda: shutil.rmtree(tile_dir, ignore_errors=True))
+            self.measure("new_map_cached", params, lambda: self.openMap(path))
+            self.measure("zoom_image", dict(params, steps=40), self.zoomSteps, setup=self.window.reset_image)
+
+    def runMarkers(self, size, counts):
+        path = self.mapPath(size)
+        map_hash = projectFile.fileHash(path)
+        for count in counts:
+            params = {'size': size, 'markers': count}
+            records = makeRecords(count, size, size // 2)
+
+            project = os.path.join(self.work_dir, "markers_%d.imap" % count)
+            projectFile.saveProject(project, path, map_hash, {'version': projectFile.DOCUMENT_VERSION,
+                                                              'markers': records})
+            # The project shown or cached by the previous run would be shown again without reading it
+            self.measure("load_data", params, lambda: (self.window.load_data(project), self.waitForMap(), self.repaint()),
+                         setup=self.leaveMap)
+            # Until the thumbnail of the project is painted, the rest of the project loads after it
+            self.window.remember_map()
+            self.measure("open_recent", params, lambda: (self.window.open_recent(project), self.repaint()))
+            self.app.processEvents()
+
+            # The first save of a project writes the image, later ones only the markers
+            targets = iter(os.path.join(self.work_dir, "save_%d_%d.imap" % (count, run)) for run in range(self.repeat))
+            self.measure("save_file", params, lambda: (self.window.save_file(next(targets)), self.finishJournal()))
+            self.measure("save_file_again", params, lambda: (self.window.save_file(), self.finishJournal()))
+
+            self.measure("zoom_image", dict(params, steps=40), self.zoomSteps, setup=self.window.reset_image)
+            self.measure("set_marker_size", dict(params, steps=30), self.sliderSteps, setup=self.zoomToMarkers)
+            self.measure("marker_items", params, lambda: self.createItems(count))
+
+    def zoomSteps(self):
+        view = self.window.graphics_view
+        for angle in [120] * 20 + [-120] * 20:
+            self.window.zoom_image(wheelEvent(view, angle))
+            self.repaint()
+
+    def zoomToMarkers(self):
+        # Close enough for the markers to be drawn instead of clusters
+        self.window.reset_image()
+        for _ in range(25):
+            self.window.zoom_image(wheelEvent(self.window.graphics_view, 120))
+        self.window.slider.setValue(25)
+        self.window.settle_marker_size()
+
+    def sliderSteps(self):
+        for value in range(26, 56):
+            self.window.slider.setValue(value)
+            self.repaint()
+        self.window.settle_marker_size()
+        self.repaint()
+
+    def createItems(self, count):
+        store = self.window.graphics_scene.store
+        rows = store.rows()[:count]
+        items = [MarkerItem(store, row) for row in rows]
+        del items
+
+    def close(self):
+        self.window.close()
+
+
+def formatParams(params):
+    return " ".join("%s=%s" % (key, value) for key, value in sorted(params.items()))
+
+
+def resultKey(result):
+    return result['name'], formatParams(result['params'])
+
+
+def compare(results, baseline, tolerance):
+    # Returns the results that are slower than the baseline by more than the tolerance
+    previous = {resultKey(result): result for result in baseline['results']}
+    regressions = []
+    print("\n%-16s %-32s %10s %10s %8s" % ("operation", "parameters", "baseline", "current", "ratio"))
+    for result in results:
+        old = previous.get(resultKey(result))
+        if old is None or old['seconds'] <= 0:
+            continue
+        ratio = result['seconds'] / old['seconds']
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(result)
+            flag = "  slower"
+        print("%-16s %-32s %10.4f %10.4f %8.2f%s" % (result['name'], formatParams(result['params']), old['seconds'],
+                                                     result['seconds'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmarks of map loading, saving, zooming and markers")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="map widths in pixels, the maps are 2:1")
+    parser.add_argument("--markers", default=DEFAULT_MARKERS, help="marker counts")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the median is reported")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="also write the results to " + DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    arguments = parser.parse_args()
+
+    sizes = [int(size) for size in arguments.sizes.split(",")]
+    counts = [int(count) for count in arguments.markers.split(",")]
+
+    work_dir = tempfile.mkdtemp(prefix="imap-benchmark-")
+    # Keep tiles and autosaves of the benchmark out of the user's caches
+    TilePyramid.cache_dir = os.path.join(work_dir, "tiles")
+    ChangeJournal.autosave_dir = os.path.join(work_dir, "autosave")
+    ChangeJournal.compact_interval = 3600.0
+    RecentMaps.directory = os.path.join(work_dir, "recent")
+    try:
+        benchmark = Benchmark(work_dir, arguments.repeat)
+        benchmark.runStartup()
+
+        benchmark.runMaps(sizes)
+        benchmark.runMarkers(min(sizes), counts)
+        benchmark.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'pyside': pyside_version,
+        'machine': platform.platform(),
+        'repeat': arguments.repeat,
+        'results': benchmark.results
+    }
+    with open(arguments.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    if arguments.save_baseline:
+        shutil.copyfile(arguments.output, DEFAULT_BASELINE)
+
+    if arguments.baseline:
+        with open(arguments.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = compare(benchmark.results, baseline, arguments.tolerance)
+        if regressions:
+            print("\n%d measurements are slower than the baseline" % len(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+import projectFile
+
+
+class ChangeJournal:
+    # Edits are appended to <project>.journal and synced to disk at least this often
+    flush_interval = 1.0
+    # The journal is folded back into the project at most this often
+    compact_interval = 30.0
+    autosave_dir = "autosave"
+
+    def __init__(self, project_path, image_path, image_hash, records, document=None, chunks=None):
+        self.project_path = project_path
+        self.journal_path = project_path + ".journal"
+        self.image_path = image_path
+        self.image_hash = image_hash
+
+        # Snapshot of the project as of the last write, only touched by the worker thread
+        self.records = {record['id']: record for record in records}
+        self.document = dict(document or {})
+        # Binary sections of the project, tag -> payload
+        self.chunks = dict(chunks or {})
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="ChangeJournal", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def autosavePath(image_path):
+        # Maps that were never saved are journaled into a project of their own under autosave/, images of the same
+        # name in different folders get different projects
+        stem = os.path.splitext(os.path.basename(image_path))[0]
+        key = hashlib.sha1(os.path.abspath(image_path).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(ChangeJournal.autosave_dir, stem + "-" + key + ".imap")
+
+    @staticmethod
+    def replay(project_path, records):
+        # Applies edits left in the journal by a session that did not finish, returns the records and their count
+        records = {record['id']: record for record in records}
+        replayed = 0
+        try:
+            with open(project_path + ".journal", 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        delta = json.loads(line)
+                    except ValueError:
+                        # Half-written last line of a crashed session
+                        break
+                    ChangeJournal.applyDelta(records, delta)
+                    replayed += 1
+        except OSError:
+            pass
+        return list(records.values()), replayed
+
+    @staticmethod
+    def applyDelta(records, delta):
+        if delta['op'] in ('add', 'edit'):
+            records[delta['marker']['id']] = delta['marker']
+        elif delta['op'] == 'move':
+            if delta['id'] in records:
+                records[delta['id']] = dict(records[delta['id']], x=delta['x'], y=delta['y'])
+        elif delta['op'] == 'delete':
+            records.pop(delta['id'], None)
+
+    # Called on the GUI thread, only builds a small dict and hands it to the worker
+
+    @staticmethod
+    def delta(op, marker):
+        # Also what the live sync sends to viewers
+        if op in ('add', 'edit'):
+            return {'op': op, 'marker': marker.record()}
+        if op == 'move':
+            position = marker.scenePos()
+            return {'op': op, 'id': marker.uid, 'x': position.x(), 'y': position.y()}
+        return {'op': op, 'id': marker.uid}
+
+    def record(self, op, marker):
+        self.queue.put(self.delta(op, marker))
+
+    def setSection(self, key, value):
+        # Non-marker parts of the project document, written out with the next compaction
+        self.queue.put({'op': 'document', 'key': key, 'value': value})
+
+    def setChunk(self, tag, payload):
+        # Binary sections like the fog of war, replaced whole and written with the next periodic compaction;
+        # a payload of None drops the section
+        self.queue.put({'op': 'chunk', 'tag': tag, 'payload': payload})
+
+    def compactNow(self):
+        self.queue.put('compact')
+
+    def sync(self, timeout=None):
+        # Blocks until everything queued so far is written, meant for shutdown and tools
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        self.queue.put('stop')
+        self.thread.join()
+
+    def stop(self):
+        # Like close, but lets the worker finish on its own
+        self.queue.put('stop')
+
+    # Worker thread
+
+    def run(self):
+        # The journal file is only created once there is something to write
+        file = None
+        last_flush = last_compact = time.monotonic()
+        unflushed = False
+        entries = 0
+        # Chunks changed since the last compaction, they are not in the journal
+        chunks_changed = False
+        compact = False
+        stopping = False
+        waiters = []
+
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+
+            if item == 'stop':
+                stopping = True
+                # Anything not yet folded into the project is written out before the worker ends
+                compact = compact or entries > 0 or chunks_changed
+            elif item == 'compact':
+                compact = True
+            elif isinstance(item, threading.Event):
+                waiters.append(item)
+            elif item is not None:
+                if item['op'] == 'document':
+                    self.document[item['key']] = item['value']
+                    compact = True
+                elif item['op'] == 'chunk':
+                    if item['payload'] is None:
+                        self.chunks.pop(item['tag'], None)
+                    else:
+                        self.chunks[item['tag']] = item['payload']
+                    chunks_changed = True
+                else:
+                    if file is None:
+                        os.makedirs(os.path.dirname(os.path.abspath(self.journal_path)), exist_ok=True)
+                        file = open(self.journal_path, 'a', encoding='utf-8')
+                    file.write(json.dumps(item, separators=(',', ':')) + "\n")
+                    self.applyDelta(self.records, item)
+                    unflushed = True
+                    entries += 1
+
+            now = time.monotonic()
+            if unflushed and (now - last_flush >= self.flush_interval or waiters or compact):
+                file.flush()
+                os.fsync(file.fileno())
+                unflushed = False
+                last_flush = now
+
+            if compact or ((entries or chunks_changed) and now - last_compact >= self.compact_interval):
+                try:
+                    self.compact()
+                except OSError:
+                    # The journal still holds everything, compaction is retried later
+                    pass
+                else:
+                    if file is not None:
+                        file.truncate(0)
+                        file.seek(0)
+                    elif os.path.exists(self.journal_path):
+                        # Left over by an earlier session and now part of the project
+                        os.remove(self.journal_path)
+                    entries = 0
+                    chunks_changed = False
+                compact = False
+                last_compact = now
+
+            for waiter in waiters:
+                waiter.set()
+            waiters = []
+
+        if file is not None:
+            file.close()
+            # Everything was folded into the project, so an empty journal is not left behind
+            if entries == 0:
+                os.remove(self.journal_path)
+
+    def compact(self):
+        if self.image_hash is None:
+            self.image_hash = projectFile.fileHash(self.image_path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.project_path)), exist_ok=True)
+        document = dict(self.document, markers=list(self.records.values()))
+        projectFile.saveProject(self.project_path, self.image_path, self.image_hash, document, self.chunks.items())
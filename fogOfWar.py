@@ -0,0 +1,209 @@
+import math
+import struct
+import zlib
+
+from PySide6.QtCore import QPointF, QRectF, Qt
+from PySide6.QtGui import QColor, QImage, QPainter, QPen, QPixmap
+from PySide6.QtWidgets import QGraphicsItem
+
+# Project chunk holding the mask: header, then (column, row, state, payload length, payload) of every tile that is
+# not fully fogged, the payload is the zlib compressed alpha of a mixed tile
+FOG_TAG = b"FOGM"
+FOG_VERSION = 1
+FOG_HEADER = struct.Struct("<HIIHHI")
+TILE_HEADER = struct.Struct("<HHBI")
+
+
+class FogMask:
+    # How much of the map players have explored, as tiles of alpha: 255 where the map is fogged, 0 where it is
+    # revealed. Tiles are tile_size mask pixels wide and a mask pixel covers `resolution` map pixels
+    tile_size = 256
+    # Longest side of the mask, larger maps get a coarser mask
+    max_side = 8192
+
+    # State of a tile, or of a rect; fogged tiles have no image
+    FOGGED = 0
+    CLEAR = 1
+    MIXED = 2
+
+    def __init__(self, width, height, resolution=None):
+        self.width = width
+        self.height = height
+        self.resolution = resolution or max(1, math.ceil(max(width, height) / self.max_side))
+        self.span = self.tile_size * self.resolution
+
+        # (column, row) -> state of the tile, tiles that are not in here are fogged
+        self.states = {}
+        # (column, row) -> QImage in Format_Alpha8 of a mixed tile
+        self.images = {}
+        # (column, row) -> QPixmap the mixed tile is drawn from
+        self.pixmaps = {}
+        # (column, row) -> compressed payload of a mixed tile as saved, only dirty tiles are compressed again
+        self.encoded = {}
+
+    def tileRect(self, tile):
+        return QRectF(tile[0] * self.span, tile[1] * self.span, self.span, self.span)
+
+    def tilesIn(self, rect):
+        rect = rect.intersected(QRectF(0, 0, self.width, self.height))
+        if rect.isEmpty():
+            return []
+        return [(column, row)
+                for row in range(int(rect.top() // self.span), int(math.ceil(rect.bottom() / self.span)))
+                for column in range(int(rect.left() // self.span), int(math.ceil(rect.right() / self.span)))]
+
+    def state(self, tile):
+        return self.states.get(tile, self.FOGGED)
+
+    def coverage(self, rect):
+        # FOGGED or CLEAR when every tile the rect touches is, MIXED otherwise
+        states = {self.state(tile) for tile in self.tilesIn(rect)}
+        if len(states) == 1:
+            return states.pop()
+        return self.MIXED if states else self.FOGGED
+
+    def isRevealed(self, x, y):
+        tile = (int(x // self.span), int(y // self.span))
+        state = self.state(tile)
+        if state != self.MIXED:
+            return state == self.CLEAR
+        image = self.images[tile]
+        column = min(int(x / self.resolution) - tile[0] * self.tile_size, self.tile_size - 1)
+        row = min(int(y / self.resolution) - tile[1] * self.tile_size, self.tile_size - 1)
+        return image.constBits()[row * image.bytesPerLine() + column] < 128
+
+    def brush(self, start, end, radius, reveal=True):
+        # Paints a stroke of round dabs from start to end in map coordinates, only the tiles under it are touched.
+        # Returns the map rect that changed
+        rect = QRectF(start, end).normalized().adjusted(-radius, -radius, radius, radius)
+        pen = QPen(Qt.GlobalColor.transparent if reveal else QColor(0, 0, 0), 2 * radius / self.resolution,
+                   Qt.PenStyle.SolidLine, Qt.PenCapStyle.RoundCap)
+        for tile in self.tilesIn(rect):
+            state = self.state(tile)
+            if state == (self.CLEAR if reveal else self.FOGGED):
+                continue
+            image = self.images.get(tile)
+            if image is None:
+                image = QImage(self.tile_size, self.tile_size, QImage.Format.Format_Alpha8)
+                image.fill(QColor(0, 0, 0, 0 if state == self.CLEAR else 255))
+
+            painter = QPainter(image)
+            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+            painter.setPen(pen)
+            origin = QPointF(tile[0] * self.span, tile[1] * self.span)
+            if start == end:
+                # A click without a drag, a line of no length paints nothing even with round caps
+                painter.setPen(Qt.PenStyle.NoPen)
+                painter.setBrush(pen.brush())
+                painter.drawEllipse((start - origin) / self.resolution, radius / self.resolution,
+                                    radius / self.resolution)
+            else:
+                painter.drawLine((start - origin) / self.resolution, (end - origin) / self.resolution)
+            painter.end()
+            self.setTile(tile, image)
+        return rect
+
+    def setTile(self, tile, image):
+        # Uniform tiles keep no image, so a mask costs memory only along the edge of the explored area
+        data = image.constBits().tobytes()
+        self.pixmaps.pop(tile, None)
+        self.encoded.pop(tile, None)
+        if not data.strip(b"\x00"):
+            self.states[tile] = self.CLEAR
+            self.images.pop(tile, None)
+        elif not data.strip(b"\xff"):
+            self.states.pop(tile, None)
+            self.images.pop(tile, None)
+        else:
+            self.states[tile] = self.MIXED
+            self.images[tile] = image
+
+    def pixmap(self, tile):
+        pixmap = self.pixmaps.get(tile)
+        if pixmap is None:
+            pixmap = self.pixmaps[tile] = QPixmap.fromImage(self.images[tile])
+        return pixmap
+
+    def toBytes(self):
+        # Tiles that did not change since the last save reuse their compressed payload
+        parts = [FOG_HEADER.pack(FOG_VERSION, self.width, self.height, self.resolution, self.tile_size,
+                                 len(self.states))]
+        for tile, state in self.states.items():
+            payload = b""
+            if state == self.MIXED:
+                payload = self.encoded.get(tile)
+                if payload is None:
+                    payload = self.encoded[tile] = zlib.compress(self.images[tile].constBits().tobytes(), 1)
+            parts.append(TILE_HEADER.pack(tile[0], tile[1], state, len(payload)))
+            parts.append(payload)
+        return b"".join(parts)
+
+    @staticmethod
+    def fromBytes(data):
+        try:
+            return FogMask.readBytes(data)
+        except (struct.error, zlib.error) as error:
+            raise ValueError("Fog of war is damaged: " + str(error))
+
+    @staticmethod
+    def readBytes(data):
+        version, width, height, resolution, tile_size, count = FOG_HEADER.unpack_from(data)
+        if version > FOG_VERSION or tile_size != FogMask.tile_size:
+            raise ValueError("Fog of war was saved by a newer version of Interactive Map")
+        mask = FogMask(width, height, resolution)
+        # Masks come from project files and from the host of a shared map, nothing is trusted
+        columns, rows = math.ceil(width / mask.span), math.ceil(height / mask.span)
+        offset = FOG_HEADER.size
+        for _ in range(count):
+            column, row, state, length = TILE_HEADER.unpack_from(data, offset)
+            offset += TILE_HEADER.size
+            if column >= columns or row >= rows:
+                raise ValueError("Fog of war has a tile outside the map")
+            if state not in (FogMask.CLEAR, FogMask.MIXED):
+                raise ValueError("Fog of war has a tile of unknown state %d" % state)
+            tile = (column, row)
+            mask.states[tile] = state
+            if state == FogMask.MIXED:
+                payload = data[offset:offset + length]
+                pixels = zlib.decompress(payload)
+                if len(pixels) != tile_size * tile_size:
+                    raise ValueError("Fog of war has a tile of the wrong size")
+                image = QImage(pixels, tile_size, tile_size, tile_size, QImage.Format.Format_Alpha8).copy()
+                mask.images[tile] = image
+                mask.encoded[tile] = payload
+            offset += length
+        return mask
+
+
+class FogLayer(QGraphicsItem):
+    # Draws the fog over the map image, below the markers; a repaint only draws the tiles in the exposed area
+
+    def __init__(self, mask):
+        super().__init__()
+        self.mask = mask
+        self.setAcceptedMouseButtons(Qt.MouseButton.NoButton)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        # Above the map item, below the marker layer
+        self.setZValue(0.5)
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.mask.width, self.mask.height)
+
+    def brush(self, start, end, radius, reveal=True):
+        self.update(self.mask.brush(start, end, radius, reveal))
+
+    def paint(self, painter, option, widget=None):
+        mask = self.mask
+        # Tiles meet on whole map pixels, antialiased edges would let the map show through the seams
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing, False)
+        for tile in mask.tilesIn(option.exposedRect):
+            state = mask.state(tile)
+            target = mask.tileRect(tile).intersected(self.boundingRect())
+            if state == FogMask.FOGGED:
+                painter.fillRect(target, Qt.GlobalColor.black)
+            elif state == FogMask.MIXED:
+                # Edge tiles reach over the map, only the part on the map is drawn
+                source = QRectF(target.topLeft() - mask.tileRect(tile).topLeft(), target.size())
+                source = QRectF(source.topLeft() / mask.resolution, source.size() / mask.resolution)
+                painter.drawPixmap(target, mask.pixmap(tile), source)
@@ -0,0 +1,50 @@
+import os
+
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QColor, QPainter, QPen, QPixmap
+
+from perfTrace import perf_trace
+from pixmapCache import PixmapCache
+
+
+class IconCache(PixmapCache):
+    # Budget for all decoded and scaled pixmaps kept alive by the cache
+    max_bytes = 64 * 1024 * 1024
+    placeholder_size = 64
+
+    def __init__(self, folders, max_bytes=max_bytes):
+        super().__init__(max_bytes)
+        # Keyed by (category, icon, size)
+        self.folders = folders
+
+    def pixmap(self, category, icon, size=None):
+        # Size None stands for the decoded original, which scaled variants are made from
+        key = (category, icon, size)
+        pixmap = self.get(key)
+        if pixmap is not None:
+            return pixmap
+
+        if size is None:
+            with perf_trace.section("icon_load"):
+                pixmap = QPixmap(os.path.join(self.folders[category], icon)) if icon is not None else QPixmap()
+            if pixmap.isNull():
+                # Markers of an empty or missing icon folder stay visible and clickable
+                pixmap = self.placeholder()
+        else:
+            original = self.pixmap(category, icon)
+            with perf_trace.section("icon_scale"):
+                pixmap = original.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatio,
+                                         Qt.TransformationMode.SmoothTransformation)
+        self.insert(key, pixmap)
+        return pixmap
+
+    def placeholder(self):
+        pixmap = QPixmap(self.placeholder_size, self.placeholder_size)
+        pixmap.fill(Qt.GlobalColor.transparent)
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.setPen(QPen(QColor("black"), 4))
+        painter.setBrush(QColor("lightgray"))
+        painter.drawEllipse(4, 4, self.placeholder_size - 8, self.placeholder_size - 8)
+        painter.end()
+        return pixmap
@@ -0,0 +1,109 @@
+import json
+import os
+
+
+class IconCatalog:
+    manifest_path = "markers/catalog.json"
+    manifest_version = 1
+
+    def __init__(self, folders, manifest_path=manifest_path):
+        self.folders = folders
+        self.manifest_path = manifest_path
+
+        # category -> ordered list of icon ids; an id keeps its index for as long as the manifest exists
+        self.icons = {}
+        # category -> set of icon ids that are currently present on disk
+        self.present = {}
+
+        self.load()
+
+    def folderMtimes(self):
+        mtimes = {}
+        for category, folder in self.folders.items():
+            try:
+                mtimes[category] = os.stat(folder).st_mtime_ns
+            except OSError:
+                mtimes[category] = None
+        return mtimes
+
+    def readManifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(manifest, dict) or manifest.get('version') != self.manifest_version:
+            return None
+        return manifest
+
+    def load(self):
+        manifest = self.readManifest()
+        mtimes = self.folderMtimes()
+
+        if manifest is not None and manifest.get('mtimes') == mtimes:
+            self.icons = {category: list(manifest['icons'].get(category, [])) for category in self.folders}
+            self.present = {category: set(manifest['present'].get(category, [])) for category in self.folders}
+            return
+
+        self.rebuild(manifest['icons'] if manifest is not None else {})
+        self.save(mtimes)
+
+    def rebuild(self, previous):
+        for category, folder in self.folders.items():
+            try:
+                files = sorted(file for file in os.listdir(folder) if file.endswith(".png"))
+            except OSError:
+                files = []
+
+            # Known icons keep their position, new ones are appended so saved indices never shift
+            order = list(previous.get(category, []))
+            known = set(order)
+            order.extend(file for file in files if file not in known)
+
+            self.icons[category] = order
+            self.present[category] = set(files)
+
+    def save(self, mtimes):
+        manifest = {
+            'version': self.manifest_version,
+            'mtimes': mtimes,
+            'icons': self.icons,
+            'present': {category: sorted(icons) for category, icons in self.present.items()}
+        }
+        temp_path = self.manifest_path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(manifest, file, indent=1)
+            os.replace(temp_path, self.manifest_path)
+        except OSError:
+            # A read-only install still works, the catalog is simply rebuilt on the next start
+            pass
+
+    def iconIds(self, category):
+        return self.icons.get(category, [])
+
+    def isAvailable(self, category, icon):
+        return icon in self.present.get(category, ())
+
+    def available(self, category):
+        # Pairs of (index, icon id) for the icons that can currently be shown
+        return [(index, icon) for index, icon in enumerate(self.iconIds(category)) if self.isAvailable(category, icon)]
+
+    def icon(self, category, index):
+        icons = self.iconIds(category)
+        if 0 <= index < len(icons) and self.isAvailable(category, icons[index]):
+            return icons[index]
+        return None
+
+    def legacyIcons(self, category):
+        # Old data files stored indices into the folder in directory listing order, not the order of the manifest
+        try:
+            return [file for file in os.listdir(self.folders[category]) if file.endswith(".png")]
+        except (KeyError, OSError):
+            return []
+
+    def indexOf(self, category, icon):
+        try:
+            return self.iconIds(category).index(icon)
+        except ValueError:
+            return None
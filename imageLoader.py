@@ -0,0 +1,169 @@
+import threading
+
+from PySide6.QtCore import QObject, QRectF, QRunnable, QSize, QThreadPool, Qt, Signal
+from PySide6.QtGui import QColor, QImageReader
+from PySide6.QtWidgets import QGraphicsItem
+
+from perfTrace import perf_trace
+from tilePyramid import TilePyramid
+
+
+class MapLoadSignals(QObject):
+    # Emitted from the worker thread, delivered to the loader on the GUI thread
+    preview = Signal(int, object)
+    finished = Signal(int, object)
+    failed = Signal(int, str)
+
+
+class MapLoadTask(QRunnable):
+    def __init__(self, generation, file_path, preview_size, preview_threshold, signals):
+        super().__init__()
+        # The loader keeps the task alive until it is done
+        self.setAutoDelete(False)
+
+        self.generation = generation
+        self.file_path = file_path
+        self.preview_size = preview_size
+        self.preview_threshold = preview_threshold
+        self.signals = signals
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            with perf_trace.section("map_decode"):
+                self.load()
+        except OSError as error:
+            self.signals.failed.emit(self.generation, str(error))
+        finally:
+            self.done.set()
+
+    def load(self):
+        size = QImageReader(self.file_path).size()
+        if max(size.width(), size.height()) > self.preview_threshold:
+            # JPEG decoders scale while decoding, so the preview is much faster than the full image
+            reader = QImageReader(self.file_path)
+            reader.setAutoTransform(True)
+            reader.setScaledSize(size.scaled(self.preview_size, self.preview_size,
+                                             Qt.AspectRatioMode.KeepAspectRatio))
+            preview = reader.read()
+            if not preview.isNull() and not self.cancelled:
+                self.signals.preview.emit(self.generation, preview)
+        if self.cancelled:
+            return
+
+        if TilePyramid.needsTiling(self.file_path):
+            # The map is shown from tiles, no full resolution image is handed to the GUI
+            pyramid = TilePyramid(self.file_path)
+            if not pyramid.isBuilt():
+                pyramid.build()
+            if not self.cancelled:
+                self.signals.finished.emit(self.generation, pyramid)
+            return
+
+        reader = QImageReader(self.file_path)
+        reader.setAutoTransform(True)
+        QImageReader.setAllocationLimit(0)
+        image = reader.read()
+        if image.isNull():
+            raise IOError("Could not read " + self.file_path + ": " + reader.errorString())
+        if not self.cancelled:
+            self.signals.finished.emit(self.generation, image)
+
+
+class MapImageLoader(QObject):
+    # Longest side of the preview shown while the full image is decoded
+    preview_size = 1024
+    # Smaller images decode quickly enough that a preview would only add work
+    preview_threshold = 4096
+
+    # Only emitted for the map that was requested last
+    previewReady = Signal(object)
+    loaded = Signal(object)
+    failed = Signal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self.pool = QThreadPool.globalInstance()
+        self.signals = MapLoadSignals()
+        self.signals.preview.connect(self.handlePreview)
+        self.signals.finished.connect(self.handleFinished)
+        self.signals.failed.connect(self.handleFailed)
+
+        # Results of an earlier request that finishes late are told apart by their generation
+        self.generation = 0
+        self.task = None
+
+    def load(self, file_path):
+        self.cancel()
+        self.generation += 1
+        self.task = MapLoadTask(self.generation, file_path, self.preview_size, self.preview_threshold,
+                                self.signals)
+        self.pool.start(self.task)
+
+    def cancel(self):
+        # Decoding that already started runs to its end on the worker, its result is dropped
+        if self.task is not None:
+            self.task.cancelled = True
+            self.task = None
+            self.generation += 1
+
+    def isLoading(self):
+        return self.task is not None
+
+    def wait(self, timeout=None):
+        # Blocks until the worker is done, the results arrive with the next processed events
+        if self.task is not None:
+            return self.task.done.wait(timeout)
+        return True
+
+    def handlePreview(self, generation, image):
+        if generation == self.generation:
+            self.previewReady.emit(image)
+
+    def handleFinished(self, generation, result):
+        if generation == self.generation:
+            self.task = None
+            self.loaded.emit(result)
+
+    def handleFailed(self, generation, message):
+        if generation == self.generation:
+            self.task = None
+            self.failed.emit(message)
+
+
+class MapImageItem(QGraphicsItem):
+    # Map item of the full image size whatever pixmap it currently shows, so marker positions stay in map pixels
+
+    def __init__(self, size):
+        super().__init__()
+
+        self.size = QSize(size)
+        self.pixmap = None
+        self.placeholder = QColor(200, 200, 200)
+
+        # Paint only receives the exposed part of the map
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.size.width(), self.size.height())
+
+    def setPixmap(self, pixmap):
+        self.pixmap = pixmap
+        self.update()
+
+    def isFullResolution(self):
+        return self.pixmap is not None and self.pixmap.size() == self.size
+
+    def paint(self, painter, option, widget=None):
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if self.pixmap is None:
+            painter.fillRect(exposed, self.placeholder)
+            return
+        # A preview is stretched over the whole map
+        scale_x = self.pixmap.width() / self.size.width()
+        scale_y = self.pixmap.height() / self.size.height()
+        source = QRectF(exposed.x() * scale_x, exposed.y() * scale_y, exposed.width() * scale_x,
+                        exposed.height() * scale_y)
+        painter.drawPixmap(exposed, self.pixmap, source)
@@ -0,0 +1,309 @@
+import json
+import os
+import re
+import struct
+import zlib
+
+from PySide6.QtCore import QObject, QTimer, Signal
+from PySide6.QtNetwork import QHostAddress, QTcpServer, QTcpSocket
+
+import projectFile
+from changeJournal import ChangeJournal
+
+# Every message is a frame: payload length, message type, payload
+FRAME_HEADER = struct.Struct(">IB")
+DEFAULT_PORT = 47800
+# Only this machine can connect unless another address to listen on is given, there is no authentication
+DEFAULT_HOST = "127.0.0.1"
+# Map images a host may send, the hash and extension of a MAP message name the file in the image cache
+IMAGE_EXTENSIONS = {"png", "jpg", "jpeg", "bmp", "gif", "webp", "tif", "tiff"}
+HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+# Host to viewer
+MAP = 1         # JSON {generation, hash, extension}: the host shows another map
+IMAGE = 2       # Raw bytes of the map image file, only sent to viewers that do not have it cached
+SNAPSHOT = 3    # zlib compressed JSON list of every marker record
+DELTAS = 4      # zlib compressed JSON list of marker deltas, as written to the change journal
+FOG = 6         # Fog of war mask as saved in projects, empty when the map has no fog
+# Viewer to host
+READY = 5       # JSON {generation, cached}: the viewer got MAP and tells whether it needs the image
+
+
+def frame(kind, payload):
+    return FRAME_HEADER.pack(len(payload), kind) + payload
+
+
+def packJson(value, compress=False):
+    data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    # Level 1 keeps the cost of a batch far below the latency budget, marker JSON still shrinks several times
+    return zlib.compress(data, 1) if compress else data
+
+
+def unpackJson(payload, compressed=False):
+    return json.loads((zlib.decompress(payload) if compressed else payload).decode('utf-8'))
+
+
+# What a malformed frame from the other side raises, the connection is dropped
+FRAME_ERRORS = (ValueError, KeyError, TypeError, AttributeError, zlib.error)
+
+
+class FrameReader:
+    # Splits what arrives on a socket into whole frames
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            length, kind = FRAME_HEADER.unpack_from(self.buffer)
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            frames.append((kind, bytes(self.buffer[FRAME_HEADER.size:end])))
+            del self.buffer[:end]
+        return frames
+
+
+class SyncServer(QObject):
+    # Edits are collected for this long and sent together
+    batch_interval = 10
+
+    clientsChanged = Signal(int)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self.server = QTcpServer(self)
+        self.server.newConnection.connect(self.handleNewConnection)
+        # socket -> (FrameReader, generation of the map the viewer has, or None while it is not ready)
+        self.clients = {}
+
+        self.scene = None
+        # (signal, slot) connected on the current scene
+        self.connections = []
+        self.map_path = None
+        self.image_hash = None
+        self.generation = 0
+        # Compressed snapshot of the current map, reused by viewers joining until the next edit
+        self.snapshot = None
+        self.hashes = {}
+
+        self.pending = []
+        self.batch_timer = QTimer(self)
+        self.batch_timer.setSingleShot(True)
+        self.batch_timer.setInterval(self.batch_interval)
+        self.batch_timer.timeout.connect(self.flush)
+
+        # Map changes are announced once the event loop is back, after the markers of a project were loaded
+        self.map_timer = QTimer(self)
+        self.map_timer.setSingleShot(True)
+        self.map_timer.setInterval(0)
+        self.map_timer.timeout.connect(self.announceMap)
+
+    def listen(self, port=DEFAULT_PORT, address=DEFAULT_HOST):
+        # address is an IP address string or a QHostAddress.SpecialAddress, "0.0.0.0" opens the map to the network
+        host = QHostAddress(address)
+        if host.isNull():
+            raise IOError("Could not listen on %s: not an IP address" % address)
+        if not self.server.listen(host, port):
+            raise IOError("Could not listen on %s port %d: %s" % (address, port, self.server.errorString()))
+        return self.server.serverPort()
+
+    def isListening(self):
+        return self.server.isListening()
+
+    def close(self):
+        self.batch_timer.stop()
+        self.map_timer.stop()
+        for socket in list(self.clients):
+            socket.disconnectFromHost()
+        self.clients.clear()
+        self.server.close()
+        self.setMap(None, None)
+
+    def setMap(self, scene, map_path):
+        # Follows the scene shown by the window, its marker signals become the deltas sent to viewers
+        if scene is not self.scene:
+            if self.scene is not None:
+                for signal, slot in self.connections:
+                    signal.disconnect(slot)
+            self.connections = []
+            if scene is not None:
+                for op, signal in (('add', scene.markerAdded), ('edit', scene.markerEdited),
+                                   ('move', scene.markerMoved), ('delete', scene.markerRemoved)):
+                    slot = (lambda marker, op=op: self.record(op, marker))
+                    signal.connect(slot)
+                    self.connections.append((signal, slot))
+            self.scene = scene
+        self.map_path = map_path
+        self.image_hash = None
+        self.pending = []
+        self.snapshot = None
+        self.generation += 1
+        if map_path is not None and self.isListening():
+            self.map_timer.start()
+
+    def imageHash(self):
+        # Hashed once per file version, the viewers cache images by content
+        stat = os.stat(self.map_path)
+        key = (os.path.abspath(self.map_path), stat.st_size, stat.st_mtime_ns)
+        image_hash = self.hashes.get(key)
+        if image_hash is None:
+            image_hash = self.hashes[key] = projectFile.fileHash(self.map_path)
+        return image_hash
+
+    def announceMap(self):
+        if self.map_path is None:
+            return
+        self.image_hash = self.imageHash()
+        for socket in self.clients:
+            self.sendMap(socket)
+
+    def sendMap(self, socket):
+        self.clients[socket] = (self.clients[socket][0], None)
+        extension = os.path.splitext(self.map_path)[1].lstrip('.').lower()
+        socket.write(frame(MAP, packJson({'generation': self.generation, 'hash': self.image_hash,
+                                          'extension': extension})))
+
+    def handleNewConnection(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            # Small delta frames go out right away instead of waiting to be merged by the network stack
+            socket.setSocketOption(QTcpSocket.SocketOption.LowDelayOption, 1)
+            self.clients[socket] = (FrameReader(), None)
+            socket.readyRead.connect(lambda socket=socket: self.handleReadyRead(socket))
+            socket.disconnected.connect(lambda socket=socket: self.handleDisconnected(socket))
+            if self.map_path is not None and self.image_hash is not None:
+                self.sendMap(socket)
+            self.clientsChanged.emit(len(self.clients))
+
+    def handleDisconnected(self, socket):
+        if self.clients.pop(socket, None) is not None:
+            socket.deleteLater()
+            self.clientsChanged.emit(len(self.clients))
+
+    def handleReadyRead(self, socket):
+        if socket not in self.clients:
+            return
+        reader, _ = self.clients[socket]
+        try:
+            for kind, payload in reader.feed(socket.readAll().data()):
+                if kind == READY:
+                    self.handleReady(socket, reader, unpackJson(payload))
+        except FRAME_ERRORS:
+            # Not a viewer of this app, or a broken one
+            socket.abort()
+            self.handleDisconnected(socket)
+
+    def handleReady(self, socket, reader, message):
+        if message['generation'] != self.generation:
+            return
+        if not message['cached']:
+            with open(self.map_path, 'rb') as file:
+                socket.write(frame(IMAGE, file.read()))
+        # Edits still waiting for the batch are already part of the snapshot
+        self.flush()
+        if self.snapshot is None:
+            self.snapshot = packJson(self.scene.markerRecords(), compress=True)
+        socket.write(frame(SNAPSHOT, self.snapshot))
+        if self.scene.fog is not None:
+            socket.write(frame(FOG, self.scene.fog.toBytes()))
+        self.clients[socket] = (reader, self.generation)
+
+    def record(self, op, marker):
+        if not self.clients:
+            return
+        self.snapshot = None
+        self.pending.append(ChangeJournal.delta(op, marker))
+        if not self.batch_timer.isActive():
+            self.batch_timer.start()
+
+    def sendFog(self):
+        # After every brush stroke, the mask only holds the tiles on the edge of the explored area
+        if self.scene is None:
+            return
+        self.flush()
+        data = frame(FOG, self.scene.fog.toBytes() if self.scene.fog is not None else b"")
+        for socket, (_, generation) in self.clients.items():
+            if generation == self.generation:
+                socket.write(data)
+
+    def flush(self):
+        self.batch_timer.stop()
+        if not self.pending:
+            return
+        data = frame(DELTAS, packJson(self.pending, compress=True))
+        self.pending = []
+        for socket, (_, generation) in self.clients.items():
+            if generation == self.generation:
+                socket.write(data)
+                socket.flush()
+
+
+class SyncClient(QObject):
+    # The host showed another map: image file path and marker records
+    mapReceived = Signal(str, object)
+    # A batch of marker deltas of the map last received
+    deltasReceived = Signal(object)
+    # Fog of war mask of the map last received, empty bytes when it has none
+    fogReceived = Signal(bytes)
+    disconnected = Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self.socket = QTcpSocket(self)
+        self.socket.setSocketOption(QTcpSocket.SocketOption.LowDelayOption, 1)
+        self.socket.readyRead.connect(self.handleReadyRead)
+        self.socket.disconnected.connect(self.disconnected)
+        self.reader = FrameReader()
+        self.map = None
+
+    def connectToHost(self, host, port=DEFAULT_PORT, timeout=5000):
+        self.socket.connectToHost(host, port)
+        if not self.socket.waitForConnected(timeout):
+            raise IOError("Could not connect to %s:%d: %s" % (host, port, self.socket.errorString()))
+
+    def close(self):
+        self.socket.disconnectFromHost()
+
+    def imagePath(self):
+        # Images received once are kept in the same content addressed cache as the images of projects
+        return os.path.join(projectFile.images_dir, self.map['hash'] + "." + self.map['extension'])
+
+    @staticmethod
+    def checkMap(message):
+        # The hash and extension become a file name, anything that could point outside the cache is refused
+        if not isinstance(message.get('hash'), str) or not HASH_PATTERN.fullmatch(message['hash']):
+            raise ValueError("Invalid map hash")
+        if message.get('extension') not in IMAGE_EXTENSIONS:
+            raise ValueError("Invalid map image type")
+        return message
+
+    def handleReadyRead(self):
+        try:
+            self.readFrames()
+        except FRAME_ERRORS:
+            # The host is not this app, or sent something broken, aborting emits disconnected
+            self.socket.abort()
+
+    def readFrames(self):
+        for kind, payload in self.reader.feed(self.socket.readAll().data()):
+            if kind == MAP:
+                self.map = self.checkMap(unpackJson(payload))
+                cached = os.path.exists(self.imagePath())
+                self.socket.write(frame(READY, packJson({'generation': self.map['generation'], 'cached': cached})))
+            elif kind == IMAGE:
+                os.makedirs(projectFile.images_dir, exist_ok=True)
+                temp_path = self.imagePath() + ".tmp"
+                with open(temp_path, 'wb') as file:
+                    file.write(payload)
+                os.replace(temp_path, self.imagePath())
+            elif kind == SNAPSHOT:
+                self.mapReceived.emit(self.imagePath(), unpackJson(payload, compressed=True))
+            elif kind == DELTAS:
+                self.deltasReceived.emit(unpackJson(payload, compressed=True))
+            elif kind == FOG:
+                self.fogReceived.emit(payload)
@@ -1,26 +1,64 @@
-import datetime
+import importlib.util
+import math
 import os
-import pickle
 import sys
+import warnings
 
-from PySide6.QtCore import Qt
-from PySide6.QtGui import QPainter, QPixmap, QColor, QIcon
+from PySide6.QtCore import QPointF, QSize, Qt, QTimer
+from PySide6.QtGui import QPixmap, QIcon, QImageReader, QTransform
 from PySide6.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, \
-    QToolBar, QGraphicsView, QGraphicsScene, QFileDialog, QTextEdit, QGraphicsPixmapItem, QSlider
-
-from markerPanel import MarkerPanel
+    QToolBar, QGraphicsView, QFileDialog, QSlider, QInputDialog, QMessageBox, QProgressDialog, QMenu, \
+    QDockWidget
+
+import projectFile
+from changeJournal import ChangeJournal
+from fogOfWar import FOG_TAG, FogMask
+from imageLoader import MapImageItem, MapImageLoader
+from mapCache import MapCache, MapState
+from mapScene import MapScene
+from markerPanel import MarkerInfoPanel, MarkerPanel
+from markerSearch import MarkerSearchBox
+from markerStore import joinTags, splitTags
 from markers import MarkerItem
+from minimap import Minimap
+from perfTrace import perf_trace, timed
+from recentMaps import RecentMaps
+from renderQuality import RenderQuality
+from tilePyramid import TilePyramid, TiledMapItem
 
 
 class MainWindow(QMainWindow):
+    # Radius of the fog of war brush on screen
+    fog_brush_pixels = 40
+    # The game master sees the map through the fog, viewers of a shared map do not
+    fog_opacity = 0.6
+
     def __init__(self):
         super().__init__()
 
         self.setWindowTitle("Interactive Map")
         self.setWindowIcon(QIcon("./icon.ico"))
         self.picture_item = None
+        self.map_path = None
+        self.map_hash = None
+        self.project_path = None
+        self.journal = None
         self.resize(800, 600)
 
+        # Maps visited recently stay in memory, IMAP_MAP_CACHE_MB sets how much they may take
+        self.map_cache = MapCache(int(os.environ.get("IMAP_MAP_CACHE_MB", 512)) * 1024 * 1024)
+        # Parents of the maps opened from a marker link: (project path, image path, view transform, view center)
+        self.map_stack = []
+
+        # Live sync: the server mirrors the shown map to viewers, the client is set while this window is a viewer.
+        # Both are created when first used, so the network module is not loaded at startup
+        self.sync_server = None
+        self.sync_client = None
+        self.shared_scene = None
+
+        # Maps opened lately, with thumbnails, read from disk when the menu is first opened
+        self.recent_maps = RecentMaps()
+
         # Create the main widget
         main_panel = QWidget()
         main_layout = QHBoxLayout()
@@ -45,13 +83,25 @@ class MainWindow(QMainWindow):
 
         # Create a QGraphicsView and QGraphicsScene
         self.graphics_view = QGraphicsView()
-        self.graphics_scene = QGraphicsScene()
-        self.graphics_scene.selectionChanged.connect(self.handleMarkerSelectionChanged)
+        # Every map has a scene of its own, so that a cached map is shown again by swapping scenes
+        self.graphics_scene = self.create_scene()
         self.graphics_view.setScene(self.graphics_scene)
 
+        # The marker panels are built once and rebound to the marker being shown or edited
+        self.marker_panel = MarkerPanel(self.graphics_scene)
+        self.marker_panel.linkRequested.connect(self.choose_marker_link)
+        self.left_layout.addWidget(self.marker_panel)
+        self.marker_info_panel = MarkerInfoPanel()
+        self.marker_info_panel.editRequested.connect(self.show_marker_panel)
+        self.marker_info_panel.closeRequested.connect(self.close_marker_info)
+        self.marker_info_panel.openLinkRequested.connect(self.open_linked_map)
+        self.left_layout.addWidget(self.marker_info_panel)
+
         # Drag and zoom of the QGraphicsView
         self.graphics_view = QGraphicsView(self.graphics_scene)
-        self.graphics_view.setRenderHint(QPainter.Antialiasing)
+        # Antialiasing and smooth scaling are switched off while the map is dragged or zoomed
+        self.render_quality = RenderQuality(self.graphics_view)
+        self.render_quality.settled.connect(lambda: self.update_visible_area())
         # TODO Figure out the warning
         # noinspection PyUnresolvedReferences
         self.graphics_view.setDragMode(QGraphicsView.ScrollHandDrag)
@@ -62,9 +112,32 @@ class MainWindow(QMainWindow):
         self.graphics_view.wheelEvent = self.zoom_image
         # Connect the slot function to the clicked signal of the graphics view
         self.graphics_view.mouseDoubleClickEvent = self.place_new_marker
+        # Timed for the performance overlay
+        self.graphics_view.paintEvent = self.paint_view
+        # Dragging paints the fog of war while its brush is on, otherwise it moves the map
+        self.graphics_view.mousePressEvent = self.view_mouse_press
+        self.graphics_view.mouseMoveEvent = self.view_mouse_move
+        self.graphics_view.mouseReleaseEvent = self.view_mouse_release
+        # Last point of the fog brush stroke being painted, and whether the stroke reveals or fogs
+        self.fog_stroke = None
+        self.fog_reveal = True
+        # Route tool: (scene, point, name) of the marker a route starts from, and the terrain of the shown map as
+        # (map path, TerrainGrid)
+        self.route_start = None
+        self.terrain = None
+        # Dragging the map moves the scroll bars, which brings other tiles and markers into view
+        self.graphics_view.horizontalScrollBar().valueChanged.connect(lambda: self.update_visible_area())
+        self.graphics_view.verticalScrollBar().valueChanged.connect(lambda: self.update_visible_area())
 
         center_layout.addWidget(self.graphics_view)
 
+        # Whole map with the part in view, drawn from a small copy of the map so panning never repaints the scene
+        self.minimap = Minimap(self)
+        self.minimap.navigateRequested.connect(self.center_view)
+        minimap_dock = QDockWidget("Minimap", self)
+        minimap_dock.setWidget(self.minimap)
+        self.addDockWidget(Qt.RightDockWidgetArea, minimap_dock)
+
         # Create a toolbar
         toolbar = QToolBar(self)
         toolbar.setMovable(False)
@@ -76,17 +149,91 @@ class MainWindow(QMainWindow):
         toolbar.addWidget(button_new)
 
         button_save = QPushButton("Save Map", self)
-        button_save.clicked.connect(lambda: self.save_file("scene_data.dat"))
+        button_save.clicked.connect(lambda: self.save_file())
         toolbar.addWidget(button_save)
 
         button_load = QPushButton("Open Map", self)
         button_load.clicked.connect(self.load_data)
         toolbar.addWidget(button_load)
 
+        button_recent = QPushButton("Open Recent", self)
+        self.recent_menu = QMenu(self)
+        self.recent_menu.aboutToShow.connect(self.fill_recent_menu)
+        button_recent.setMenu(self.recent_menu)
+        toolbar.addWidget(button_recent)
+
         button_reset = QPushButton("Reset Map Position", self)
         button_reset.clicked.connect(self.reset_image)
         toolbar.addWidget(button_reset)
 
+        # Returns from a map opened through a marker link to the map it was opened from
+        self.button_back = QPushButton("Back", self)
+        self.button_back.clicked.connect(self.go_back)
+        self.button_back.setEnabled(False)
+        toolbar.addWidget(self.button_back)
+
+        # Categories and user tags shown on the map
+        button_layers = QPushButton("Layers", self)
+        self.layers_menu = QMenu(self)
+        self.layers_menu.aboutToShow.connect(self.fill_layers_menu)
+        button_layers.setMenu(self.layers_menu)
+        toolbar.addWidget(button_layers)
+
+        button_minimap = QPushButton("Minimap", self)
+        button_minimap.setCheckable(True)
+        button_minimap.setChecked(True)
+        button_minimap.toggled.connect(minimap_dock.setVisible)
+        minimap_dock.visibilityChanged.connect(button_minimap.setChecked)
+        toolbar.addWidget(button_minimap)
+
+        button_export = QPushButton("Export Image", self)
+        button_export.clicked.connect(lambda: self.export_image())
+        toolbar.addWidget(button_export)
+
+        # Frame times, item counts and cache hit rates drawn over the map, created when first shown
+        self.perf_overlay = None
+        button_perf = QPushButton("Performance", self)
+        button_perf.setCheckable(True)
+        button_perf.toggled.connect(self.toggle_perf_overlay)
+        toolbar.addWidget(button_perf)
+
+        button_trace = QPushButton("Save Trace", self)
+        button_trace.clicked.connect(lambda: self.save_trace())
+        toolbar.addWidget(button_trace)
+
+        # Unexplored parts of the map are hidden under fog, the brush reveals them with the left mouse button and
+        # fogs them again with the right one
+        self.button_fog = QPushButton("Fog of War", self)
+        self.button_fog.setCheckable(True)
+        self.button_fog.toggled.connect(self.toggle_fog)
+        toolbar.addWidget(self.button_fog)
+
+        self.button_fog_brush = QPushButton("Fog Brush", self)
+        self.button_fog_brush.setCheckable(True)
+        self.button_fog_brush.setEnabled(False)
+        self.button_fog_brush.toggled.connect(self.toggle_fog_brush)
+        toolbar.addWidget(self.button_fog_brush)
+
+        # Overland distance between two markers clicked while the route tool is on, around costly terrain
+        self.button_route = QPushButton("Route", self)
+        self.button_route.setCheckable(True)
+        self.button_route.toggled.connect(self.toggle_route)
+        toolbar.addWidget(self.button_route)
+
+        button_scale = QPushButton("Map Scale", self)
+        button_scale.clicked.connect(lambda: self.set_map_scale())
+        toolbar.addWidget(button_scale)
+
+        # Player screens on the local network follow the markers of the shown map
+        self.button_share = QPushButton("Share Map", self)
+        self.button_share.setCheckable(True)
+        self.button_share.toggled.connect(self.toggle_sharing)
+        toolbar.addWidget(self.button_share)
+
+        button_join = QPushButton("Join Shared Map", self)
+        button_join.clicked.connect(lambda: self.join_shared_map())
+        toolbar.addWidget(button_join)
+
         # Create a slider
         slider_label = QLabel("Marker Size")
         slider_label.setContentsMargins(20, 0, 10, 0)
@@ -98,9 +245,33 @@ class MainWindow(QMainWindow):
         self.slider.setMinimum(10)
         self.slider.setMaximum(100)
         self.slider.setValue(25)
-        self.slider.valueChanged.connect(self.set_marker_size)
+        self.slider.valueChanged.connect(lambda: self.set_marker_size())
+        self.slider.sliderReleased.connect(self.settle_marker_size)
         toolbar.addWidget(self.slider)
 
+        # Search over marker names and descriptions
+        self.search_box = MarkerSearchBox(self.graphics_scene, self)
+        self.search_box.markerChosen.connect(self.focus_marker)
+        toolbar.addWidget(self.search_box)
+        MarkerItem.setSharedSlider(self.slider.value())
+
+        # Markers are drawn in high quality once the slider has not moved for a moment
+        self.marker_size_timer = QTimer(self)
+        self.marker_size_timer.setSingleShot(True)
+        self.marker_size_timer.setInterval(150)
+        self.marker_size_timer.timeout.connect(self.settle_marker_size)
+
+        # Map images are decoded on a worker thread, a preview is shown until the full resolution is ready
+        self.map_loader = MapImageLoader(self)
+        self.map_loader.previewReady.connect(self.show_map_preview)
+        self.map_loader.loaded.connect(self.show_full_map)
+        self.map_loader.failed.connect(self.map_load_failed)
+
+        self.button_cancel_load = QPushButton("Cancel Loading", self)
+        self.button_cancel_load.clicked.connect(self.cancel_map_load)
+        self.statusBar().addPermanentWidget(self.button_cancel_load)
+        self.button_cancel_load.hide()
+
         # Fill the main colors_layout
         main_layout.addWidget(left_panel)
         main_layout.addWidget(center_panel)
@@ -108,32 +279,313 @@ class MainWindow(QMainWindow):
         # Create and set the central widget
         self.setCentralWidget(main_panel)
 
-    def new_map(self, file_path=None):
+    def create_scene(self):
+        scene = MapScene()
+        scene.selectionChanged.connect(self.handleMarkerSelectionChanged)
+
+        # Every marker change made through the UI goes to the change journal
+        scene.markerAdded.connect(lambda marker: self.record_change('add', marker))
+        scene.markerEdited.connect(lambda marker: self.record_change('edit', marker))
+        scene.markerMoved.connect(lambda marker: self.record_change('move', marker))
+        scene.markerRemoved.connect(lambda marker: self.record_change('delete', marker))
+        scene.layersChanged.connect(self.save_layers)
+        # The minimap redraws its marker and fog overlay only when the scene's version changed
+        scene.changed.connect(lambda region: self.minimap.update())
+        return scene
+
+    def set_scene(self, scene):
+        self.graphics_scene = scene
+        self.graphics_view.setScene(scene)
+        self.marker_panel.setScene(scene)
+        self.search_box.setScene(scene)
+
+    def stash_map(self):
+        # Moves the shown map into the cache and leaves an empty scene behind
+        if self.picture_item is None:
+            return
+        # A map that is still loading is loaded again when it is shown next
+        self.map_loader.cancel()
+        self.button_cancel_load.hide()
+        self.marker_panel.clearMarker()
+        self.marker_info_panel.clearMarker()
+        self.graphics_scene.clearSelection()
+        self.graphics_scene.setRoute(None)
+        self.remember_map()
+
+        state = MapState(self.graphics_scene, self.picture_item, self.map_path, self.map_hash, self.project_path,
+                         self.journal)
+        state.transform = self.graphics_view.transform()
+        state.center = self.visible_scene_rect().center()
+        self.map_cache.put(state)
+
+        self.picture_item = None
+        self.journal = None
+        self.set_scene(self.create_scene())
+        self.minimap.setMap(self.graphics_scene, None, None)
+
+    def restore_map(self, state):
+        self.set_scene(state.scene)
+        self.picture_item = state.picture_item
+        self.map_path = state.map_path
+        self.map_hash = state.map_hash
+        self.project_path = state.project_path
+        self.journal = state.journal
+        self.minimap.setMap(self.graphics_scene, self.picture_item, self.map_path)
+
+        self.graphics_view.setSceneRect(self.picture_item.sceneBoundingRect())
+        self.show_view(state.transform, state.center)
+        if isinstance(self.picture_item, MapImageItem) and not self.picture_item.isFullResolution():
+            self.map_loader.load(self.map_path)
+            self.button_cancel_load.show()
+        self.update_fog_buttons()
+        self.share_map()
+
+    def show_view(self, transform, center):
+        self.graphics_view.setTransform(transform)
+        self.graphics_view.centerOn(center)
+        self.update_visible_area()
+
+    def open_map(self, path):
+        # Shows a project or a map image, straight from the cache when it was visited recently
+        self.stash_map()
+        state = self.map_cache.take(path)
+        if state is None and not path.endswith(".imap"):
+            # Markers placed on a bare image live in its autosave project
+            autosave_path = ChangeJournal.autosavePath(path)
+            state = self.map_cache.take(autosave_path)
+            if state is None and os.path.exists(autosave_path):
+                path = autosave_path
+        if state is not None:
+            self.restore_map(state)
+        elif path.endswith(".imap"):
+            self.load_data(path)
+        else:
+            self.new_map(path)
+        return self.picture_item is not None
+
+    def saved_project_path(self):
+        # The project the map was saved to, None while its edits only go to an autosave
+        if self.project_path and not os.path.abspath(self.project_path).startswith(
+                os.path.abspath(ChangeJournal.autosave_dir)):
+            return self.project_path
+        return None
+
+    def link_base(self):
+        # Links of a saved project are relative to its folder, so projects can be moved together
+        project_path = self.saved_project_path()
+        return os.path.dirname(os.path.abspath(project_path)) if project_path else None
+
+    def fill_recent_menu(self):
+        # Built when opened, newest first with the thumbnail of each map
+        self.recent_menu.clear()
+        entries = self.recent_maps.existing()
+        for entry in entries:
+            path = entry['path']
+            action = self.recent_menu.addAction(os.path.basename(path), lambda path=path: self.open_recent(path))
+            action.setToolTip(path)
+            thumbnail = self.recent_maps.thumbnail(path)
+            if thumbnail is not None:
+                action.setIcon(QIcon(QPixmap.fromImage(thumbnail)))
+        if not entries:
+            self.recent_menu.addAction("No Recent Maps").setEnabled(False)
+        self.recent_menu.setToolTipsVisible(True)
+
+    def remember_map(self):
+        # The map being left goes to the top of the recent list, with a thumbnail and the view it was left at
+        if self.picture_item is None or self.viewing():
+            return
+        rect = self.picture_item.boundingRect()
+        center = self.visible_scene_rect().center()
+        try:
+            self.recent_maps.remember(self.saved_project_path() or self.map_path, self.map_path,
+                                      (rect.width(), rect.height()), self.graphics_view.transform().m11(),
+                                      (center.x(), center.y()), self.minimap.image())
+        except OSError as error:
+            warnings.warn("Could not update the recent maps: " + str(error))
+
+    @timed("open_recent")
+    def open_recent(self, path):
+        entry = self.recent_maps.entry(path)
+        if entry is None or not os.path.exists(path):
+            self.statusBar().showMessage("Map not found: " + path)
+            return
+        self.map_stack.clear()
+        self.button_back.setEnabled(False)
+        transform = QTransform.fromScale(entry['scale'], entry['scale'])
+        center = QPointF(*entry['center'])
+        thumbnail = self.recent_maps.thumbnail(path)
+        if thumbnail is None or MapState.keyOf(None, path) in self.map_cache:
+            if self.open_map(path):
+                self.show_view(transform, center)
+            return
+
+        # The thumbnail is shown where the map was left right away, the project is read once it was painted and
+        # the image is decoded on the loader's thread as usual
+        self.stash_map()
+        preview = MapImageItem(QSize(*[math.ceil(side) for side in entry['size']]))
+        preview.setPixmap(QPixmap.fromImage(thumbnail))
+        self.graphics_scene.addItem(preview)
+        self.graphics_scene.setSceneRect(preview.boundingRect())
+        self.graphics_view.setSceneRect(preview.boundingRect())
+        self.minimap.setMap(self.graphics_scene, preview, entry['map_path'])
+        self.show_view(transform, center)
+        self.statusBar().showMessage("Loading " + os.path.basename(path) + "...")
+        QTimer.singleShot(0, lambda: self.finish_recent(path, transform, center, preview.pixmap))
+
+    def finish_recent(self, path, transform, center, thumbnail):
+        if not self.open_map(path):
+            self.statusBar().showMessage("Could not open " + path)
+            return
+        # Until the loader's preview arrives the map keeps showing the thumbnail
+        if isinstance(self.picture_item, MapImageItem) and self.picture_item.pixmap is None:
+            self.picture_item.setPixmap(thumbnail)
+            self.minimap.invalidateImage()
+        self.show_view(transform, center)
+
+    def choose_marker_link(self, marker):
+        file_path, _ = QFileDialog.getOpenFileName(self, "Link Map", "",
+                                                   "Maps (*.imap *.png *.jpg *.jpeg);;Map Projects (*.imap);;"
+                                                   "Image Files (*.png *.jpg *.jpeg)")
+        if file_path:
+            base = self.link_base()
+            marker.link = os.path.relpath(file_path, base) if base else os.path.abspath(file_path)
+            self.marker_panel.changed = True
+            self.marker_panel.updateLink()
+
+    def open_linked_map(self, marker):
+        if self.picture_item is None or not marker.link:
+            return
+        base = self.link_base()
+        path = os.path.join(base, marker.link) if base else marker.link
+        if not os.path.exists(path):
+            self.statusBar().showMessage("Linked map not found: " + path)
+            return
+
+        self.map_stack.append((self.project_path, self.map_path, self.graphics_view.transform(),
+                               self.visible_scene_rect().center()))
+        self.button_back.setEnabled(True)
+        if not self.open_map(path):
+            self.go_back()
+
+    def go_back(self):
+        if not self.map_stack:
+            return
+        project_path, map_path, transform, center = self.map_stack.pop()
+        self.button_back.setEnabled(bool(self.map_stack))
+        if self.open_map(project_path or map_path):
+            self.show_view(transform, center)
+
+    @timed("new_map")
+    def new_map(self, file_path=None, journal=True):
         if file_path is None or file_path is False:
             # Open a file dialog to select an image file
             file_dialog = QFileDialog()
             file_path, _ = file_dialog.getOpenFileName(self, "Open Image", "", "Image Files (*.png *.jpg *.jpeg)")
+            # A map opened by hand starts a new trail of linked maps
+            if file_path:
+                self.map_stack.clear()
+                self.button_back.setEnabled(False)
 
         # Check if a file was selected
         if file_path:
-            # Clear the existing scene
+            # Only the header is read here, the dimensions are enough to lay out the scene and the markers.
+            # An image that cannot be read leaves the shown map as it is
+            size = QImageReader(file_path).size()
+            if not size.isValid():
+                QMessageBox.warning(self, "Open Map", "Could not read the map image: " + file_path)
+                return
+
+            # Markers placed on the image before are in its autosave project
+            autosave_path = ChangeJournal.autosavePath(file_path)
+            if journal and os.path.exists(autosave_path):
+                self.load_data(autosave_path)
+                return
+
+            # The shown map goes to the cache, an older copy of the new map is dropped
+            self.stash_map()
+            stale = self.map_cache.take(MapState.keyOf(None, file_path))
+            if stale is not None:
+                stale.release()
+
+            # Clear the existing scene, the panels let go of its markers first
+            self.marker_panel.clearMarker()
+            self.marker_info_panel.clearMarker()
             self.graphics_scene.clear()
-
-            # Load the image file as QPixmap
-            pixmap = QPixmap(file_path)
-
-            # Create a QGraphicsPixmapItem with the loaded pixmap
-            self.picture_item = self.graphics_scene.addPixmap(pixmap)
+            self.picture_item = None
+
+            self.map_path = file_path
+            self.map_hash = None
+            self.project_path = None
+
+            pyramid = TilePyramid(file_path) if TilePyramid.needsTiling(file_path) else None
+            if pyramid is not None and pyramid.isBuilt():
+                # Very large maps are cut into a tile pyramid cached on disk and only visible tiles are loaded
+                self.picture_item = TiledMapItem(pyramid)
+            else:
+                # Decoding, and cutting the tiles of very large maps, happens on a worker thread
+                self.picture_item = MapImageItem(size)
+                self.map_loader.load(file_path)
+                self.statusBar().showMessage("Loading " + os.path.basename(file_path) + "...")
+                self.button_cancel_load.show()
+            self.graphics_scene.addItem(self.picture_item)
+            self.minimap.setMap(self.graphics_scene, self.picture_item, self.map_path)
 
             # Set the scene rectangle to match the size of the pixmap item
             self.graphics_scene.setSceneRect(self.picture_item.boundingRect())
+            self.graphics_scene.setMapRect(self.picture_item.boundingRect())
 
             self.reset_image()
 
+            if journal:
+                # Edits of a map that was never saved are autosaved into a project of its own, a journal left
+                # without a project by a session that ended early is replayed first
+                records, replayed = ChangeJournal.replay(autosave_path, [])
+                self.start_journal(autosave_path, records)
+                if replayed:
+                    self.journal.compactNow()
+                    self.graphics_scene.loadRecords(records)
+                    self.update_visible_area()
+            self.update_fog_buttons()
+            self.share_map()
+
+    def show_map_preview(self, image):
+        if isinstance(self.picture_item, MapImageItem):
+            self.picture_item.setPixmap(QPixmap.fromImage(image))
+            self.minimap.invalidateImage()
+
+    def show_full_map(self, result):
+        self.button_cancel_load.hide()
+        self.statusBar().clearMessage()
+        if isinstance(result, TilePyramid):
+            # Same size and position as the item it replaces, so markers and the view stay where they are
+            self.graphics_scene.removeItem(self.picture_item)
+            self.picture_item = TiledMapItem(result)
+            self.graphics_scene.addItem(self.picture_item)
+            self.minimap.setMap(self.graphics_scene, self.picture_item, self.map_path)
+            self.minimap.invalidateImage()
+            self.update_visible_area()
+        elif isinstance(self.picture_item, MapImageItem):
+            self.picture_item.setPixmap(QPixmap.fromImage(result))
+            self.minimap.invalidateImage()
+
+    def map_load_failed(self, message):
+        self.button_cancel_load.hide()
+        self.statusBar().showMessage("Could not load the map image")
+        warnings.warn(message)
+
+    def cancel_map_load(self):
+        # The map stays on its preview, markers can still be placed and the project saved
+        self.map_loader.cancel()
+        self.button_cancel_load.hide()
+        self.statusBar().showMessage("Loading cancelled, the map is shown at preview quality")
+
+    @timed("zoom_image")
     def zoom_image(self, event):
         # Get the position of the mouse cursor in scene coordinates
         mouse_pos = self.graphics_view.mapToScene(event.position().toPoint())
 
+        self.render_quality.interact()
+
         # Adjust zoom level based on the wheel movement
         zoom_factor = 1.1 if event.angleDelta().y() > 0 else 0.9
 
@@ -149,27 +601,378 @@ class MainWindow(QMainWindow):
         self.graphics_view.horizontalScrollBar().setValue(self.graphics_view.horizontalScrollBar().value() + delta.x())
         self.graphics_view.verticalScrollBar().setValue(self.graphics_view.verticalScrollBar().value() + delta.y())
 
+        self.update_visible_area()
+
     def reset_image(self):
         # Reset the zoom level
         self.graphics_view.resetTransform()
 
         # Reset the position of the picture to the center of the scene
-        self.graphics_view.setSceneRect(self.graphics_scene.itemsBoundingRect())
-        self.graphics_view.centerOn(0, 0)
-
-        # Rescale the picture to fit within the view
-        scene_rect = self.graphics_scene.itemsBoundingRect()
-        if not scene_rect.isNull():
-            self.graphics_view.fitInView(scene_rect, Qt.AspectRatioMode.KeepAspectRatio)
-
+        if self.picture_item is not None:
+            scene_rect = self.picture_item.sceneBoundingRect()
+            self.graphics_view.setSceneRect(scene_rect)
+            self.graphics_view.centerOn(0, 0)
+
+            # Rescale the picture to fit within the view
+            if not scene_rect.isNull():
+                self.graphics_view.fitInView(scene_rect, Qt.AspectRatioMode.KeepAspectRatio)
+
+        self.update_visible_area()
+
+    def paint_view(self, event):
+        with perf_trace.section("paint"):
+            QGraphicsView.paintEvent(self.graphics_view, event)
+
+    def toggle_perf_overlay(self, checked):
+        if self.perf_overlay is None:
+            if not checked:
+                return
+            from perfOverlay import PerfOverlay
+            self.perf_overlay = PerfOverlay(self)
+        self.perf_overlay.setActive(checked)
+
+    def save_trace(self, filename=None):
+
+        # Everything recorded since tracing was switched on, in the Chrome trace event format
+        if not filename:
+            filename, _ = QFileDialog.getSaveFileName(self, "Save Trace", "trace.json", "Trace Files (*.json)")
+            if not filename:
+                return
+        perf_trace.dump(filename)
+
+    def export_image(self, filename=None, scale=None, tiles=False):
+        # Renders the map with its markers at any scale, in parallel processes and without holding the image in memory
+        if self.picture_item is None:
+            return
+        if scale is None:
+            scale, accepted = QInputDialog.getDouble(self, "Export Image", "Scale of the map image:", 1.0, 0.05, 16.0,
+                                                     2)
+            if not accepted:
+                return
+        if not filename:
+            filename, selected = QFileDialog.getSaveFileName(self, "Export Image", "map.png",
+                                                             "PNG Image (*.png);;Tile Directory (*)")
+            if not filename:
+                return
+            tiles = selected.startswith("Tile")
+            if not tiles and not filename.lower().endswith(".png"):
+                filename += ".png"
+
+        # Only loaded when an image is exported, with the worker processes it starts
+        from mapExport import MapExport
+
+        export = MapExport(self.graphics_scene, self.map_path, scale)
+        progress_dialog = QProgressDialog("Exporting %d x %d image..." % (export.width, export.height), "Cancel", 0,
+                                          export.taskCount(tiles), self)
+        progress_dialog.setWindowModality(Qt.WindowModal)
+        progress_dialog.setMinimumDuration(0)
+
+        def progress(done):
+            progress_dialog.setValue(done)
+            QApplication.processEvents()
+            export.cancelled = progress_dialog.wasCanceled()
+
+        try:
+            export.run(filename, tiles, progress)
+        except InterruptedError:
+            pass
+        except (OSError, ValueError) as error:
+            QMessageBox.warning(self, "Export Image", "Could not export the image: " + str(error))
+        finally:
+            progress_dialog.close()
+
+    def visible_scene_rect(self):
+        return self.graphics_view.mapToScene(self.graphics_view.viewport().rect()).boundingRect()
+
+    def update_visible_area(self):
+        scale = self.graphics_view.transform().m11()
+        visible_rect = self.visible_scene_rect()
+        # Let a tiled map switch to the pyramid level of the current zoom and load the tiles in view
+        if isinstance(self.picture_item, TiledMapItem):
+            self.picture_item.setViewScale(scale, self.picture_item.mapRectFromScene(visible_rect),
+                                           self.render_quality.interacting)
+        # Markers only have items while they are in view
+        self.graphics_scene.setView(scale, visible_rect)
+        self.minimap.setViewRect(visible_rect)
+
+    def center_view(self, point):
+        self.render_quality.interact()
+        self.graphics_view.centerOn(point)
+        self.update_visible_area()
+
+    def fill_layers_menu(self):
+        # Built when opened, the tags are the ones used on the shown map
+        self.layers_menu.clear()
+        layers = self.graphics_scene.layers
+        for category in MarkerItem.PathsByCategory:
+            action = self.layers_menu.addAction(category)
+            action.setCheckable(True)
+            action.setChecked(layers.isCategoryVisible(category))
+            action.toggled.connect(lambda checked, category=category:
+                                   self.graphics_scene.setCategoryVisible(category, checked))
+        tags = self.graphics_scene.store.tagNames()
+        if tags:
+            self.layers_menu.addSeparator()
+        for tag in tags:
+            action = self.layers_menu.addAction("#" + tag)
+            action.setCheckable(True)
+            action.setChecked(tag not in layers.hidden_tags)
+            action.toggled.connect(lambda checked, tag=tag: self.graphics_scene.setTagVisible(tag, checked))
+        self.layers_menu.addSeparator()
+        self.layers_menu.addAction("Only Markers Tagged...", self.filter_layers_by_tags)
+        self.layers_menu.addAction("Show All", lambda: self.graphics_scene.setLayerFilter())
+
+    def filter_layers_by_tags(self):
+        # Compound filter: the hidden categories and tags stay, only markers with one of the tags are shown
+        layers = self.graphics_scene.layers
+        text, accepted = QInputDialog.getText(self, "Only Markers Tagged", "Tags, comma separated:",
+                                              text=", ".join(sorted(layers.required_tags)))
+        if accepted:
+            state = layers.state()
+            self.graphics_scene.setLayerFilter(state['hidden_categories'], state['hidden_tags'],
+                                               splitTags(joinTags(text)))
+
+    def save_layers(self):
+        if self.journal is not None:
+            self.journal.setSection('layers', self.graphics_scene.layers.state())
+
+    def update_fog_buttons(self):
+        # The buttons follow the fog of the shown map
+        has_fog = self.graphics_scene.fog is not None
+        self.button_fog.blockSignals(True)
+        self.button_fog.setChecked(has_fog)
+        self.button_fog.blockSignals(False)
+        if not has_fog:
+            self.button_fog_brush.setChecked(False)
+        self.button_fog_brush.setEnabled(has_fog)
+
+    def toggle_fog(self, checked):
+        if self.picture_item is None or self.viewing():
+            self.button_fog.setChecked(False)
+            return
+        if checked and self.graphics_scene.fog is None:
+            # A new fog covers the whole map
+            rect = self.picture_item.boundingRect()
+            self.graphics_scene.setFog(FogMask(math.ceil(rect.width()), math.ceil(rect.height())), self.fog_opacity)
+        elif not checked:
+            self.graphics_scene.setFog(None)
+        self.update_fog_buttons()
+        self.save_fog()
+
+    def toggle_fog_brush(self, checked):
+        self.graphics_view.setDragMode(QGraphicsView.NoDrag if checked else QGraphicsView.ScrollHandDrag)
+
+    def save_fog(self):
+        # Only the tiles painted since the last save are compressed again
+        if self.journal is not None:
+            fog = self.graphics_scene.fog
+            self.journal.setChunk(FOG_TAG, fog.toBytes() if fog is not None else None)
+        if self.sync_server is not None and self.sync_server.isListening():
+            self.sync_server.sendFog()
+
+    def toggle_route(self, checked):
+        self.route_start = None
+        self.graphics_scene.setRoute(None)
+        if not checked:
+            return
+        # NumPy is only needed by the route tool, it is imported once the first route is measured
+        if importlib.util.find_spec("numpy") is None:
+            QMessageBox.warning(self, "Route", "Measuring routes needs NumPy, install it with: pip install numpy")
+            self.button_route.setChecked(False)
+            return
+        self.statusBar().showMessage("Click the marker the route starts from")
+
+    def set_map_scale(self, text=None):
+        # Distances are shown in a unit given as the length of one map pixel, like "0.05 mi"
+        if text is None:
+            units = self.graphics_scene.map_units
+            text, accepted = QInputDialog.getText(self, "Map Scale", "Length of one map pixel, like 0.05 mi:",
+                                                  text="%g %s" % (units['per_pixel'], units['unit']))
+            if not accepted:
+                return
+        parts = text.split(None, 1)
+        try:
+            self.graphics_scene.setMapUnits(parts[1].strip() if len(parts) > 1 else "px", float(parts[0]))
+        except (IndexError, ValueError) as error:
+            QMessageBox.warning(self, "Map Scale", "Could not read the scale %r: %s" % (text, error))
+            return
+        if self.journal is not None:
+            self.journal.setSection('units', self.graphics_scene.map_units)
+
+    def terrain_grid(self):
+        # Built from the map image once and cached on disk by its content, kept in memory while the map is shown
+        import routePlanner
+        if self.terrain is None or self.terrain[0] != self.map_path:
+            image_hash = self.map_hash or projectFile.fileHash(self.map_path)
+            QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+            try:
+                self.terrain = (self.map_path, routePlanner.TerrainGrid.load(self.map_path, image_hash))
+            finally:
+                QApplication.restoreOverrideCursor()
+        return self.terrain[1]
+
+    @timed("measure_route")
+    def measure_route(self, marker):
+        import routePlanner
+        x, y = self.graphics_scene.store.position(marker.row)
+        point = QPointF(x, y)
+        if self.route_start is None or self.route_start[0] is not self.graphics_scene:
+            self.route_start = (self.graphics_scene, point, marker.name or "unnamed marker")
+            self.statusBar().showMessage("Route from %s, click the marker it goes to" % self.route_start[2])
+            return
+        _, start, start_name = self.route_start
+        self.route_start = None
+        try:
+            route = self.terrain_grid().route(start, point)
+        except (IOError, ValueError) as error:
+            QMessageBox.warning(self, "Route", str(error))
+            return
+        scene = self.graphics_scene
+        scene.setRoute(routePlanner.RouteItem(route, scene.formatDistance(route.length)))
+        self.statusBar().showMessage("%s to %s: %s overland, takes as long as %s over open ground" %
+                                     (start_name, marker.name or "unnamed marker", scene.formatDistance(route.length),
+                                      scene.formatDistance(route.cost)))
+
+    def view_mouse_press(self, event):
+        if self.button_route.isChecked() and event.button() == Qt.MouseButton.LeftButton:
+            item = self.graphics_view.itemAt(event.position().toPoint())
+            if isinstance(item, MarkerItem):
+                self.measure_route(item)
+                return
+        if self.button_fog_brush.isChecked() and self.graphics_scene.fog is not None:
+            self.fog_stroke = self.graphics_view.mapToScene(event.position().toPoint())
+            self.fog_reveal = event.button() != Qt.MouseButton.RightButton
+            self.brush_fog(self.fog_stroke)
+            return
+        QGraphicsView.mousePressEvent(self.graphics_view, event)
+
+    def view_mouse_move(self, event):
+        if self.fog_stroke is not None:
+            self.brush_fog(self.graphics_view.mapToScene(event.position().toPoint()))
+            return
+        QGraphicsView.mouseMoveEvent(self.graphics_view, event)
+
+    def view_mouse_release(self, event):
+        if self.fog_stroke is not None:
+            self.fog_stroke = None
+            # Markers that were revealed or fogged are shown or hidden once per stroke
+            self.graphics_scene.updateView()
+            self.save_fog()
+            return
+        QGraphicsView.mouseReleaseEvent(self.graphics_view, event)
+
+    def brush_fog(self, point):
+        # The brush keeps its size on screen at any zoom
+        radius = self.fog_brush_pixels / max(self.graphics_view.transform().m11(), 1e-6)
+        self.graphics_scene.brushFog(self.fog_stroke, point, radius, self.fog_reveal)
+        self.fog_stroke = point
+
+    def share_map(self):
+        # Viewers are sent the new map once the event loop is back, after its markers were loaded
+        if self.sync_server is not None and self.sync_server.isListening():
+            self.sync_server.setMap(self.graphics_scene, self.map_path)
+
+    def toggle_sharing(self, checked):
+        if not checked:
+            if self.sync_server is not None:
+                self.sync_server.close()
+            self.statusBar().showMessage("Map sharing stopped")
+            return
+        from liveSync import DEFAULT_HOST, DEFAULT_PORT, SyncServer
+        if self.sync_server is None:
+            self.sync_server = SyncServer(self)
+            self.sync_server.clientsChanged.connect(
+                lambda count: self.statusBar().showMessage("%d viewer(s) connected" % count))
+        # Other machines can only connect when IMAP_SYNC_HOST names an address to listen on, like 0.0.0.0
+        host = os.environ.get("IMAP_SYNC_HOST", DEFAULT_HOST)
+        try:
+            port = self.sync_server.listen(int(os.environ.get("IMAP_SYNC_PORT", DEFAULT_PORT)), host)
+        except (IOError, ValueError) as error:
+            QMessageBox.warning(self, "Share Map", str(error))
+            self.button_share.setChecked(False)
+            return
+        self.statusBar().showMessage("Sharing the map on %s port %d" % (host, port))
+        if self.picture_item is not None:
+            self.share_map()
+
+    def join_shared_map(self, address=None):
+        from liveSync import DEFAULT_PORT, SyncClient
+        if not address:
+            address, accepted = QInputDialog.getText(self, "Join Shared Map", "Host and port:",
+                                                     text="localhost:%d" % DEFAULT_PORT)
+            if not accepted or not address:
+                return
+        host, _, port = address.partition(":")
+        client = SyncClient(self)
+        try:
+            client.connectToHost(host, int(port or DEFAULT_PORT))
+        except (IOError, ValueError) as error:
+            QMessageBox.warning(self, "Join Shared Map", str(error))
+            client.deleteLater()
+            return
+        self.leave_shared_map()
+        self.sync_client = client
+        client.mapReceived.connect(self.show_shared_map)
+        client.deltasReceived.connect(self.apply_shared_deltas)
+        client.fogReceived.connect(self.apply_shared_fog)
+        client.disconnected.connect(self.leave_shared_map)
+        self.statusBar().showMessage("Viewing the map shared by " + host)
+
+    def leave_shared_map(self):
+        if self.sync_client is not None:
+            self.sync_client.disconnected.disconnect(self.leave_shared_map)
+            self.sync_client.close()
+            self.sync_client.deleteLater()
+            self.sync_client = None
+            self.shared_scene = None
+            self.statusBar().showMessage("Left the shared map")
+
+    def viewing(self):
+        # Viewers only look at the shared map, markers are edited on the host
+        return self.sync_client is not None
+
+    def show_shared_map(self, image_path, records):
+        self.map_stack.clear()
+        self.button_back.setEnabled(False)
+        self.new_map(image_path)
+        if self.picture_item is None:
+            return
+        # Nothing is edited here, so there is nothing to journal
+        if self.journal is not None:
+            self.journal.stop()
+            self.journal = None
+        self.shared_scene = self.graphics_scene
+        self.graphics_scene.loadRecords(records)
+        self.update_visible_area()
+
+    def apply_shared_deltas(self, deltas):
+        if self.graphics_scene is self.shared_scene:
+            self.graphics_scene.applyDeltas(deltas)
+
+    def apply_shared_fog(self, data):
+        if self.graphics_scene is not self.shared_scene:
+            return
+        try:
+            self.graphics_scene.setFog(FogMask.fromBytes(data) if data else None)
+        except ValueError as error:
+            warnings.warn("Could not read the shared fog of war: " + str(error))
+
+    def left_panel_empty(self):
+        return self.marker_panel.isHidden() and self.marker_info_panel.isHidden()
+
+    @timed("place_new_marker")
     def place_new_marker(self, event):
+        if self.viewing() or self.button_fog_brush.isChecked():
+            return
         # Check if a picture has been loaded
-        if self.picture_item is not None and (not self.marker_editing_flag or self.left_layout.isEmpty()):
+        # Double clicking a marker that links to a map opens that map
+        item = self.graphics_view.itemAt(event.position().toPoint())
+        if isinstance(item, MarkerItem) and item.link:
+            self.open_linked_map(item)
+            return
 
-            while self.left_layout.count():
-                widget = self.left_layout.takeAt(0).widget()
-                if widget is not None:
-                    widget.deleteLater()
+        if self.picture_item is not None and (not self.marker_editing_flag or self.left_panel_empty()):
+            self.marker_info_panel.clearMarker()
 
             # Get the cursor position in relation to the graphics view
             cursor_pos = event.position().toPoint()
@@ -180,148 +983,246 @@ class MainWindow(QMainWindow):
             # Convert the scene coordinates to the coordinates of the picture item
             marker_pos = self.picture_item.mapFromScene(scene_pos)
 
-            # Create the indicator marker using MarkerItem
-            new_marker = MarkerItem(marker_pos)
-            new_marker.setSlider(self.slider.value())
-
-            self.graphics_scene.addItem(new_marker)
+            # Create the indicator marker, its item stays while the panel is open
+            new_marker = self.graphics_scene.createMarker(marker_pos)
 
-            self.left_layout.addWidget(MarkerPanel(new_marker, self.graphics_scene))
+            self.show_marker_panel(new_marker)
             self.marker_editing_flag = True
 
     def show_existing_marker(self, marker):
 
-        if self.picture_item is not None and (not self.marker_editing_flag or self.left_layout.isEmpty()):
+        if self.picture_item is not None and (not self.marker_editing_flag or self.left_panel_empty()):
             self.marker_editing_flag = False
-
-            while self.left_layout.count():
-                widget = self.left_layout.takeAt(0).widget()
-                if widget is not None:
-                    widget.deleteLater()
-
-            marker_info_panel = QWidget()
-            layout = QVBoxLayout()
-            layout.setAlignment(Qt.AlignTop)
-
-            # Label for marker name
-            name_label = QLabel(marker.name)
-            layout.addWidget(name_label)
-
-            # Widget for marker description
-            text_edit = QTextEdit(marker.desc)
-            text_edit.setReadOnly(True)  # Make the text area read-only
-            layout.addWidget(text_edit)
-
-            # Button to edit marker
-            edit_button = QPushButton("Edit")
-
-            def handleEditButton():
-                marker_info_panel.deleteLater()
-                self.left_layout.addWidget(MarkerPanel(marker, self.graphics_scene))
-
-            edit_button.clicked.connect(handleEditButton)
-            layout.addWidget(edit_button)
-
-            # Button to close
-            close_button = QPushButton("Close")
-
-            def handleCloseButton():
-                marker_info_panel.deleteLater()
-                self.graphics_scene.clearSelection()
-
-            close_button.clicked.connect(handleCloseButton)
-            layout.addWidget(close_button)
-
-            marker_info_panel.setLayout(layout)
-
-            self.left_layout.addWidget(marker_info_panel)
+            self.marker_panel.clearMarker()
+            self.marker_info_panel.setMarker(marker)
+
+    def show_marker_panel(self, marker):
+        if self.viewing():
+            return
+        self.marker_info_panel.clearMarker()
+        self.marker_panel.setMarker(marker)
+
+    def close_marker_info(self):
+        self.marker_info_panel.clearMarker()
+        self.graphics_scene.clearSelection()
+
+    def focus_marker(self, row):
+        if self.picture_item is None:
+            return
+        # Zoom in to full resolution unless the view is already closer, then center on the marker
+        scale = self.graphics_view.transform().m11()
+        if scale < 1:
+            self.graphics_view.scale(1 / scale, 1 / scale)
+        x, y = self.graphics_scene.store.position(row)
+        self.graphics_view.centerOn(x, y)
+        self.update_visible_area()
+
+        # Selecting the marker opens its info panel
+        marker = self.graphics_scene.markerItem(row)
+        self.graphics_scene.clearSelection()
+        marker.setSelected(True)
 
     def handleMarkerSelectionChanged(self):
-        if len(self.graphics_scene.items()) > 0:
+        if self.graphics_scene.markerCount() > 0:
             selected_items = self.graphics_scene.selectedItems()
             if len(selected_items) == 1 and isinstance(selected_items[0], MarkerItem):
                 marker = selected_items[0]
                 self.show_existing_marker(marker)
 
+    @timed("set_marker_size")
     def set_marker_size(self):
-        if self.picture_item is not None:
-            items = self.graphics_scene.items()
-            for marker in items:
-                if isinstance(marker, MarkerItem):
-                    marker.setSlider(self.slider.value())
-
-    # Save data to a file
-    def save_file(self, filename):
-        now = datetime.datetime.now()
-        filename = "data/" + now.strftime("%Y-%m-%d-%H-%M") + filename
-
-        # checking if the directory exist
-        if not os.path.exists("data/"):
-            os.makedirs("data/")
-
-        items = self.graphics_scene.items()
-        data = []
-        for item in items:
-            if isinstance(item, MarkerItem):
-                item_dict = {
-                    'type': 'Marker',
-                    'pos': item.pos,
-                    'typeInd': item.category,
-                    'imgInd': item.image_index,
-                    'name': item.name,
-                    'desc': item.desc,
-                    'showing': item.showing,
-                    'color': item.color
-                }
-                # print(item_dict)
-                data.append(item_dict)
-            elif isinstance(item, QGraphicsPixmapItem):
-                item_dict = {
-                    'type': 'Image',
-                    'imgPath': "data/" + now.strftime("%Y-%m-%d-%H-%M") + '.png'
-                }
-                item.pixmap().save("data/" + now.strftime("%Y-%m-%d-%H-%M") + ".png")
-                # print(item_dict)
-                data.append(item_dict)
-
-        # Save the item data to a file
-        with open(filename, 'wb') as file:
-            pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
-            # print("Data saved successfully.")
+        # Marker size is applied at paint time, so a slider step only repaints the view with a cheap preview
+        MarkerItem.setSharedSlider(self.slider.value(), preview=True)
+        self.graphics_view.viewport().update()
+        self.marker_size_timer.start()
+
+    def settle_marker_size(self):
+        self.marker_size_timer.stop()
+        if MarkerItem.preview:
+            MarkerItem.setSharedSlider(self.slider.value())
+            # Labels are placed again for the offset of the new size
+            self.update_visible_area()
+            self.graphics_view.viewport().update()
+
+    def start_journal(self, project_path, records, chunks=None, document=None):
+        # The previous journal finishes writing on its own thread
+        if self.journal is not None:
+            self.journal.stop()
+        self.journal = ChangeJournal(project_path, self.map_path, self.map_hash, records, document, chunks)
+
+    def record_change(self, op, marker):
+        if self.journal is not None:
+            self.journal.record(op, marker)
+
+    # Save the map project to a file
+    @timed("save_file")
+    def save_file(self, filename=None):
+        if self.picture_item is None or self.journal is None:
+            return
+
+        if not filename:
+            filename = self.project_path
+        if not filename:
+            # Ask where to create the project on the first save
+            file_dialog = QFileDialog()
+            filename, _ = file_dialog.getSaveFileName(self, "Save Map", "", "Map Projects (*.imap)")
+            if not filename:
+                return
+            if not filename.endswith(".imap"):
+                filename += ".imap"
+
+        if filename != self.journal.project_path:
+            fog = self.graphics_scene.fog
+            self.start_journal(filename, self.graphics_scene.markerRecords(),
+                               {FOG_TAG: fog.toBytes()} if fog is not None else None,
+                               {'layers': self.graphics_scene.layers.state(),
+                                'units': self.graphics_scene.map_units})
+        self.project_path = filename
+
+        # The project is written by the journal thread, the map image is stored once and later saves
+        # of the same project only append the markers
+        self.journal.compactNow()
 
     # Load data from a file
-    def load_data(self):
+    @timed("load_data")
+    def load_data(self, file_path=None):
 
-        # Open a file dialog to select the data file
-        file_dialog = QFileDialog()
-        file_path, _ = file_dialog.getOpenFileName(self, "Open Data File", "", "Data Files (*.dat *.pickle)")
+        if file_path is None or file_path is False:
+            # Open a file dialog to select the data file
+            file_dialog = QFileDialog()
+            file_path, _ = file_dialog.getOpenFileName(self, "Open Data File", "",
+                                                       "Map Projects (*.imap);;Legacy Data Files (*.dat *.pickle)")
+            if file_path:
+                self.map_stack.clear()
+                self.button_back.setEnabled(False)
 
         # Check if a file was selected
         if file_path:
-            # Clear the existing scene
-            self.graphics_scene.clear()
-
-            # Read the item data from the text file
-            with open(file_path, 'rb') as file:
-                data = pickle.load(file)
-
-            # Create and add the items to the graphics scene
-            for item_dict in reversed(data):
-                if item_dict['type'] == 'Marker':
-                    # Create the MarkerItem with the saved data
-                    marker = MarkerItem(item_dict['pos'], item_dict['typeInd'], item_dict['imgInd'], item_dict['name'],
-                                        item_dict['showing'], item_dict['desc'], QColor(item_dict['color']))
-                    # print(marker)
-                    marker.setSlider(self.slider.value())
-                    self.graphics_scene.addItem(marker)
-                elif item_dict['type'] == 'Image':
-                    # print("img")
-                    self.new_map(item_dict['imgPath'])
-
-            # print("Data loaded successfully.")
+            if self.picture_item is not None and MapState.keyOf(self.project_path, self.map_path) == \
+                    MapState.keyOf(None, file_path):
+                return
+            # A project visited recently is still in memory
+            state = self.map_cache.take(file_path)
+            if state is not None:
+                self.stash_map()
+                self.restore_map(state)
+                return
+
+            # The file is read before the shown map is left, so a broken one leaves it in place
+            try:
+                if file_path.endswith(".imap"):
+                    project = projectFile.loadProject(file_path)
+                else:
+                    project = projectFile.loadLegacyData(file_path)
+                if not QImageReader(project['image_path']).size().isValid():
+                    raise IOError("Could not read the map image: " + project['image_path'])
+            except (OSError, ValueError) as error:
+                QMessageBox.warning(self, "Open Map", "Could not open %s: %s" % (file_path, error))
+                return
+            self.stash_map()
+
+            # Clears the scene and starts loading the map image, the markers are placed right away
+            self.new_map(project['image_path'], journal=False)
+            if self.picture_item is None:
+                return
+            self.map_hash = project['image_hash']
+
+            records = project['document']['markers']
+            chunks = project['chunks']
+            # Sections other than the markers, like the shown layers, are kept by the journal
+            document = {key: value for key, value in project['document'].items() if key not in ('markers', 'version')}
+            replayed = 0
+            if file_path.endswith(".imap"):
+                # Recover the edits of a session that ended before they were folded into the project
+                records, replayed = ChangeJournal.replay(file_path, records)
+                self.project_path = file_path
+                self.start_journal(file_path, records, chunks, document)
+            else:
+                # Legacy files are converted to a project on the next save, until then they are autosaved apart
+                # from the markers placed on the bare image
+                self.start_journal(ChangeJournal.autosavePath(file_path), records, chunks, document)
+            if replayed:
+                self.journal.compactNow()
+
+            if 'layers' in document:
+                self.graphics_scene.setLayerState(document['layers'])
+            if 'units' in document:
+                self.graphics_scene.map_units = dict(document['units'])
+            if FOG_TAG in chunks:
+                try:
+                    self.graphics_scene.setFog(FogMask.fromBytes(chunks[FOG_TAG]), self.fog_opacity)
+                except ValueError as error:
+                    warnings.warn("Could not read the fog of war: " + str(error))
+                self.update_fog_buttons()
+
+            # Markers go into the scene's store, items are only created for the ones in view
+            self.graphics_scene.loadRecords(records)
+            self.update_visible_area()
+
+    def closeEvent(self, event):
+        self.remember_map()
+        self.map_loader.cancel()
+        # Write out the remaining edits before the process ends
+        if self.journal is not None:
+            self.journal.close()
+        self.map_cache.clear()
+        if self.sync_server is not None:
+            self.sync_server.close()
+        self.leave_shared_map()
+        if os.environ.get("IMAP_TRACE"):
+            self.save_trace(os.environ["IMAP_TRACE"])
+        super().closeEvent(event)
+
+
+def runCommandLine(arguments):
+    # python main.py import PROJECT INPUT [--image IMAGE] | python main.py export PROJECT OUTPUT
+    # Works without a window or a display, markers are streamed in batches
+    import argparse
+    import markerTransfer
+
+    parser = argparse.ArgumentParser(prog="main.py", description="Import and export markers of map projects")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importing = commands.add_parser("import", help="add markers from a CSV, JSON, JSON lines or GeoJSON file")
+    importing.add_argument("project", help="project to add the markers to, created when --image is given")
+    importing.add_argument("input", help="marker file")
+    importing.add_argument("--image", help="map image of a new project, or a new image for an existing one")
+    importing.add_argument("--format", choices=markerTransfer.FORMATS, help="format of the input, by default "
+                                                                            "taken from the file extension")
+    importing.add_argument("--replace", action="store_true", help="drop the markers already in the project")
+    importing.add_argument("--batch-size", type=int, default=10000, help="rows read between progress reports")
+    importing.add_argument("--strict", action="store_true", help="stop at the first invalid row instead of "
+                                                                 "skipping it")
+
+    exporting = commands.add_parser("export", help="write the markers of a project to a file")
+    exporting.add_argument("project", help="project to read")
+    exporting.add_argument("output", help="marker file to write")
+    exporting.add_argument("--format", choices=markerTransfer.FORMATS, help="format of the output, by default "
+                                                                            "taken from the file extension")
+    options = parser.parse_args(arguments)
+
+    try:
+        if options.command == "import":
+            imported, skipped = markerTransfer.importMarkers(options.project, options.input, options.image,
+                                                             options.format, options.replace, options.batch_size,
+                                                             options.strict,
+                                                             report=lambda text: print(text, file=sys.stderr))
+            print("Imported %d markers into %s, skipped %d" % (imported, options.project, skipped))
+        else:
+            count = markerTransfer.exportMarkers(options.project, options.output, options.format)
+            print("Exported %d markers to %s" % (count, options.output))
+    except (OSError, ValueError) as error:
+        print("Error: " + str(error), file=sys.stderr)
+        return 1
+    return 0
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ("import", "export", "-h", "--help"):
+        sys.exit(runCommandLine(sys.argv[1:]))
+
+    # IMAP_TRACE=trace.json records the whole session and writes the trace on exit
+    perf_trace.setEnabled(bool(os.environ.get("IMAP_TRACE")))
     app = QApplication([])
     window = MainWindow()
     window.show()
@@ -0,0 +1,93 @@
+import os
+from collections import OrderedDict
+
+from imageLoader import MapImageItem
+from tilePyramid import TiledMapItem
+
+
+class MapState:
+    # Everything a map needs to be shown again without reloading: its scene with markers, the map item, the journal
+    # of its project and where the view was
+    marker_bytes = 120
+    item_bytes = 2048
+
+    def __init__(self, scene, picture_item, map_path, map_hash, project_path, journal):
+        self.scene = scene
+        self.picture_item = picture_item
+        self.map_path = map_path
+        self.map_hash = map_hash
+        self.project_path = project_path
+        self.journal = journal
+        self.transform = None
+        self.center = None
+
+    @staticmethod
+    def keyOf(project_path, map_path):
+        return os.path.abspath(project_path or map_path)
+
+    def key(self):
+        return self.keyOf(self.project_path, self.map_path)
+
+    def memoryBytes(self):
+        # Estimate of what dropping the map frees: decoded image pixels, marker columns and live items
+        size = 0
+        if isinstance(self.picture_item, MapImageItem) and self.picture_item.pixmap is not None:
+            pixmap = self.picture_item.pixmap
+            size += pixmap.width() * pixmap.height() * 4
+        elif isinstance(self.picture_item, TiledMapItem):
+            size += self.picture_item.cache.total_bytes
+        size += self.scene.markerCount() * self.marker_bytes + len(self.scene.items_by_row) * self.item_bytes
+        return size
+
+    def release(self):
+        # The journal folds its last edits into the project on its own thread
+        if self.journal is not None:
+            self.journal.stop()
+            self.journal = None
+
+
+class MapCache:
+    # Memory for maps that are not shown, recently visited ones are kept so that going back is instant
+    max_bytes = 512 * 1024 * 1024
+
+    def __init__(self, max_bytes=max_bytes):
+        self.max_bytes = max_bytes
+        # key -> MapState, ordered from least to most recently used
+        self.states = OrderedDict()
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, key):
+        return key in self.states
+
+    def put(self, state):
+        key = state.key()
+        previous = self.states.pop(key, None)
+        if previous is not None and previous is not state:
+            previous.release()
+        self.states[key] = state
+        self.evict()
+
+    def take(self, key):
+        # The state leaves the cache while it is shown
+        return self.states.pop(os.path.abspath(key), None)
+
+    def totalBytes(self):
+        return sum(state.memoryBytes() for state in self.states.values())
+
+    def evict(self):
+        # Least recently used maps go first; the most recent one stays even when it alone is over the budget
+        total = self.totalBytes()
+        while total > self.max_bytes and len(self.states) > 1:
+            _, state = self.states.popitem(last=False)
+            total -= state.memoryBytes()
+            state.release()
+
+    def clear(self):
+        # Journals are closed and not just stopped, for when the app exits
+        for state in self.states.values():
+            if state.journal is not None:
+                state.journal.close()
+                state.journal = None
+        self.states.clear()
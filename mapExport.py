@@ -0,0 +1,312 @@
+import json
+import math
+import multiprocessing
+import os
+import struct
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from PySide6.QtCore import QPointF, QRectF, Qt
+from PySide6.QtGui import QColor, QImage, QPainter
+
+from markers import MarkerItem, drawMarker, icon_cache, icon_catalog, labelPath, labelStyle
+from tilePyramid import TilePyramid
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Largest label drawn below a marker, in export pixels, markers this far outside a strip may still reach into it
+LABEL_MARGIN = 400
+
+
+def adler32Combine(first, second, second_length):
+    # Checksum of two concatenated blocks from the checksums of both, as zlib's adler32_combine
+    base = 65521
+    remainder = second_length % base
+    sum1 = first & 0xffff
+    sum2 = (remainder * sum1) % base
+    sum1 += (second & 0xffff) + base - 1
+    sum2 += ((first >> 16) & 0xffff) + ((second >> 16) & 0xffff) + base - remainder
+    if sum1 >= base:
+        sum1 -= base
+    if sum1 >= base:
+        sum1 -= base
+    if sum2 >= base << 1:
+        sum2 -= base << 1
+    if sum2 >= base:
+        sum2 -= base
+    return sum1 | (sum2 << 16)
+
+
+def pngChunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+# Worker processes
+
+worker = {}
+
+
+def initWorker(map_path, cache_dir, marker_size, transparent):
+    # Every worker has its own GUI application for fonts and pixmaps, without a display
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    from PySide6.QtGui import QGuiApplication
+    worker['app'] = QGuiApplication.instance() or QGuiApplication([])
+
+    TilePyramid.cache_dir = cache_dir
+    worker['pyramid'] = TilePyramid(map_path)
+    worker['marker_size'] = marker_size
+    worker['format'] = QImage.Format.Format_RGBA8888 if transparent else QImage.Format.Format_RGB888
+    # Pyramid tiles decoded by this worker, neighbouring strips mostly need the same ones
+    worker['tiles'] = OrderedDict()
+    worker['labels'] = {}
+
+
+def workerTile(level, column, row):
+    tiles = worker['tiles']
+    key = (level, column, row)
+    image = tiles.get(key)
+    if image is None:
+        image = tiles[key] = QImage(worker['pyramid'].tilePath(level, column, row))
+        while len(tiles) > 64:
+            tiles.popitem(last=False)
+    else:
+        tiles.move_to_end(key)
+    return image
+
+
+def renderRegion(rect, scale, markers):
+    # Renders the export pixels in rect: the map from the pyramid level closest to the scale, then the markers
+    image = QImage(int(rect.width()), int(rect.height()), worker['format'])
+    image.fill(Qt.GlobalColor.transparent if image.hasAlphaChannel() else Qt.GlobalColor.white)
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+
+    pyramid = worker['pyramid']
+    level = pyramid.levelForScale(scale)
+    scene_rect = QRectF(rect.x() / scale, rect.y() / scale, rect.width() / scale, rect.height() / scale)
+    for column, row in pyramid.tilesInRect(level, scene_rect.intersected(QRectF(0, 0, pyramid.width,
+                                                                               pyramid.height))):
+        tile = pyramid.tileRect(level, column, row)
+        target = QRectF(tile.x() * scale - rect.x(), tile.y() * scale - rect.y(), tile.width() * scale,
+                        tile.height() * scale)
+        tile_image = workerTile(level, column, row)
+        painter.drawImage(target, tile_image, QRectF(tile_image.rect()))
+
+    size = worker['marker_size']
+    labels = worker['labels']
+    for x, y, category, icon, name, showing, color in markers:
+        label = None
+        if showing and name:
+            key = (name, color)
+            label = labels.get(key)
+            if label is None:
+                path, _ = labelPath(name)
+                pen, brush = labelStyle(QColor.fromRgba(color))
+                label = labels[key] = (path, pen, brush)
+        painter.save()
+        painter.translate(QPointF(x * scale - rect.x(), y * scale - rect.y()))
+        drawMarker(painter, icon_cache.pixmap(category, icon, size), size, label)
+        painter.restore()
+    painter.end()
+    return image
+
+
+def renderStrip(y, height, width, scale, markers, level):
+    # One compressed band of PNG scanlines: raw deflate ending on a byte boundary, its Adler-32 and raw length
+    image = renderRegion(QRectF(0, y, width, height), scale, markers)
+    channels = 4 if image.hasAlphaChannel() else 3
+    line_bytes = width * channels
+    bits = image.constBits()
+    stride = image.bytesPerLine()
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    checksum = 1
+    length = 0
+    output = []
+    for line in range(height):
+        # Filter type 0, the scanline as it is
+        raw = b"\x00" + bytes(bits[line * stride:line * stride + line_bytes])
+        checksum = zlib.adler32(raw, checksum)
+        length += len(raw)
+        output.append(compressor.compress(raw))
+    output.append(compressor.flush(zlib.Z_SYNC_FLUSH))
+    return b"".join(output), checksum, length
+
+
+def renderTileFile(path, rect, scale, markers):
+    image = renderRegion(rect, scale, markers)
+    if not image.save(path, "PNG"):
+        raise IOError("Could not write " + path)
+    return path
+
+
+def buildPyramid(map_path, cache_dir):
+    TilePyramid.cache_dir = cache_dir
+    pyramid = TilePyramid(map_path)
+    if not pyramid.isBuilt():
+        pyramid.build()
+
+
+# Export driver, runs in the app process
+
+class MapExport:
+    # Rows of export pixels rendered and compressed by one task
+    strip_height = 256
+    tile_size = 1024
+
+    def __init__(self, scene, map_path, scale, workers=None, compression=6):
+        self.scene = scene
+        self.map_path = map_path
+        self.scale = scale
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.compression = compression
+
+        pyramid = TilePyramid(map_path)
+        self.width = max(1, math.ceil(pyramid.width * scale))
+        self.height = max(1, math.ceil(pyramid.height * scale))
+        self.transparent = map_path.lower().endswith(".png")
+
+        # Marker size of the view, markers ignore the zoom there and keep their screen size in the export too
+        self.marker_size = MarkerItem.size
+        self.cancelled = False
+
+    def markersIn(self, rect):
+        # Render data of the markers that can reach into the export rect
+        margin = (self.marker_size + LABEL_MARGIN) / self.scale
+        scene_rect = QRectF(rect.x() / self.scale - margin, rect.y() / self.scale - margin,
+                            rect.width() / self.scale + 2 * margin, rect.height() / self.scale + 2 * margin)
+        store = self.scene.store
+        markers = []
+        for row in sorted(self.scene.visibleRowsInRect(scene_rect)):
+            record = store.record(row)
+            icon = record['icon']
+            if icon is None:
+                # Same fallback as MarkerItem.setImageByType, an empty folder leaves icon None for the placeholder
+                available = icon_catalog.available(record['category'])
+                if available:
+                    icon = available[0][1]
+            markers.append((record['x'], record['y'], record['category'], icon, record['name'],
+                            record['showing'], store.colors[row]))
+        return markers
+
+    def executor(self):
+        # Qt is not safe to fork, workers are started fresh
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=initWorker,
+                                   initargs=(self.map_path, TilePyramid.cache_dir, self.marker_size, self.transparent))
+
+    def waitFor(self, future, progress, done):
+        # The progress callback keeps the caller responsive and may cancel the export while a task runs
+        while not wait([future], timeout=0.05).done:
+            if progress is not None:
+                progress(done)
+            if self.cancelled:
+                raise InterruptedError("Export cancelled")
+        return future.result()
+
+    def ordered(self, executor, tasks, progress):
+        # Results in the order of the tasks, with only a few tasks in flight so finished ones do not pile up
+        pending = deque()
+        tasks = iter(tasks)
+        done = 0
+        while True:
+            while len(pending) < self.workers * 2:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                pending.append(executor.submit(*task))
+            if not pending:
+                return
+            result = self.waitFor(pending.popleft(), progress, done)
+            done += 1
+            if progress is not None:
+                progress(done)
+            if self.cancelled:
+                raise InterruptedError("Export cancelled")
+            yield result
+
+    def taskCount(self, tiles):
+        if tiles:
+            return math.ceil(self.width / self.tile_size) * math.ceil(self.height / self.tile_size)
+        return math.ceil(self.height / self.strip_height)
+
+    def run(self, path, tiles=False, progress=None):
+        # Writes a single PNG at path, or a directory of PNG tiles with a tiles.json index when tiles is set
+        with self.executor() as executor:
+            try:
+                # The pyramid doubles as the source of the export, also for maps that are otherwise shown in one piece
+                self.waitFor(executor.submit(buildPyramid, self.map_path, TilePyramid.cache_dir), progress, 0)
+                if tiles:
+                    self.writeTiles(executor, path, progress)
+                else:
+                    self.writePng(executor, path, progress)
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    def writePng(self, executor, path, progress):
+        def tasks():
+            for y in range(0, self.height, self.strip_height):
+                height = min(self.strip_height, self.height - y)
+                yield (renderStrip, y, height, self.width, self.scale,
+                       self.markersIn(QRectF(0, y, self.width, height)), self.compression)
+
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(PNG_SIGNATURE)
+                file.write(pngChunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8,
+                                                         6 if self.transparent else 2, 0, 0, 0)))
+                # One zlib stream made of the strips compressed by the workers, ended by an empty final block
+                checksum = 1
+                file.write(pngChunk(b"IDAT", b"\x78\x9c"))
+                for data, strip_checksum, length in self.ordered(executor, tasks(), progress):
+                    checksum = adler32Combine(checksum, strip_checksum, length)
+                    for start in range(0, len(data), 1 << 20):
+                        file.write(pngChunk(b"IDAT", data[start:start + (1 << 20)]))
+                end = zlib.compressobj(self.compression, zlib.DEFLATED, -15).flush(zlib.Z_FINISH)
+                file.write(pngChunk(b"IDAT", end + struct.pack(">I", checksum)))
+                file.write(pngChunk(b"IEND", b""))
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def writeTiles(self, executor, directory, progress):
+        created = not os.path.isdir(directory)
+        os.makedirs(directory, exist_ok=True)
+        columns = math.ceil(self.width / self.tile_size)
+        rows = math.ceil(self.height / self.tile_size)
+        # Tiles handed to the workers, the only files removed when the export does not finish
+        paths = []
+
+        def tasks():
+            for row in range(rows):
+                for column in range(columns):
+                    rect = QRectF(column * self.tile_size, row * self.tile_size,
+                                  min(self.tile_size, self.width - column * self.tile_size),
+                                  min(self.tile_size, self.height - row * self.tile_size))
+                    paths.append(os.path.join(directory, "%d_%d.png" % (row, column)))
+                    yield renderTileFile, paths[-1], rect, self.scale, self.markersIn(rect)
+
+        try:
+            for _ in self.ordered(executor, tasks(), progress):
+                pass
+        except BaseException:
+            # Tiles still being rendered are written before they can be removed
+            executor.shutdown(cancel_futures=True)
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            if created:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+            raise
+        with open(os.path.join(directory, "tiles.json"), 'w', encoding='utf-8') as file:
+            json.dump({'width': self.width, 'height': self.height, 'tile_size': self.tile_size, 'columns': columns,
+                       'rows': rows, 'scale': self.scale, 'name': "{row}_{column}.png"}, file)
@@ -0,0 +1,341 @@
+from PySide6.QtCore import QRectF, Signal
+from PySide6.QtWidgets import QGraphicsScene
+
+from fogOfWar import FogLayer, FogMask
+from markerClusters import ClusterGrid, ClusterLayer, MarkerLayer
+from markerIndex import MarkerIndex
+from markerLabels import LabelLayer
+from markerLayers import LayerFilter
+from markerSearch import MarkerSearchIndex
+from markerStore import MarkerStore
+from markers import MarkerItem
+from perfTrace import timed
+
+
+class MapScene(QGraphicsScene):
+    # Marker changes made through the UI, listened to by everything that keeps marker state outside the scene
+    markerAdded = Signal(object)
+    markerEdited = Signal(object)
+    markerMoved = Signal(object)
+    markerRemoved = Signal(object)
+    # The shown categories or tags changed
+    layersChanged = Signal()
+
+    # With more markers than this in view they are shown as clusters at any zoom
+    max_items = 3000
+
+    def __init__(self):
+        super().__init__()
+
+        # Data of every marker on the map, render items only exist for the markers in view
+        self.store = MarkerStore()
+        # Spatial index of every marker, kept in sync by the methods below and MarkerItem.itemChange
+        self.marker_index = MarkerIndex(self.store)
+        # Marker counts per cell at every level of detail, kept in sync the same way
+        self.cluster_grid = ClusterGrid()
+        # Words of marker names and descriptions, updated when a marker panel saves its edits
+        self.search_index = MarkerSearchIndex(self.store)
+        self.markerEdited.connect(lambda marker: self.search_index.update(marker.row))
+        self.markerEdited.connect(self.markerCategoryChanged)
+        # Shown categories and tags, hidden markers are left out of visibleRowsInRect like the ones under fog
+        self.layers = LayerFilter(self.store)
+
+        # store row -> MarkerItem
+        self.items_by_row = {}
+        # Rows whose items are kept while out of view, like the marker being edited
+        self.pinned = set()
+        self.view_scale = 1.0
+        self.view_rect = QRectF()
+        # Bumped by every change to the markers, the layers or the fog, views drawn from them like the minimap
+        # compare it to tell when to redraw
+        self.version = 0
+
+        self.marker_layer = None
+        # Category id -> child of the marker layer holding the items of that category
+        self.category_layers = {}
+        self.label_layer = None
+        self.cluster_layer = None
+        # Unexplored parts of the map, None when the map has no fog of war
+        self.fog = None
+        self.fog_layer = None
+        # Length of one map pixel in the unit distances are shown in, saved with the project
+        self.map_units = {'unit': "px", 'per_pixel': 1.0}
+        # Route measured between two markers, None while there is none
+        self.route_item = None
+        self.createLayers()
+
+    def createLayers(self):
+        # All markers live in one layer, clusters are drawn by a single item above them
+        self.marker_layer = MarkerLayer()
+        # Above the map item, which is added to the scene later
+        self.marker_layer.setZValue(1)
+        self.addItem(self.marker_layer)
+        self.category_layers = {}
+        # Names of the markers, decluttered for the zoom; fades with the markers as a child of their layer
+        self.label_layer = LabelLayer(self)
+        self.label_layer.setParentItem(self.marker_layer)
+        self.cluster_layer = ClusterLayer(self.cluster_grid)
+        self.cluster_layer.setVisible(False)
+        self.addItem(self.cluster_layer)
+
+    # Marker data
+
+    def createMarker(self, pos):
+        # Placed through the UI, the item is pinned until its panel is closed
+        row = self.store.add(pos.x(), pos.y(), self.store.category_names[0])
+        self.indexRow(row)
+        marker = self.markerItem(row)
+        self.pinned.add(row)
+        self.markerAdded.emit(marker)
+        return marker
+
+    def loadRecords(self, records):
+        # Markers read from a file only go into the store and the indices, items follow with the next view update
+        for record in records:
+            self.indexRow(self.store.addRecord(record))
+
+    def indexRow(self, row):
+        self.version += 1
+        self.marker_index.insert(row)
+        self.cluster_grid.add(*self.store.position(row), self.store.categories[row])
+        self.search_index.add(row)
+
+    def removeMarker(self, marker):
+        self.markerRemoved.emit(marker)
+        self.removeRow(marker.row)
+
+    def removeRow(self, row):
+        self.version += 1
+        self.releaseItem(row)
+        self.pinned.discard(row)
+        self.marker_index.remove(row)
+        self.cluster_grid.remove(*self.store.position(row), self.clusterGroup(row))
+        self.search_index.remove(row)
+        self.store.remove(row)
+        self.label_layer.invalidate(row, removed=True)
+
+    def markerPositionChanged(self, marker):
+        position = marker.scenePos()
+        self.moveRow(marker.row, position.x(), position.y())
+
+    def moveRow(self, row, x, y):
+        old_x, old_y = self.store.position(row)
+        if old_x == x and old_y == y:
+            return
+        self.store.setPosition(row, x, y)
+        self.version += 1
+        self.marker_index.move(row)
+        self.cluster_grid.move(old_x, old_y, x, y, self.clusterGroup(row))
+        self.label_layer.invalidate(row)
+        # Moves that did not come from dragging the item, like those of a live sync, also move the item
+        marker = self.items_by_row.get(row)
+        if marker is not None and (marker.pos().x(), marker.pos().y()) != (x, y):
+            marker.setPos(x, y)
+
+    def applyDeltas(self, deltas):
+        # Changes made elsewhere, like on the host of a live sync; applied without emitting the marker signals
+        for delta in deltas:
+            if delta['op'] in ('add', 'edit'):
+                record = delta['marker']
+                row = self.store.rowOf(record['id'])
+                if row is not None:
+                    self.removeRow(row)
+                self.indexRow(self.store.addRecord(record))
+            else:
+                row = self.store.rowOf(delta['id'])
+                if row is None:
+                    continue
+                if delta['op'] == 'move':
+                    self.moveRow(row, delta['x'], delta['y'])
+                elif delta['op'] == 'delete':
+                    self.removeRow(row)
+        self.updateView()
+
+    def clusterGroup(self, row):
+        # A category picked in the marker panel is only applied to the layers and clusters once it is saved
+        marker = self.items_by_row.get(row)
+        return self.store.categories[row] if marker is None else marker.parentItem().category
+
+    def markerCategoryChanged(self, marker):
+        # The item moves to the layer of its new category, its old category is the one of the layer it is in.
+        # New tags may hide the marker too
+        category = self.store.categories[marker.row]
+        old_layer = marker.parentItem()
+        if old_layer.category != category:
+            x, y = self.store.position(marker.row)
+            self.cluster_grid.remove(x, y, old_layer.category)
+            self.cluster_grid.add(x, y, category)
+            marker.setParentItem(self.categoryLayer(category))
+            self.version += 1
+        if old_layer.category != category or self.layers.isActive():
+            self.updateView()
+
+    def markerLabelChanged(self, marker):
+        self.label_layer.invalidate(marker.row)
+
+    def markerRecords(self):
+        return self.store.records()
+
+    def markerCount(self):
+        return self.store.count()
+
+    def visibleRowsInRect(self, rect):
+        # Rows of the markers in the rect that are shown, the view and the image export both go through here.
+        # Markers under fog are hidden, the tiles of the mask decide for whole cells before any row is looked at
+        coverage = FogMask.CLEAR if self.fog is None else self.fog.coverage(rect)
+        if coverage == FogMask.FOGGED:
+            return []
+        rows = self.layers.filterRows(self.marker_index.rowsInRect(rect))
+        if coverage == FogMask.CLEAR:
+            return rows
+        xs = self.store.xs
+        ys = self.store.ys
+        return [row for row in rows if self.fog.isRevealed(xs[row], ys[row])]
+
+    def setCategoryVisible(self, category, visible):
+        # Hiding the layer hides every item of the category in one call and only repaints where they were;
+        # the next view update then lets go of them
+        self.layers.setCategoryVisible(category, visible)
+        layer = self.category_layers.get(self.store.categoryId(category))
+        if layer is not None:
+            layer.setVisible(visible)
+        self.layersChanged.emit()
+        self.applyLayers()
+
+    def setTagVisible(self, tag, visible):
+        self.layers.setTagVisible(tag, visible)
+        self.layersChanged.emit()
+        self.applyLayers()
+
+    def setLayerFilter(self, hidden_categories=(), hidden_tags=(), required_tags=()):
+        self.layers.setFilter(hidden_categories, hidden_tags, required_tags)
+        for category, layer in self.category_layers.items():
+            layer.setVisible(category not in self.layers.hidden_categories)
+        self.layersChanged.emit()
+        self.applyLayers()
+
+    def setLayerState(self, state):
+        # Restores the layers saved with a project, without reporting a change
+        self.layers.setState(state)
+        for category, layer in self.category_layers.items():
+            layer.setVisible(category not in self.layers.hidden_categories)
+        self.applyLayers()
+
+    def applyLayers(self):
+        # Clusters leave hidden categories out without touching a cell, tags only apply to markers
+        self.cluster_grid.hidden = set(self.layers.hidden_categories)
+        self.version += 1
+        self.cluster_layer.update()
+        self.updateView()
+
+    def setFog(self, mask, opacity=1.0):
+        if self.fog_layer is not None:
+            self.removeItem(self.fog_layer)
+            self.fog_layer = None
+        self.fog = mask
+        self.cluster_layer.fog = mask
+        self.version += 1
+        if mask is not None:
+            self.fog_layer = FogLayer(mask)
+            self.fog_layer.setOpacity(opacity)
+            self.addItem(self.fog_layer)
+        self.updateView()
+
+    def brushFog(self, start, end, radius, reveal=True):
+        # Markers are shown or hidden with the next view update, once the stroke is done
+        self.fog_layer.brush(start, end, radius, reveal)
+        self.version += 1
+
+    def setRoute(self, item):
+        if self.route_item is not None:
+            self.removeItem(self.route_item)
+        self.route_item = item
+        if item is not None:
+            self.addItem(item)
+
+    def setMapUnits(self, unit, per_pixel):
+        if per_pixel <= 0:
+            raise ValueError("A map pixel must have a positive length")
+        self.map_units = {'unit': unit, 'per_pixel': per_pixel}
+
+    def formatDistance(self, pixels):
+        distance = pixels * self.map_units['per_pixel']
+        return "%.*f %s" % (0 if distance >= 100 else 1 if distance >= 10 else 2, distance, self.map_units['unit'])
+
+    # Render items
+
+    def markerItem(self, row):
+        marker = self.items_by_row.get(row)
+        if marker is None:
+            marker = MarkerItem(self.store, row)
+            marker.setParentItem(self.categoryLayer(self.store.categories[row]))
+            self.items_by_row[row] = marker
+        return marker
+
+    def categoryLayer(self, category):
+        layer = self.category_layers.get(category)
+        if layer is None:
+            layer = self.category_layers[category] = MarkerLayer(category)
+            layer.setParentItem(self.marker_layer)
+            layer.setVisible(category not in self.layers.hidden_categories)
+        return layer
+
+    def releaseItem(self, row):
+        marker = self.items_by_row.pop(row, None)
+        if marker is not None:
+            self.removeItem(marker)
+
+    def pin(self, marker):
+        self.pinned.add(marker.row)
+
+    def unpin(self, marker):
+        self.pinned.discard(marker.row)
+
+    def setMapRect(self, rect):
+        self.cluster_layer.setBounds(rect)
+        self.label_layer.setBounds(rect)
+
+    def setView(self, scale, rect):
+        self.view_scale = scale
+        self.view_rect = QRectF(rect)
+        self.updateView()
+
+    @timed("update_view")
+    def updateView(self):
+        # Zoomed out markers collapse into clusters, which cross-fade with the markers while zooming
+        blend = ClusterLayer.blend(self.view_scale)
+        if blend < 1 and self.cluster_grid.countInRect(self.view_rect) > self.max_items:
+            blend = 1.0
+        self.cluster_layer.setViewScale(self.view_scale)
+        self.cluster_layer.setOpacity(blend)
+        self.cluster_layer.setVisible(blend > 0)
+        self.marker_layer.setOpacity(1 - blend)
+        self.marker_layer.setVisible(blend < 1)
+
+        # Only markers in view get items, the margin covers icons reaching in from outside
+        visible = set()
+        if blend < 1:
+            margin = MarkerItem.max_size / max(self.view_scale, 1e-6)
+            visible.update(self.visibleRowsInRect(self.view_rect.adjusted(-margin, -margin, margin, margin)))
+        for row, marker in list(self.items_by_row.items()):
+            if row not in visible and row not in self.pinned and not marker.isSelected():
+                self.releaseItem(row)
+        for row in visible:
+            self.markerItem(row)
+        self.label_layer.setView(self.view_scale, list(self.items_by_row))
+
+    def clear(self):
+        super().clear()
+        self.store.clear()
+        self.marker_index.clear()
+        self.cluster_grid.clear()
+        self.search_index.reset()
+        self.items_by_row.clear()
+        self.pinned.clear()
+        self.version += 1
+        self.layers = LayerFilter(self.store)
+        self.fog = None
+        self.fog_layer = None
+        self.map_units = {'unit': "px", 'per_pixel': 1.0}
+        self.route_item = None
+        self.createLayers()
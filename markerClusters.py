@@ -0,0 +1,184 @@
+import math
+
+from PySide6.QtCore import QPointF, QRectF, Qt
+from PySide6.QtGui import QColor, QFont, QPen, QBrush
+from PySide6.QtWidgets import QGraphicsItem
+
+
+class ClusterGrid:
+    # Level k groups markers into square cells of base_cell * 2**k scene units
+    base_cell = 128.0
+    levels = 12
+
+    def __init__(self):
+        # One dict per level: (column, row) -> {group: [count, sum of x, sum of y]}, groups are marker categories
+        self.grid = [{} for _ in range(self.levels)]
+        # Groups left out of the clusters, switching one on or off touches no cell
+        self.hidden = set()
+
+    def cellSize(self, level):
+        return self.base_cell * (1 << level)
+
+    def add(self, x, y, group=0, sign=1):
+        # Cells of the next level cover 2x2 cells of this one, so their coordinates are halved on the way up
+        column, row = int(math.floor(x / self.base_cell)), int(math.floor(y / self.base_cell))
+        for cells in self.grid:
+            cell = (column, row)
+            column >>= 1
+            row >>= 1
+            groups = cells.get(cell)
+            if groups is None:
+                groups = cells[cell] = {}
+            entry = groups.get(group)
+            if entry is None:
+                entry = groups[group] = [0, 0.0, 0.0]
+            entry[0] += sign
+            entry[1] += sign * x
+            entry[2] += sign * y
+            if entry[0] == 0:
+                del groups[group]
+                if not groups:
+                    del cells[cell]
+
+    def remove(self, x, y, group=0):
+        self.add(x, y, group, -1)
+
+    def move(self, old_x, old_y, x, y, group=0):
+        self.add(old_x, old_y, group, -1)
+        self.add(x, y, group, 1)
+
+    def clear(self):
+        self.grid = [{} for _ in range(self.levels)]
+        self.hidden = set()
+
+    def levelForScale(self, scale, cluster_pixels):
+        # Finest level whose cells are at least cluster_pixels wide on screen
+        for level in range(self.levels):
+            if self.cellSize(level) * scale >= cluster_pixels:
+                return level
+        return self.levels - 1
+
+    def clustersInRect(self, level, rect):
+        # (count, centroid x, centroid y) of every cluster of the level whose cell touches the rect
+        size = self.cellSize(level)
+        cells = self.grid[level]
+        first_column, first_row = int(math.floor(rect.left() / size)), int(math.floor(rect.top() / size))
+        last_column, last_row = int(math.floor(rect.right() / size)), int(math.floor(rect.bottom() / size))
+
+        if (last_column - first_column + 1) * (last_row - first_row + 1) > len(cells):
+            keys = [cell for cell in cells
+                    if first_column <= cell[0] <= last_column and first_row <= cell[1] <= last_row]
+        else:
+            keys = [(column, row) for row in range(first_row, last_row + 1)
+                    for column in range(first_column, last_column + 1) if (column, row) in cells]
+
+        clusters = []
+        hidden = self.hidden
+        for cell in keys:
+            count = sum_x = sum_y = 0
+            for group, entry in cells[cell].items():
+                if group not in hidden:
+                    count += entry[0]
+                    sum_x += entry[1]
+                    sum_y += entry[2]
+            if count:
+                clusters.append((count, sum_x / count, sum_y / count))
+        return clusters
+
+    def countInRect(self, rect):
+        # Approximate number of markers in the rect, read from the coarsest level with more than a few cells in it
+        for level in range(self.levels - 1, -1, -1):
+            size = self.cellSize(level)
+            if max(rect.width(), rect.height()) / size >= 4 or level == 0:
+                return sum(count for count, _, _ in self.clustersInRect(level, rect))
+        return 0
+
+
+class MarkerLayer(QGraphicsItem):
+    # Empty parent of markers, so they can be faded or hidden with a single call: one holds every category layer,
+    # a category layer the markers of its category
+
+    def __init__(self, category=None):
+        super().__init__()
+        self.category = category
+        self.setFlag(QGraphicsItem.ItemHasNoContents)
+
+    def boundingRect(self):
+        return QRectF()
+
+    def paint(self, painter, option, widget=None):
+        pass
+
+
+class ClusterLayer(QGraphicsItem):
+    # Below this view scale markers are shown as clusters, above fade_end only the markers are shown
+    threshold = 0.35
+    fade_end = 0.5
+    # Clusters are formed from markers closer than this on screen
+    cluster_pixels = 72
+
+    def __init__(self, grid):
+        super().__init__()
+
+        self.grid = grid
+        # Clusters centered under the fog of war mask are not drawn
+        self.fog = None
+        self.bounds = QRectF()
+        self.level = 0
+        self.scale = 1.0
+
+        self.setAcceptedMouseButtons(Qt.MouseButton.NoButton)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.setZValue(2)
+
+        self.font = QFont("Arial Black", 9)
+        self.pen = QPen(QColor("white"), 2)
+        self.brush = QBrush(QColor(40, 40, 40, 200))
+
+    def setBounds(self, rect):
+        self.prepareGeometryChange()
+        self.bounds = QRectF(rect)
+
+    def boundingRect(self):
+        # Badges are drawn at screen size, so they may reach over the edge of the map
+        margin = self.cluster_pixels / max(self.scale, 1e-6)
+        return self.bounds.adjusted(-margin, -margin, margin, margin)
+
+    @staticmethod
+    def blend(scale):
+        # 1 when fully clustered, 0 when only markers are shown, linear in between
+        if scale <= ClusterLayer.threshold:
+            return 1.0
+        if scale >= ClusterLayer.fade_end:
+            return 0.0
+        return (ClusterLayer.fade_end - scale) / (ClusterLayer.fade_end - ClusterLayer.threshold)
+
+    def setViewScale(self, scale):
+        self.prepareGeometryChange()
+        self.scale = scale
+        self.level = self.grid.levelForScale(scale, self.cluster_pixels)
+        self.update()
+
+    def paint(self, painter, option, widget=None):
+        # Cost depends on the number of clusters in the exposed area, not on the number of markers
+        transform = painter.worldTransform()
+        clusters = self.grid.clustersInRect(self.level, option.exposedRect)
+
+        painter.save()
+        painter.resetTransform()
+        painter.setFont(self.font)
+        painter.setBrush(self.brush)
+        for count, x, y in clusters:
+            if self.fog is not None and not self.fog.isRevealed(x, y):
+                continue
+            center = transform.map(QPointF(x, y))
+            if count == 1:
+                radius = 5
+            else:
+                radius = 11 + 3 * math.log2(count)
+            painter.setPen(self.pen)
+            painter.drawEllipse(center, radius, radius)
+            if count > 1:
+                painter.drawText(QRectF(center.x() - radius, center.y() - radius, 2 * radius, 2 * radius),
+                                 Qt.AlignmentFlag.AlignCenter, str(count))
+        painter.restore()
@@ -0,0 +1,116 @@
+import math
+
+
+class MarkerIndex:
+    # Uniform grid over the marker positions of a MarkerStore, in scene coordinates
+    cell_size = 256.0
+
+    def __init__(self, store, cell_size=cell_size):
+        self.store = store
+        self.cell_size = cell_size
+        # (column, row) -> set of store rows
+        self.cells = {}
+        # store row -> cell the row is filed under
+        self.cell_of_row = {}
+        # Range of cells that were ever occupied, bounds the nearest marker search
+        self.bounds = None
+
+    def cellOf(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def insert(self, row):
+        cell = self.cellOf(*self.store.position(row))
+        self.cell_of_row[row] = cell
+        self.cells.setdefault(cell, set()).add(row)
+        self.extendBounds(cell)
+
+    def move(self, row):
+        old_cell = self.cell_of_row.get(row)
+        if old_cell is None:
+            return
+        cell = self.cellOf(*self.store.position(row))
+        if cell != old_cell:
+            self.removeFromCell(row, old_cell)
+            self.cell_of_row[row] = cell
+            self.cells.setdefault(cell, set()).add(row)
+            self.extendBounds(cell)
+
+    def remove(self, row):
+        cell = self.cell_of_row.pop(row, None)
+        if cell is not None:
+            self.removeFromCell(row, cell)
+
+    def removeFromCell(self, row, cell):
+        members = self.cells[cell]
+        members.discard(row)
+        if not members:
+            del self.cells[cell]
+
+    def extendBounds(self, cell):
+        if self.bounds is None:
+            self.bounds = (cell[0], cell[1], cell[0], cell[1])
+        else:
+            self.bounds = (min(self.bounds[0], cell[0]), min(self.bounds[1], cell[1]),
+                           max(self.bounds[2], cell[0]), max(self.bounds[3], cell[1]))
+
+    def clear(self):
+        self.cells.clear()
+        self.cell_of_row.clear()
+        self.bounds = None
+
+    def count(self):
+        return len(self.cell_of_row)
+
+    def rowsInRect(self, rect):
+        first_column, first_row = self.cellOf(rect.left(), rect.top())
+        last_column, last_row = self.cellOf(rect.right(), rect.bottom())
+
+        # Walk whichever is smaller, the covered cells or the occupied ones
+        if (last_column - first_column + 1) * (last_row - first_row + 1) > len(self.cells):
+            cells = [cell for cell in self.cells
+                     if first_column <= cell[0] <= last_column and first_row <= cell[1] <= last_row]
+        else:
+            cells = [(column, row) for row in range(first_row, last_row + 1)
+                     for column in range(first_column, last_column + 1) if (column, row) in self.cells]
+
+        xs = self.store.xs
+        ys = self.store.ys
+        found = []
+        for cell in cells:
+            for row in self.cells[cell]:
+                if rect.left() <= xs[row] <= rect.right() and rect.top() <= ys[row] <= rect.bottom():
+                    found.append(row)
+        return found
+
+    def nearest(self, point, max_distance=math.inf):
+        if not self.cell_of_row:
+            return None
+        column, row = self.cellOf(point.x(), point.y())
+        best = None
+        best_distance = max_distance
+
+        # Search rings of cells around the point until no closer marker can be found in the next ring
+        max_ring = max(column - self.bounds[0], row - self.bounds[1], self.bounds[2] - column, self.bounds[3] - row)
+        for ring in range(max_ring + 1):
+            if (ring - 1) * self.cell_size > best_distance:
+                break
+            for cell in self.ringCells(column, row, ring):
+                for marker_row in self.cells.get(cell, ()):
+                    x, y = self.store.position(marker_row)
+                    distance = math.hypot(x - point.x(), y - point.y())
+                    if distance < best_distance:
+                        best, best_distance = marker_row, distance
+        return best
+
+    @staticmethod
+    def ringCells(column, row, ring):
+        if ring == 0:
+            return [(column, row)]
+        cells = []
+        for offset in range(-ring, ring + 1):
+            cells.append((column + offset, row - ring))
+            cells.append((column + offset, row + ring))
+        for offset in range(-ring + 1, ring):
+            cells.append((column - ring, row + offset))
+            cells.append((column + ring, row + offset))
+        return cells
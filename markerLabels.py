@@ -0,0 +1,192 @@
+import math
+from collections import OrderedDict
+
+from PySide6.QtCore import QPointF, QRectF, Qt
+from PySide6.QtGui import QColor, QPainter, QPixmap
+from PySide6.QtWidgets import QGraphicsItem
+
+from markers import MarkerItem, labelPath, labelStyle
+from perfTrace import perf_trace
+from pixmapCache import PixmapCache
+
+
+class LabelCache(PixmapCache):
+    # Budget for the rendered labels kept alive by the cache
+    max_bytes = 32 * 1024 * 1024
+    # Room around the text for its outline
+    padding = 2
+
+    def __init__(self, max_bytes=max_bytes):
+        # Keyed by (text, ARGB color, point size)
+        super().__init__(max_bytes)
+
+    def pixmap(self, text, color, font=None):
+        # The outlined text is laid out and rasterized once, drawing a label is a single pixmap blit
+        font = font or MarkerItem.font
+        key = (text, color, font.pointSize())
+        pixmap = self.get(key)
+        if pixmap is not None:
+            return pixmap
+
+        with perf_trace.section("label_render"):
+            path, rect = labelPath(text)
+            pen, brush = labelStyle(QColor.fromRgba(color))
+            pixmap = QPixmap(math.ceil(rect.width()) + 2 * self.padding, math.ceil(rect.height()) + 2 * self.padding)
+            pixmap.fill(Qt.GlobalColor.transparent)
+            painter = QPainter(pixmap)
+            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+            painter.translate(rect.width() / 2 + self.padding, self.padding)
+            painter.setPen(pen)
+            painter.setBrush(brush)
+            painter.drawPath(path)
+            painter.end()
+        self.insert(key, pixmap)
+        return pixmap
+
+    @staticmethod
+    def origin(pixmap, x, y, marker_size):
+        # Device position of the top left corner of a label below a marker icon centered on x, y
+        return QPointF(x - pixmap.width() / 2, y + marker_size / 2 - LabelCache.padding)
+
+
+class LabelPlacement:
+    # Labels accepted at one zoom step, in screen pixels of that step, with a grid of their rects for collisions
+    cell_size = 256
+
+    def __init__(self, scale, marker_size):
+        self.scale = scale
+        self.marker_size = marker_size
+        # row -> rect of its label, or None when it collided with a label placed earlier
+        self.rows = {}
+        # (column, row) -> [(store row, rect)]
+        self.cells = {}
+
+    def cellsOf(self, rect):
+        size = self.cell_size
+        for column in range(int(rect.left() // size), int(rect.right() // size) + 1):
+            for row in range(int(rect.top() // size), int(rect.bottom() // size) + 1):
+                yield column, row
+
+    def place(self, row, rect, force=False):
+        # Accepts the label unless it overlaps one already accepted, forced labels are accepted anyway
+        if not force:
+            for cell in self.cellsOf(rect):
+                for _, other in self.cells.get(cell, ()):
+                    if other.intersects(rect):
+                        self.rows[row] = None
+                        return False
+        self.rows[row] = rect
+        for cell in self.cellsOf(rect):
+            self.cells.setdefault(cell, []).append((row, rect))
+        return True
+
+    def forget(self, row):
+        rect = self.rows.pop(row, None)
+        if rect is not None:
+            for cell in self.cellsOf(rect):
+                entries = self.cells[cell]
+                entries[:] = [entry for entry in entries if entry[0] != row]
+                if not entries:
+                    del self.cells[cell]
+
+
+class LabelLayer(QGraphicsItem):
+    # Zoom steps per doubling of the scale that share a placement
+    steps_per_octave = 4
+    # Placements of recently used zoom steps that are kept
+    max_placements = 8
+
+    def __init__(self, scene):
+        super().__init__()
+
+        self.map_scene = scene
+        self.bounds = QRectF()
+        self.scale = 1.0
+        self.rows = ()
+
+        # (zoom step, marker size) -> LabelPlacement
+        self.placements = OrderedDict()
+        # (x, y, pixmap) of the labels to paint, in scene coordinates
+        self.visible = []
+
+        self.setAcceptedMouseButtons(Qt.MouseButton.NoButton)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        # Above every marker of the layer
+        self.setZValue(1)
+
+    def setBounds(self, rect):
+        self.prepareGeometryChange()
+        self.bounds = QRectF(rect)
+
+    def boundingRect(self):
+        # Labels are drawn at screen size below the markers, so they may reach over the edge of the map
+        margin = (MarkerItem.max_size + 200) / max(self.scale, 1e-6)
+        return self.bounds.adjusted(-margin, -margin, margin, margin)
+
+    def placement(self):
+        step = round(math.log2(max(self.scale, 1e-6)) * self.steps_per_octave)
+        key = (step, MarkerItem.size)
+        placement = self.placements.get(key)
+        if placement is None:
+            placement = self.placements[key] = LabelPlacement(2 ** (step / self.steps_per_octave), MarkerItem.size)
+            while len(self.placements) > self.max_placements:
+                self.placements.popitem(last=False)
+        else:
+            self.placements.move_to_end(key)
+        return placement
+
+    def setView(self, scale, rows):
+        # Rows are the markers that have items, new ones are placed against the labels already accepted
+        if scale != self.scale:
+            self.prepareGeometryChange()
+            self.scale = scale
+        self.rows = rows
+        self.layout()
+
+    def layout(self):
+        store = self.map_scene.store
+        placement = self.placement()
+        pinned = self.map_scene.pinned
+
+        # Pinned markers, like the one being edited, always show their label, the others keep their placement
+        # from earlier views so labels do not jump around while panning
+        new_rows = [row for row in self.rows if row not in placement.rows and store.showing(row) and store.name(row)]
+        new_rows.sort(key=lambda row: (row not in pinned, store.uids[row]))
+        for row in new_rows:
+            pixmap = label_cache.pixmap(store.name(row), store.colors[row])
+            x, y = store.position(row)
+            origin = LabelCache.origin(pixmap, x * placement.scale, y * placement.scale, placement.marker_size)
+            placement.place(row, QRectF(origin.x(), origin.y(), pixmap.width(), pixmap.height()), row in pinned)
+
+        visible = []
+        for row in self.rows:
+            if placement.rows.get(row) is not None:
+                x, y = store.position(row)
+                visible.append((x, y, label_cache.pixmap(store.name(row), store.colors[row])))
+        self.visible = visible
+        self.update()
+
+    def invalidate(self, row=None, removed=False):
+        # A changed marker is placed again, labels it blocked before stay hidden until the zoom step changes
+        if row is None:
+            self.placements.clear()
+        else:
+            for placement in self.placements.values():
+                placement.forget(row)
+            if removed:
+                self.rows = [other for other in self.rows if other != row]
+        self.layout()
+
+    def paint(self, painter, option, widget=None):
+        transform = painter.worldTransform()
+        size = MarkerItem.size
+        painter.save()
+        painter.resetTransform()
+        for x, y, pixmap in self.visible:
+            point = transform.map(QPointF(x, y))
+            painter.drawPixmap(LabelCache.origin(pixmap, point.x(), point.y(), size), pixmap)
+        painter.restore()
+
+
+# Process-wide cache of rendered labels, shared by every map and the image export
+label_cache = LabelCache()
@@ -0,0 +1,69 @@
+from markerStore import splitTags
+
+
+class LayerFilter:
+    # Which markers are shown: every category and every user tag is a layer. A marker is shown when its category
+    # is, none of its tags is hidden and, while some tags are required, it has one of them
+
+    def __init__(self, store):
+        self.store = store
+        # Category ids
+        self.hidden_categories = set()
+        self.hidden_tags = set()
+        self.required_tags = set()
+        # Tag string id -> whether markers with exactly those tags are shown, filled in as rows are checked
+        self.tag_sets = {}
+
+    def isActive(self):
+        return bool(self.hidden_categories or self.hidden_tags or self.required_tags)
+
+    def isVisible(self, row):
+        # Two lookups per row, tag strings are only split once per distinct set of tags
+        if self.store.categories[row] in self.hidden_categories:
+            return False
+        tags_id = self.store.tags[row]
+        shown = self.tag_sets.get(tags_id)
+        if shown is None:
+            tags = set(splitTags(self.store.strings[tags_id]))
+            shown = self.hidden_tags.isdisjoint(tags) and (not self.required_tags or
+                                                           not self.required_tags.isdisjoint(tags))
+            self.tag_sets[tags_id] = shown
+        return shown
+
+    def filterRows(self, rows):
+        if not self.isActive():
+            return rows
+        return [row for row in rows if self.isVisible(row)]
+
+    def isCategoryVisible(self, category):
+        return self.store.categoryId(category) not in self.hidden_categories
+
+    def setCategoryVisible(self, category, visible):
+        if visible:
+            self.hidden_categories.discard(self.store.categoryId(category))
+        else:
+            self.hidden_categories.add(self.store.categoryId(category))
+
+    def setTagVisible(self, tag, visible):
+        if visible:
+            self.hidden_tags.discard(tag)
+        else:
+            self.hidden_tags.add(tag)
+        self.tag_sets.clear()
+
+    def setFilter(self, hidden_categories=(), hidden_tags=(), required_tags=()):
+        # Replaces the whole filter at once, categories by name
+        self.hidden_categories = {self.store.categoryId(category) for category in hidden_categories}
+        self.hidden_tags = set(hidden_tags)
+        self.required_tags = set(required_tags)
+        self.tag_sets.clear()
+
+    def state(self):
+        # Saved in the project document
+        return {'hidden_categories': sorted(self.store.category_names[category]
+                                            for category in self.hidden_categories),
+                'hidden_tags': sorted(self.hidden_tags), 'required_tags': sorted(self.required_tags)}
+
+    def setState(self, state):
+        self.setFilter(state.get('hidden_categories', ()), state.get('hidden_tags', ()),
+                       state.get('required_tags', ()))
@@ -1,22 +1,70 @@
-import os
 from functools import partial
 
-from PySide6.QtCore import Qt
-from PySide6.QtGui import QIcon, QPixmap, QColor
+from PySide6.QtCore import QAbstractListModel, QItemSelectionModel, QModelIndex, QSize, Qt, Signal
+from PySide6.QtGui import QIcon, QColor
 from PySide6.QtWidgets import QWidget, QLabel, QLineEdit, QGridLayout, QCheckBox, QPushButton, QTextEdit, \
-    QComboBox, QScrollArea
+    QComboBox, QListView, QVBoxLayout
 
 import markers
 from markers import MarkerItem
+from perfTrace import timed
+
+
+class IconListModel(QAbstractListModel):
+    # Icons of one category; thumbnails are only made for the rows the view actually paints
+    thumbnail_size = 32
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.category = None
+        # (image index, icon id) of the icons present on disk
+        self.icons = []
+
+    def setCategory(self, category):
+        if category == self.category:
+            return
+        self.beginResetModel()
+        self.category = category
+        self.icons = markers.icon_catalog.available(category)
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.icons)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        image_index, icon = self.icons[index.row()]
+        if role == Qt.ItemDataRole.DecorationRole:
+            # Scaled once by the icon cache shared with the markers
+            return markers.icon_cache.pixmap(self.category, icon, self.thumbnail_size)
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return icon
+        if role == Qt.ItemDataRole.UserRole:
+            return image_index
+        return None
+
+    def rowOfImage(self, image_index):
+        for row, (index, _) in enumerate(self.icons):
+            if index == image_index:
+                return row
+        return None
 
 
 class MarkerPanel(QWidget):
+    # Emitted after the marker was saved or deleted and the panel let go of it
+    closed = Signal()
+    # Emitted with the marker when a map to link it to should be chosen
+    linkRequested = Signal(object)
 
-    def __init__(self, marker, scene):
+    def __init__(self, scene):
         super().__init__()
 
-        self.marker = marker
+        # Created once and rebound to whichever marker is edited
+        self.marker = None
         self.scene = scene
+        # Set once a field was changed on the marker, the edit is recorded when the panel lets go of it
+        self.changed = False
 
         layout = QGridLayout()
         layout.setAlignment(Qt.AlignTop)
@@ -28,105 +76,55 @@ class MarkerPanel(QWidget):
 
         # Name field
         label_name = QLabel("Name")
-        name_field = QLineEdit(self.marker.name)
-
-        def handleTextChanged():
-            self.marker.setName(name_field.text())
-
-        name_field.textChanged.connect(handleTextChanged)
+        self.name_field = QLineEdit()
+        self.name_field.textChanged.connect(self.handleTextChanged)
         layout.addWidget(label_name, 1, 0, 1, 2)
-        layout.addWidget(name_field, 2, 0, 1, 2)
+        layout.addWidget(self.name_field, 2, 0, 1, 2)
 
         # Description field
         description_label = QLabel("Description")
         layout.addWidget(description_label, 3, 0, 1, 1)
-        description_field = QTextEdit(self.marker.desc)
-        description_field.setMaximumHeight(25)
-        layout.addWidget(description_field, 4, 0, 1, 2)
-
-        hide_desc_button = QPushButton()
-
-        def toggle_desc():
-            if description_field.maximumHeight() != 25:
-                hide_desc_button.setIcon(QIcon("ui/expand.png"))
-                description_field.setMaximumHeight(25)
-            else:
-                hide_desc_button.setIcon(QIcon("ui/collapse.png"))
-                description_field.setMaximumHeight(1000)
+        self.description_field = QTextEdit()
+        self.description_field.setMaximumHeight(25)
+        layout.addWidget(self.description_field, 4, 0, 1, 2)
 
-        hide_desc_button.clicked.connect(toggle_desc)
-        hide_desc_button.setMaximumWidth(25)
-        layout.addWidget(hide_desc_button, 3, 1, 1, 1)
+        self.hide_desc_button = QPushButton()
+        self.hide_desc_button.clicked.connect(self.toggleDesc)
+        self.hide_desc_button.setMaximumWidth(25)
+        layout.addWidget(self.hide_desc_button, 3, 1, 1, 1)
 
-        toggle_desc()
+        self.toggleDesc()
 
         # Marker image options
         label_marker_image = QLabel("Marker Icon")
 
-        type_chooser = QComboBox()
-        type_chooser.addItems(list(MarkerItem.PathsByCategory.keys()))
-
-        self.folder_path = MarkerItem.PathsByCategory[type_chooser.currentText()]
-
-        marker_image_scroll = QScrollArea()
-        marker_image_widget = QWidget()
-        marker_image_grid = QGridLayout()
-        marker_image_widget.setLayout(marker_image_grid)
-        marker_image_scroll.setWidgetResizable(True)
-        marker_image_scroll.setWidget(marker_image_widget)
-        marker_image_grid.setContentsMargins(0, 0, 0, 0)  # necessary
-        marker_image_grid.setSpacing(2)
-        marker_image_grid.setAlignment(Qt.AlignTop)
-
-        def update_category():
-
-            while marker_image_grid.count():
-                widget = marker_image_grid.takeAt(0).widget()
-                if widget is not None:
-                    widget.deleteLater()
-
-            self.folder_path = MarkerItem.PathsByCategory[type_chooser.currentText()]
-
-            # Get a list of image files in the folder
-            image_files = markers.getImagePathsByCategory(type_chooser.currentText())
-            # Create QPixmap objects for each image file
-            marker_images = []
-            for file in image_files:
-                image_path = os.path.join(self.folder_path, file)
-                pixmap = QPixmap(image_path)
-                marker_images.append(pixmap)
-
-            # Function of changing marker's pixmap
-            def handleMarkerImageSelection(type_string, ind):
-                self.marker.setImageByType(type_string, ind)
-
-            for i, pixmap in enumerate(marker_images):
-                image_button = QPushButton()
-                image_button.setCheckable(True)
-                image_button.setIcon(QIcon(pixmap))
-                image_button.clicked.connect(partial(handleMarkerImageSelection, type_chooser.currentText(), i))
-                image_button.setAutoExclusive(True)  # Set button as exclusively check-able
-                image_button.adjustSize()
-                image_button.setFixedHeight(image_button.width())
-                marker_image_grid.addWidget(image_button, i // 5, i % 5)
-
-        update_category()
-
-        type_chooser.currentTextChanged.connect(update_category)
+        self.type_chooser = QComboBox()
+        self.type_chooser.addItems(list(MarkerItem.PathsByCategory.keys()))
+
+        # A virtualized grid of icons, switching categories only swaps the model's rows
+        self.icon_model = IconListModel(self)
+        self.icon_view = QListView()
+        self.icon_view.setViewMode(QListView.ViewMode.IconMode)
+        self.icon_view.setResizeMode(QListView.ResizeMode.Adjust)
+        self.icon_view.setMovement(QListView.Movement.Static)
+        self.icon_view.setUniformItemSizes(True)
+        self.icon_view.setIconSize(QSize(IconListModel.thumbnail_size, IconListModel.thumbnail_size))
+        self.icon_view.setGridSize(QSize(IconListModel.thumbnail_size + 6, IconListModel.thumbnail_size + 6))
+        self.icon_view.setSpacing(2)
+        self.icon_view.setModel(self.icon_model)
+        self.icon_view.clicked.connect(self.handleMarkerImageSelection)
+
+        self.type_chooser.currentTextChanged.connect(self.icon_model.setCategory)
+        self.icon_model.setCategory(self.type_chooser.currentText())
 
         layout.addWidget(label_marker_image, 5, 0, 1, 2)
-        layout.addWidget(type_chooser, 6, 0, 1, 2)
-        layout.addWidget(marker_image_scroll, 7, 0, 1, 2)
+        layout.addWidget(self.type_chooser, 6, 0, 1, 2)
+        layout.addWidget(self.icon_view, 7, 0, 1, 2)
 
         # Show marker name checkbox
-        show_name_checkbox = QCheckBox("Show marker name")
-        show_name_checkbox.setChecked(self.marker.showing)
-        layout.addWidget(show_name_checkbox, 8, 0, 1, 2)
-
-        def handleShowNameState(state):
-            self.marker.setShowing(state)
-
-        show_name_checkbox.stateChanged.connect(handleShowNameState)
+        self.show_name_checkbox = QCheckBox("Show marker name")
+        self.show_name_checkbox.stateChanged.connect(self.handleShowNameState)
+        layout.addWidget(self.show_name_checkbox, 8, 0, 1, 2)
 
         label_label_text = QLabel("Text Color")
         layout.addWidget(label_label_text, 9, 0, 1, 2)
@@ -140,55 +138,233 @@ class MarkerPanel(QWidget):
         colors = [QColor("black"), QColor("red"), QColor("blue"), QColor("green"), QColor("purple"),
                   QColor("white"), QColor("orange"), QColor("pink"), QColor("yellow"), QColor("lightGreen")]
 
-        def handleColorSelection(ind):
-            self.selected_color = self.color_buttons[ind].palette().button().color()
-            self.marker.setTextColor(self.selected_color)
-
         for index, color in enumerate(colors):
             button = QPushButton()
             button.setStyleSheet(f"background-color: {color.name()};")
             button.setFixedSize(20, 20)
             button.setCheckable(True)
             button.setAutoExclusive(True)  # Set button as exclusively check-able
-            button.clicked.connect(partial(handleColorSelection, index))
+            button.clicked.connect(partial(self.handleColorSelection, index))
             colors_layout.addWidget(button, index // 5, index % 5)
             self.color_buttons.append(button)
 
         color_panel.setLayout(colors_layout)
         layout.addWidget(color_panel, 10, 0, 1, 2)
 
-        # Move button
-        move_button = QPushButton("Move")
-        move_button.setCheckable(True)
-        move_button.setIcon(QIcon("ui/move.png"))
-
-        def handleMoveButton(checked):
-            self.marker.setMovable(checked)
+        # Linked map, opened by double clicking the marker
+        self.link_button = QPushButton()
+        self.link_button.clicked.connect(lambda: self.linkRequested.emit(self.marker))
+        layout.addWidget(self.link_button, 11, 0, 1, 1)
+        self.unlink_button = QPushButton("Unlink")
+        self.unlink_button.clicked.connect(self.handleUnlinkButton)
+        layout.addWidget(self.unlink_button, 11, 1, 1, 1)
+
+        # User tags, each one is a layer that can be shown or hidden with the categories
+        label_tags = QLabel("Tags")
+        self.tags_field = QLineEdit()
+        self.tags_field.setPlaceholderText("Comma separated")
+        layout.addWidget(label_tags, 12, 0, 1, 2)
+        layout.addWidget(self.tags_field, 13, 0, 1, 2)
 
-        move_button.toggled.connect(handleMoveButton)
-        layout.addWidget(move_button, 11, 0, 1, 2)
+        # Move button
+        self.move_button = QPushButton("Move")
+        self.move_button.setCheckable(True)
+        self.move_button.setIcon(QIcon("ui/move.png"))
+        self.move_button.toggled.connect(self.handleMoveButton)
+        layout.addWidget(self.move_button, 14, 0, 1, 2)
 
         # Save button
         save_button = QPushButton("Save")
         save_button.setIcon(QIcon("ui/save.png"))
-
-        def handleSaveButton():
-            self.marker.desc = description_field.toPlainText()
-            self.marker.pos = self.marker.scenePos()
-            self.scene.clearSelection()
-            self.deleteLater()
-
-        save_button.clicked.connect(handleSaveButton)
-        layout.addWidget(save_button, 12, 0, 1, 2)
+        save_button.clicked.connect(self.handleSaveButton)
+        layout.addWidget(save_button, 15, 0, 1, 2)
 
         # Delete button
         delete_button = QPushButton("Delete")
         delete_button.setIcon(QIcon("ui/delete.png"))
+        delete_button.clicked.connect(self.handleDeleteButton)
+        layout.addWidget(delete_button, 16, 0, 1, 2)
+
+        self.hide()
 
-        def handleDeleteButton():
-            self.scene.removeItem(self.marker)
+    @timed("marker_panel")
+    def setMarker(self, marker):
+        # Fills the fields from the marker without writing anything back to it
+        self.releaseMarker()
+        self.marker = marker
+        # The marker keeps its item while it is edited, even when scrolled out of view
+        self.scene.pin(marker)
+
+        self.name_field.blockSignals(True)
+        self.name_field.setText(marker.name)
+        self.name_field.blockSignals(False)
+        self.description_field.setPlainText(marker.desc)
+        self.tags_field.setText(", ".join(marker.tags))
+
+        self.type_chooser.setCurrentText(marker.category)
+        row = self.icon_model.rowOfImage(marker.image_index)
+        if row is not None:
+            index = self.icon_model.index(row)
+            self.icon_view.selectionModel().setCurrentIndex(index, QItemSelectionModel.SelectionFlag.ClearAndSelect)
+            self.icon_view.scrollTo(index)
+        else:
+            self.icon_view.clearSelection()
+
+        self.show_name_checkbox.blockSignals(True)
+        self.show_name_checkbox.setChecked(marker.showing)
+        self.show_name_checkbox.blockSignals(False)
+
+        self.selected_color = marker.color
+        for button in self.color_buttons:
+            if button.palette().button().color() == self.selected_color:
+                button.setChecked(True)
+
+        self.updateLink()
+        self.show()
+
+    def setScene(self, scene):
+        self.clearMarker()
+        self.scene = scene
+
+    def updateLink(self):
+        link = self.marker.link if self.marker is not None else ""
+        self.link_button.setText("Change Link" if link else "Link Map")
+        self.link_button.setToolTip(link)
+        self.unlink_button.setEnabled(bool(link))
+
+    def releaseMarker(self):
+        # A move in progress is finished on the marker it was started on
+        if self.move_button.isChecked():
+            self.move_button.setChecked(False)
+        if self.marker is not None:
+            # Name, icon, color and link are applied right away, so they are saved even without the Save button
+            if self.changed:
+                self.scene.markerEdited.emit(self.marker)
+            self.scene.unpin(self.marker)
             self.marker = None
-            self.deleteLater()
+        self.changed = False
+
+    def clearMarker(self):
+        self.releaseMarker()
+        self.hide()
+
+    def toggleDesc(self):
+        if self.description_field.maximumHeight() != 25:
+            self.hide_desc_button.setIcon(QIcon("ui/expand.png"))
+            self.description_field.setMaximumHeight(25)
+        else:
+            self.hide_desc_button.setIcon(QIcon("ui/collapse.png"))
+            self.description_field.setMaximumHeight(1000)
+
+    def handleTextChanged(self, text):
+        if self.marker is not None:
+            self.marker.setName(text)
+            self.changed = True
+
+    # Function of changing marker's pixmap
+    def handleMarkerImageSelection(self, index):
+        if self.marker is not None:
+            self.marker.setImageByType(self.icon_model.category, index.data(Qt.ItemDataRole.UserRole))
+            self.changed = True
+
+    def handleShowNameState(self, state):
+        if self.marker is not None:
+            self.marker.setShowing(state)
+            self.changed = True
+
+    def handleColorSelection(self, ind):
+        self.selected_color = self.color_buttons[ind].palette().button().color()
+        if self.marker is not None:
+            self.marker.setTextColor(self.selected_color)
+            self.changed = True
+
+    def handleUnlinkButton(self):
+        if self.marker is not None:
+            self.marker.link = ""
+            self.changed = True
+            self.updateLink()
+
+    def handleMoveButton(self, checked):
+        if self.marker is None:
+            return
+        self.marker.setMovable(checked)
+        if not checked:
+            self.scene.markerMoved.emit(self.marker)
+
+    def handleSaveButton(self):
+        if self.marker is None:
+            return
+        self.marker.desc = self.description_field.toPlainText()
+        self.marker.tags = self.tags_field.text()
+        self.scene.markerEdited.emit(self.marker)
+        self.changed = False
+        self.clearMarker()
+        self.scene.clearSelection()
+        self.closed.emit()
+
+    def handleDeleteButton(self):
+        if self.marker is None:
+            return
+        marker = self.marker
+        self.changed = False
+        self.clearMarker()
+        self.scene.removeMarker(marker)
+        self.closed.emit()
+
+
+class MarkerInfoPanel(QWidget):
+    # Read-only view of the selected marker, rebound like the marker panel
+    editRequested = Signal(object)
+    closeRequested = Signal()
+    openLinkRequested = Signal(object)
+
+    def __init__(self):
+        super().__init__()
+
+        self.marker = None
+
+        layout = QVBoxLayout()
+        layout.setAlignment(Qt.AlignTop)
+        self.setLayout(layout)
 
-        delete_button.clicked.connect(handleDeleteButton)
-        layout.addWidget(delete_button, 13, 0, 1, 2)
+        # Label for marker name
+        self.name_label = QLabel()
+        layout.addWidget(self.name_label)
+
+        self.tags_label = QLabel()
+        layout.addWidget(self.tags_label)
+
+        # Widget for marker description
+        self.text_edit = QTextEdit()
+        self.text_edit.setReadOnly(True)  # Make the text area read-only
+        layout.addWidget(self.text_edit)
+
+        # Button to open the map the marker links to
+        self.open_link_button = QPushButton("Open Linked Map")
+        self.open_link_button.clicked.connect(lambda: self.openLinkRequested.emit(self.marker))
+        layout.addWidget(self.open_link_button)
+
+        # Button to edit marker
+        edit_button = QPushButton("Edit")
+        edit_button.clicked.connect(lambda: self.editRequested.emit(self.marker))
+        layout.addWidget(edit_button)
+
+        # Button to close
+        close_button = QPushButton("Close")
+        close_button.clicked.connect(self.closeRequested)
+        layout.addWidget(close_button)
+
+        self.hide()
+
+    def setMarker(self, marker):
+        self.marker = marker
+        self.name_label.setText(marker.name)
+        self.text_edit.setPlainText(marker.desc)
+        self.tags_label.setText("Tags: " + ", ".join(marker.tags))
+        self.tags_label.setVisible(bool(marker.tags))
+        self.open_link_button.setVisible(bool(marker.link))
+        self.show()
+
+    def clearMarker(self):
+        self.marker = None
+        self.hide()
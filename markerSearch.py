@@ -0,0 +1,227 @@
+import bisect
+import heapq
+import re
+from collections import Counter
+
+from PySide6.QtCore import QModelIndex, Qt, Signal
+from PySide6.QtGui import QStandardItem, QStandardItemModel
+from PySide6.QtWidgets import QCompleter, QLineEdit
+
+from perfTrace import timed
+
+WORD = re.compile(r"\w+")
+
+# Bits of the posting of a token, which field of the marker it was found in
+NAME = 1
+DESC = 2
+
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+
+def editDistance(first, second, limit):
+    # Levenshtein distance, anything above the limit is reported as limit + 1
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    previous = list(range(len(second) + 1))
+    for i, char in enumerate(first, 1):
+        current = [i]
+        for j, other in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def trigrams(token):
+    padded = "$" + token + "$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class MarkerSearchIndex:
+    # Results returned by a search
+    max_results = 50
+    # Query words shorter than this only match by prefix, longer ones also with typos
+    fuzzy_length = 4
+
+    def __init__(self, store):
+        self.store = store
+        # Built on the first search and kept up to date afterwards, loading a map does not pay for it
+        self.built = False
+        self.clear()
+
+    def clear(self):
+        # token -> {row: NAME | DESC}
+        self.postings = {}
+        # Sorted tokens, prefixes are looked up by bisection
+        self.tokens = []
+        # trigram -> tokens containing it, for fuzzy matching
+        self.grams = {}
+        # row -> (name string id, desc string id) the row was indexed with
+        self.indexed = {}
+        # string id -> tokens, names and descriptions shared by many markers are split once
+        self.string_tokens = {}
+
+    def reset(self):
+        self.clear()
+        self.built = False
+
+    def ensureBuilt(self):
+        if not self.built:
+            self.built = True
+            for row in self.store.rows():
+                self.add(row, bulk=True)
+            # Sorted and split into trigrams once, instead of token by token
+            self.tokens = sorted(self.postings)
+            for token in self.tokens:
+                for gram in trigrams(token):
+                    self.grams.setdefault(gram, set()).add(token)
+
+    def tokensOf(self, string_id):
+        tokens = self.string_tokens.get(string_id)
+        if tokens is None:
+            tokens = self.string_tokens[string_id] = frozenset(tokenize(self.store.strings[string_id]))
+        return tokens
+
+    def add(self, row, bulk=False):
+        if not self.built:
+            return
+        name_id, desc_id = self.store.names[row], self.store.descs[row]
+        self.indexed[row] = (name_id, desc_id)
+        for field, string_id in ((NAME, name_id), (DESC, desc_id)):
+            for token in self.tokensOf(string_id):
+                rows = self.postings.get(token)
+                if rows is None:
+                    rows = self.postings[token] = {}
+                    if not bulk:
+                        bisect.insort(self.tokens, token)
+                        for gram in trigrams(token):
+                            self.grams.setdefault(gram, set()).add(token)
+                rows[row] = rows.get(row, 0) | field
+
+    def remove(self, row):
+        ids = self.indexed.pop(row, None)
+        if ids is None:
+            return
+        for string_id in ids:
+            for token in self.tokensOf(string_id):
+                rows = self.postings.get(token)
+                if rows is None or rows.pop(row, None) is None or rows:
+                    continue
+                del self.postings[token]
+                del self.tokens[bisect.bisect_left(self.tokens, token)]
+                for gram in trigrams(token):
+                    tokens = self.grams[gram]
+                    tokens.discard(token)
+                    if not tokens:
+                        del self.grams[gram]
+
+    def update(self, row):
+        if self.built and self.indexed.get(row) != (self.store.names[row], self.store.descs[row]):
+            self.remove(row)
+            self.add(row)
+
+    def prefixTokens(self, prefix):
+        start = bisect.bisect_left(self.tokens, prefix)
+        end = bisect.bisect_left(self.tokens, prefix + "\uffff")
+        return self.tokens[start:end]
+
+    def fuzzyTokens(self, word):
+        limit = 1 if len(word) < 8 else 2
+        # Every edit breaks at most three trigrams, tokens sharing fewer cannot be close enough
+        grams = trigrams(word)
+        counts = Counter()
+        for gram in grams:
+            counts.update(self.grams.get(gram, ()))
+        needed = len(grams) - 3 * limit
+        return [token for token, count in counts.items()
+                if count >= needed and editDistance(word, token, limit) <= limit]
+
+    def matches(self, word):
+        # row -> score of the best match of the word: whole word 3, prefix 2, fuzzy 1, doubled in the name
+        scores = {}
+        candidates = [(token, 3 if token == word else 2) for token in self.prefixTokens(word)]
+        if len(word) >= self.fuzzy_length:
+            candidates += [(token, 1) for token in self.fuzzyTokens(word) if not token.startswith(word)]
+        for token, quality in candidates:
+            for row, fields in self.postings[token].items():
+                score = quality * 2 if fields & NAME else quality
+                if score > scores.get(row, 0):
+                    scores[row] = score
+        return scores
+
+    @timed("marker_search")
+    def search(self, text, limit=max_results):
+        # Rows of the markers matching every word of the text, best first
+        words = tokenize(text)
+        if not words:
+            return []
+        self.ensureBuilt()
+
+        total = None
+        for word in sorted(set(words), key=len, reverse=True):
+            scores = self.matches(word)
+            if total is None:
+                total = scores
+            else:
+                total = {row: score + scores[row] for row, score in total.items() if row in scores}
+            if not total:
+                return []
+        return heapq.nlargest(limit, total, key=total.get)
+
+
+class MarkerSearchBox(QLineEdit):
+    # Emitted with the store row of the chosen result
+    markerChosen = Signal(int)
+
+    def __init__(self, scene, parent=None):
+        super().__init__(parent)
+        self.scene = scene
+
+        self.setPlaceholderText("Search markers")
+        self.setClearButtonEnabled(True)
+        self.setMaximumWidth(260)
+
+        # The index does the matching, the completer only shows its results
+        self.results = QStandardItemModel(self)
+        self.search_completer = QCompleter(self.results, self)
+        self.search_completer.setCompletionMode(QCompleter.CompletionMode.UnfilteredPopupCompletion)
+        self.search_completer.setWidget(self)
+        self.search_completer.activated[QModelIndex].connect(self.handleActivated)
+        self.textEdited.connect(self.handleTextEdited)
+        self.returnPressed.connect(self.handleReturnPressed)
+
+    def setScene(self, scene):
+        self.scene = scene
+        self.results.clear()
+        self.clear()
+
+    def focusInEvent(self, event):
+        # The index is built before the first word is typed, so typing does not stall
+        super().focusInEvent(event)
+        self.scene.search_index.ensureBuilt()
+
+    def handleTextEdited(self, text):
+        store = self.scene.store
+        self.results.clear()
+        for row in self.scene.search_index.search(text):
+            label = store.name(row) or "(unnamed)"
+            item = QStandardItem(label + "  -  " + store.category(row))
+            item.setData(row, Qt.ItemDataRole.UserRole)
+            self.results.appendRow(item)
+        if self.results.rowCount():
+            self.search_completer.complete()
+        else:
+            self.search_completer.popup().hide()
+
+    def handleActivated(self, index):
+        row = index.data(Qt.ItemDataRole.UserRole)
+        if row is not None:
+            self.markerChosen.emit(row)
+
+    def handleReturnPressed(self):
+        # Enter without picking a result goes to the best one
+        if self.results.rowCount():
+            self.markerChosen.emit(self.results.item(0).data(Qt.ItemDataRole.UserRole))
@@ -0,0 +1,206 @@
+import sys
+import uuid
+from array import array
+
+from markers import MarkerItem, icon_catalog
+
+# Bits of MarkerStore.flags
+ALIVE = 1
+SHOWING = 2
+
+
+class MarkerStore:
+    # All marker data in typed columns indexed by row, strings are kept once in a shared table
+
+    def __init__(self):
+        self.uids = array('q')
+        self.xs = array('d')
+        self.ys = array('d')
+        self.categories = array('B')
+        self.image_indices = array('H')
+        self.colors = array('I')
+        self.flags = array('B')
+        self.names = array('I')
+        self.descs = array('I')
+        # Path of the map a marker opens, relative to the project it is in, or the empty string
+        self.links = array('I')
+        # User tags of a marker as one string, see joinTags; markers with the same tags share it
+        self.tags = array('I')
+
+        # Category names in the order of their ids
+        self.category_names = list(MarkerItem.PathsByCategory.keys())
+        self.category_ids = {category: index for index, category in enumerate(self.category_names)}
+
+        # String table, id 0 is the empty string
+        self.strings = [""]
+        self.string_ids = {"": 0}
+
+        # Rows of deleted markers, reused by the next added ones
+        self.free_rows = []
+        self.row_of_uid = {}
+
+    def __len__(self):
+        return len(self.row_of_uid)
+
+    def count(self):
+        return len(self.row_of_uid)
+
+    def stringId(self, text):
+        string_id = self.string_ids.get(text)
+        if string_id is None:
+            string_id = len(self.strings)
+            text = sys.intern(text)
+            self.strings.append(text)
+            self.string_ids[text] = string_id
+        return string_id
+
+    def categoryId(self, category):
+        category_id = self.category_ids.get(category)
+        if category_id is None:
+            category_id = self.category_ids[category] = len(self.category_names)
+            self.category_names.append(category)
+        return category_id
+
+    def add(self, x, y, category, image_index=0, name="", desc="", showing=False, color=0xff000000, uid=None,
+            link="", tags=""):
+        if uid is None:
+            uid = uuid.uuid4().int >> 65
+        values = (uid, x, y, self.categoryId(category), image_index, color,
+                  ALIVE | (SHOWING if showing else 0), self.stringId(name), self.stringId(desc), self.stringId(link),
+                  self.stringId(joinTags(tags)))
+        columns = (self.uids, self.xs, self.ys, self.categories, self.image_indices, self.colors, self.flags,
+                   self.names, self.descs, self.links, self.tags)
+
+        if self.free_rows:
+            row = self.free_rows.pop()
+            for column, value in zip(columns, values):
+                column[row] = value
+        else:
+            row = len(self.uids)
+            for column, value in zip(columns, values):
+                column.append(value)
+        self.row_of_uid[uid] = row
+        return row
+
+    def remove(self, row):
+        self.flags[row] = 0
+        del self.row_of_uid[self.uids[row]]
+        self.free_rows.append(row)
+
+    def clear(self):
+        self.__init__()
+
+    def rows(self):
+        return [row for row, flags in enumerate(self.flags) if flags & ALIVE]
+
+    def rowOf(self, uid):
+        return self.row_of_uid.get(uid)
+
+    # Column accessors
+
+    def position(self, row):
+        return self.xs[row], self.ys[row]
+
+    def setPosition(self, row, x, y):
+        self.xs[row] = x
+        self.ys[row] = y
+
+    def category(self, row):
+        return self.category_names[self.categories[row]]
+
+    def setImage(self, row, category, image_index):
+        self.categories[row] = self.categoryId(category)
+        self.image_indices[row] = image_index
+
+    def name(self, row):
+        return self.strings[self.names[row]]
+
+    def setName(self, row, name):
+        self.names[row] = self.stringId(name)
+
+    def desc(self, row):
+        return self.strings[self.descs[row]]
+
+    def setDesc(self, row, desc):
+        self.descs[row] = self.stringId(desc)
+
+    def link(self, row):
+        return self.strings[self.links[row]]
+
+    def setLink(self, row, link):
+        self.links[row] = self.stringId(link)
+
+    def tagText(self, row):
+        return self.strings[self.tags[row]]
+
+    def tagList(self, row):
+        return splitTags(self.strings[self.tags[row]])
+
+    def setTags(self, row, tags):
+        self.tags[row] = self.stringId(joinTags(tags))
+
+    def tagNames(self):
+        # Every tag used by a marker, for listing the tag layers
+        tag_ids = {self.tags[row] for row in self.rows()}
+        return sorted({tag for tag_id in tag_ids for tag in splitTags(self.strings[tag_id])},
+                      key=lambda tag: (tag.lower(), tag))
+
+    def showing(self, row):
+        return bool(self.flags[row] & SHOWING)
+
+    def setShowing(self, row, showing):
+        if showing:
+            self.flags[row] |= SHOWING
+        else:
+            self.flags[row] &= ~SHOWING
+
+    # Project records
+
+    def record(self, row):
+        return {
+            'id': self.uids[row],
+            'x': self.xs[row],
+            'y': self.ys[row],
+            'category': self.category(row),
+            'icon': icon_catalog.icon(self.category(row), self.image_indices[row]),
+            'imgInd': self.image_indices[row],
+            'name': self.name(row),
+            'desc': self.desc(row),
+            'showing': self.showing(row),
+            'color': "#%08x" % self.colors[row],
+            'link': self.link(row),
+            'tags': self.tagText(row)
+        }
+
+    def records(self):
+        return [self.record(row) for row in self.rows()]
+
+    def addRecord(self, record):
+        # The icon id wins over the stored index, so markers survive reordered icon folders
+        image_index = record.get('imgInd', 0)
+        if record.get('icon') is not None:
+            index = icon_catalog.indexOf(record['category'], record['icon'])
+            if index is not None:
+                image_index = index
+        return self.add(record['x'], record['y'], record['category'], image_index, record['name'], record['desc'],
+                        record['showing'], parseColor(record['color']), record.get('id'), record.get('link', ""),
+                        record.get('tags', ""))
+
+
+def parseColor(text):
+    # '#aarrggbb' or '#rrggbb' to an ARGB integer
+    value = int(text.lstrip('#'), 16)
+    if len(text.lstrip('#')) <= 6:
+        value |= 0xff000000
+    return value
+
+
+def splitTags(text):
+    return [tag for tag in text.split(",") if tag]
+
+
+def joinTags(tags):
+    # Tags as a comma separated string or a list, sorted and without duplicates so equal tag sets share a string
+    if isinstance(tags, str):
+        tags = tags.split(",")
+    return ",".join(sorted({tag.strip() for tag in tags if tag.strip()}, key=lambda tag: (tag.lower(), tag)))
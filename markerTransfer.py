@@ -0,0 +1,330 @@
+import csv
+import itertools
+import json
+import math
+import os
+
+import projectFile
+from markerStore import MarkerStore, joinTags, parseColor
+from markers import MarkerItem, icon_catalog
+
+# Columns of CSV files, the same fields are used by JSON, JSON lines and the properties of GeoJSON features
+FIELDS = ['id', 'x', 'y', 'category', 'icon', 'imgInd', 'name', 'desc', 'showing', 'color', 'link', 'tags']
+FORMATS = ['csv', 'json', 'jsonl', 'geojson']
+
+
+def formatOf(path):
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    if extension == 'ndjson':
+        return 'jsonl'
+    if extension in FORMATS:
+        return extension
+    raise ValueError("Unknown marker file format: " + path)
+
+
+class JsonStream:
+    # Reads a JSON document from an iterable of text pieces, array items are handed out one at a time
+    read_size = 64 * 1024
+
+    def __init__(self, pieces):
+        self.pieces = iter(pieces)
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+
+    def fill(self):
+        # Drops what was consumed and appends the next piece, False at the end of the input
+        if self.finished:
+            return False
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        for piece in self.pieces:
+            if piece:
+                self.buffer += piece
+                return True
+        self.finished = True
+        return False
+
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in " \t\r\n":
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Invalid JSON: expected '%s'" % char)
+        self.position += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise ValueError("Invalid JSON")
+                continue
+            # A number at the very end of the buffer may continue in the next piece
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.position = end
+            return value
+
+    def items(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            yield self.value()
+            char = self.peek()
+            self.position += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError("Invalid JSON: expected ',' or ']'")
+
+    def members(self):
+        # Yields the keys of an object, the caller reads each value with value() or items() before the next key
+        self.expect("{")
+        if self.peek() == "}":
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            char = self.peek()
+            self.position += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError("Invalid JSON: expected ',' or '}'")
+
+
+def textPieces(file):
+    return iter(lambda: file.read(JsonStream.read_size), "")
+
+
+def projectMarkers(path, sections=None):
+    # Streams the marker records of a project, the other sections of its document are put into the sections dict
+    stream = JsonStream(projectFile.documentText(path))
+    for key in stream.members():
+        if key == 'markers':
+            yield from stream.items()
+        elif sections is not None:
+            sections[key] = stream.value()
+        else:
+            stream.value()
+
+
+def readRows(path, file_format):
+    # Yields (location, raw row) of a marker file, location is used in error messages
+    with open(path, 'r', encoding='utf-8', newline='') as file:
+        if file_format == 'csv':
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield "line %d" % reader.line_num, row
+        elif file_format == 'jsonl':
+            for number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                # A broken line only skips that row, like any other invalid row
+                try:
+                    row = json.loads(line)
+                except ValueError as error:
+                    row = {'error': "invalid JSON: " + str(error)}
+                yield "line %d" % number, row
+        elif file_format == 'json':
+            for number, row in enumerate(JsonStream(textPieces(file)).items(), 1):
+                yield "item %d" % number, row
+        else:
+            stream = JsonStream(textPieces(file))
+            for key in stream.members():
+                if key != 'features':
+                    stream.value()
+                    continue
+                for number, feature in enumerate(stream.items(), 1):
+                    geometry = feature.get('geometry') if isinstance(feature, dict) else None
+                    if not isinstance(geometry, dict) or geometry.get('type') != 'Point':
+                        yield "feature %d" % number, {'error': "only Point geometries are supported"}
+                        continue
+                    coordinates = geometry.get('coordinates')
+                    if not isinstance(coordinates, list) or len(coordinates) < 2:
+                        yield "feature %d" % number, {'error': "a Point needs x and y coordinates"}
+                        continue
+                    properties = feature.get('properties')
+                    row = dict(properties) if isinstance(properties, dict) else {}
+                    row['x'], row['y'] = coordinates[:2]
+                    if 'id' not in row and isinstance(feature.get('id'), int):
+                        row['id'] = feature['id']
+                    yield "feature %d" % number, row
+
+
+def parseBool(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("1", "true", "yes", "y"):
+        return True
+    if text in ("", "0", "false", "no", "n"):
+        return False
+    raise ValueError("not a boolean: " + str(value))
+
+
+def validateRow(row):
+    # A complete marker record from a row of an import file, ValueError tells what is wrong with it
+    if not isinstance(row, dict):
+        raise ValueError("expected an object, got " + type(row).__name__)
+    if 'error' in row:
+        raise ValueError(row['error'])
+    try:
+        x, y = float(row['x']), float(row['y'])
+    except KeyError as error:
+        raise ValueError("missing column " + str(error))
+    except (TypeError, ValueError):
+        raise ValueError("x and y must be numbers")
+    if not (math.isfinite(x) and math.isfinite(y)):
+        raise ValueError("x and y must be finite")
+
+    category = row.get('category') or ""
+    if category not in MarkerItem.PathsByCategory:
+        raise ValueError("unknown category '%s', expected one of: %s" %
+                         (category, ", ".join(MarkerItem.PathsByCategory)))
+
+    # An icon file name wins over an index, either has to exist in the category
+    icon = row.get('icon') or None
+    if icon is not None:
+        image_index = icon_catalog.indexOf(category, icon)
+        if image_index is None:
+            raise ValueError("no icon '%s' in category '%s'" % (icon, category))
+    else:
+        try:
+            image_index = int(row.get('imgInd') or 0)
+        except (TypeError, ValueError):
+            raise ValueError("imgInd must be a whole number")
+        icon = icon_catalog.icon(category, image_index)
+        if icon is None:
+            raise ValueError("no icon %d in category '%s'" % (image_index, category))
+
+    color = str(row.get('color') or "#ff000000")
+    try:
+        parseColor(color)
+    except ValueError:
+        raise ValueError("color must be #rrggbb or #aarrggbb")
+
+    uid = row.get('id')
+    try:
+        uid = int(uid) if uid not in (None, "") else None
+    except (TypeError, ValueError):
+        raise ValueError("id must be a whole number")
+    # Ids are kept as signed 64 bit integers
+    if uid is not None and not 0 < uid < 2 ** 63:
+        raise ValueError("id must be between 1 and %d" % (2 ** 63 - 1))
+
+    return {'id': uid, 'x': x, 'y': y, 'category': category, 'icon': icon, 'imgInd': image_index,
+            'name': str(row.get('name') or ""), 'desc': str(row.get('desc') or ""),
+            'showing': parseBool(row.get('showing', False)), 'color': color, 'link': str(row.get('link') or ""),
+            'tags': joinTags(row.get('tags') or "")}
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def importMarkers(project_path, input_path, image_path=None, file_format=None, replace=False, batch_size=10000,
+                  strict=False, report=print):
+    # Adds the markers of a CSV, JSON or GeoJSON file to a project, creating it when image_path is given.
+    # Returns (imported, skipped)
+    file_format = file_format or formatOf(input_path)
+    if os.path.exists(project_path + ".journal"):
+        raise ValueError(project_path + " has edits that were not saved yet, open it in Interactive Map first")
+
+    store = MarkerStore()
+    sections = {}
+    chunks = {}
+    if os.path.exists(project_path):
+        stored = projectFile.storedImageHash(project_path)
+        if stored is None:
+            raise ValueError(project_path + " is not an Interactive Map project")
+        image_hash = stored[0]
+        # Binary sections like the fog of war are kept as they are
+        chunks = projectFile.binaryChunks(project_path)
+        for record in projectMarkers(project_path, sections):
+            if not replace:
+                store.addRecord(record)
+    elif image_path is None:
+        raise ValueError("A new project needs the map image")
+    else:
+        image_hash = None
+
+    if image_path is not None:
+        image_hash = projectFile.fileHash(image_path)
+
+    imported = skipped = 0
+    for batch in batched(readRows(input_path, file_format), batch_size):
+        for location, row in batch:
+            try:
+                record = validateRow(row)
+            except ValueError as error:
+                if strict:
+                    raise ValueError("%s, %s: %s" % (input_path, location, error))
+                report("Skipped %s: %s" % (location, error))
+                skipped += 1
+                continue
+            # Ids already taken in the project get a new one
+            if record['id'] is not None and store.rowOf(record['id']) is not None:
+                record['id'] = None
+            store.addRecord(record)
+            imported += 1
+        report("Read %d markers" % (imported + skipped))
+
+    # The image of an existing project stays in place, saveProject then only appends the markers
+    document = dict(sections, markers=(store.record(row) for row in store.rows()))
+    projectFile.saveProject(project_path, image_path, image_hash, document, chunks.items())
+    return imported, skipped
+
+
+def exportMarkers(project_path, output_path, file_format=None):
+    # Writes the markers of a project to a CSV, JSON or GeoJSON file, returns their count
+    file_format = file_format or formatOf(output_path)
+    count = 0
+    with open(output_path, 'w', encoding='utf-8', newline='') as file:
+        if file_format == 'csv':
+            writer = csv.DictWriter(file, FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            for record in projectMarkers(project_path):
+                writer.writerow(record)
+                count += 1
+        elif file_format == 'jsonl':
+            for record in projectMarkers(project_path):
+                file.write(json.dumps(record) + "\n")
+                count += 1
+        elif file_format == 'json':
+            file.write("[")
+            for record in projectMarkers(project_path):
+                file.write((",\n" if count else "\n") + json.dumps(record))
+                count += 1
+            file.write("\n]\n")
+        else:
+            # Coordinates are map pixels, y pointing down
+            file.write('{"type": "FeatureCollection", "features": [')
+            for record in projectMarkers(project_path):
+                properties = {key: value for key, value in record.items() if key not in ('x', 'y')}
+                feature = {'type': 'Feature', 'id': record['id'],
+                           'geometry': {'type': 'Point', 'coordinates': [record['x'], record['y']]},
+                           'properties': properties}
+                file.write((",\n" if count else "\n") + json.dumps(feature))
+                count += 1
+            file.write("\n]}\n")
+    return count
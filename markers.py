@@ -1,127 +1,235 @@
-import os
 import warnings
 
-from PySide6.QtCore import QRectF, Qt
-from PySide6.QtGui import QFont, QPixmap, QColor, QBrush, QPen
-from PySide6.QtWidgets import QGraphicsPixmapItem, QGraphicsSimpleTextItem
+from PySide6.QtCore import QPointF, QRectF, Qt
+from PySide6.QtGui import QFont, QFontMetricsF, QColor, QBrush, QPen, QPainter, QPainterPath
+from PySide6.QtWidgets import QGraphicsItem, QStyle
+
+from iconCache import IconCache
+from iconCatalog import IconCatalog
 
 
 def getImagePathsByCategory(category):
-    if category in MarkerItem.PathsByCategory.keys():
-        folder_path = MarkerItem.PathsByCategory[category]
-    else:
-        folder_path = list(MarkerItem.PathsByCategory.keys())[0]
+    if category not in MarkerItem.PathsByCategory.keys():
         warnings.warn("No such category of markers: " + category + " is not in MarkerItem.PathsByCategory")
+        category = list(MarkerItem.PathsByCategory.keys())[0]
 
-    # Get a list of image files in the folder
-    return [file for file in os.listdir(folder_path) if file.endswith(".png")]
+    # Ordered icon ids from the catalog, the position of an icon is its saved image index
+    return icon_catalog.iconIds(category)
 
 
-class MarkerItem(QGraphicsPixmapItem):
+class MarkerItem(QGraphicsItem):
     max_size = 128
     PathsByCategory = {"Basic": "markers/basic", "Adventure": "markers/adventure",
                        "Creatures and plants": "markers/creatures&plants", "Landmarks": "markers/landmarks",
                        "People": "markers/people", "Town": "markers/town", "Village": "markers/village",
                        "World map": "markers/worldmap"}
 
-    def __init__(self, pos, category=list(PathsByCategory.keys())[0], image_index=0, name="", showing=False, desc="",
-                 color=QColor("black")):
-        # Copying data
-        self.pos = pos
-        self.category = category
-        self.image_index = image_index
-        self.name = name
-        self.showing = showing
-        self.desc = desc
-        self.color = color
+    # Marker size is shared by all markers and applied when they are painted
+    slider = 25
+    size = max_size * slider // 100
+    # While the size slider is dragged markers are drawn from the pixmaps of the last settled size
+    preview = False
+    settled_size = size
+
+    font = QFont("Arial Black", 10)  # Up for change
 
+    def __init__(self, store, row):
         super().__init__()
 
+        # The marker data lives in the store, the item only draws the row it is bound to
+        self.store = store
+        self.row = row
+
         # Additional data
-        self.size = 32
-        self.slider = 25
-        self.pixmap = None
+        self.icon = None
 
-        self.setPos(self.pos)
+        self.setPos(*self.store.position(row))
         self.setImageByType(self.category, self.image_index)
 
-        # Creating a child QGraphicsTextItem as a marker label
-        self.name_textItem = QGraphicsSimpleTextItem(self)
-        self.name_textItem.setText(self.name)
-        self.name_textItem.setFont(QFont("Arial Black", 10))  # Up for change
-        self.setTextColor(self.color)
+        self.setFlag(QGraphicsItem.ItemIgnoresTransformations)
+        self.setFlag(QGraphicsItem.ItemIsSelectable)
+        # Needed for itemChange to report moves to the scene's marker index
+        self.setFlag(QGraphicsItem.ItemSendsScenePositionChanges)
+
+    # Marker data, read from and written to the store
+
+    @property
+    def uid(self):
+        return self.store.uids[self.row]
+
+    @property
+    def category(self):
+        return self.store.category(self.row)
+
+    @property
+    def image_index(self):
+        return self.store.image_indices[self.row]
+
+    @property
+    def name(self):
+        return self.store.name(self.row)
+
+    @property
+    def desc(self):
+        return self.store.desc(self.row)
 
-        self.setShowing(self.showing)
+    @desc.setter
+    def desc(self, desc):
+        self.store.setDesc(self.row, desc)
 
-        self.setFlag(QGraphicsPixmapItem.ItemIgnoresTransformations)
-        self.setFlag(QGraphicsPixmapItem.ItemIsSelectable)
+    @property
+    def showing(self):
+        return self.store.showing(self.row)
+
+    @property
+    def color(self):
+        return QColor.fromRgba(self.store.colors[self.row])
+
+    @property
+    def link(self):
+        return self.store.link(self.row)
+
+    @link.setter
+    def link(self, link):
+        self.store.setLink(self.row, link)
+
+    @property
+    def tags(self):
+        return self.store.tagList(self.row)
+
+    @tags.setter
+    def tags(self, tags):
+        self.store.setTags(self.row, tags)
+
+    def record(self):
+        return self.store.record(self.row)
+
+    @staticmethod
+    def setSharedSlider(slider, preview=False):
+        # Changing the size touches no item, the caller repaints the view
+        MarkerItem.slider = slider
+        MarkerItem.size = MarkerItem.max_size * slider // 100
+        MarkerItem.preview = preview
+        if not preview:
+            MarkerItem.settled_size = MarkerItem.size
 
     def boundingRect(self):
-        return QRectF(-self.size / 2, -self.size / 2, self.size, self.size)
+        # Fixed for every size, so that resizing all markers needs no geometry change on any of them.
+        # The name is drawn by the scene's label layer
+        half = MarkerItem.max_size / 2
+        return QRectF(-half, -half, MarkerItem.max_size, MarkerItem.max_size)
+
+    def shape(self):
+        path = QPainterPath()
+        path.addRect(QRectF(-MarkerItem.size / 2, -MarkerItem.size / 2, MarkerItem.size, MarkerItem.size))
+        return path
+
+    def itemChange(self, change, value):
+        if change == QGraphicsItem.ItemScenePositionHasChanged and self.scene() is not None:
+            if hasattr(self.scene(), 'markerPositionChanged'):
+                self.scene().markerPositionChanged(self)
+        return super().itemChange(change, value)
+
+    def labelChanged(self):
+        if self.scene() is not None and hasattr(self.scene(), 'markerLabelChanged'):
+            self.scene().markerLabelChanged(self)
+
+    def paint(self, painter, option, widget=None):
+        size = MarkerItem.size
+        if MarkerItem.preview:
+            # Cheap rescale of an already cached pixmap while the slider moves, the hint is only for this item
+            pixmap = icon_cache.pixmap(self.category, self.icon, MarkerItem.settled_size)
+            painter.save()
+            painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform, False)
+            target = drawMarker(painter, pixmap, size)
+            painter.restore()
+        else:
+            # Decoded and scaled pixmaps are shared between all markers using the same icon
+            pixmap = icon_cache.pixmap(self.category, self.icon, size)
+            target = drawMarker(painter, pixmap, size)
+
+        if option.state & QStyle.StateFlag.State_Selected:
+            painter.setPen(QPen(QColor("black"), 0, Qt.PenStyle.DashLine))
+            painter.setBrush(Qt.BrushStyle.NoBrush)
+            painter.drawRect(target)
 
     def setImageByType(self, category, index):
-        image_path = os.path.join(MarkerItem.PathsByCategory[list(MarkerItem.PathsByCategory.keys())[0]],
-                                  getImagePathsByCategory(list(MarkerItem.PathsByCategory.keys())[0])[0])
-        if category in MarkerItem.PathsByCategory.keys():
-            try:
-                image_path = os.path.join(MarkerItem.PathsByCategory[category],
-                                          getImagePathsByCategory(category)[index])
-            except IndexError:
-                warnings.warn("IndexError: Index out of range in this category")
-                image_path = os.path.join(MarkerItem.PathsByCategory[category],
-                                          getImagePathsByCategory(list(MarkerItem.PathsByCategory.keys())[0])[0])
-            finally:
-                pixmap = QPixmap(image_path)
-                self.category = category
-                self.pixmap = pixmap
-                self.image_index = index
-                self.updatePixmap()
-        else:
-            image_path = os.path.join(MarkerItem.PathsByCategory[list(MarkerItem.PathsByCategory.keys())[0]],
-                                      getImagePathsByCategory(list(MarkerItem.PathsByCategory.keys())[0])[0])
-            pixmap = QPixmap(image_path)
-            self.category = MarkerItem.PathsByCategory[list(MarkerItem.PathsByCategory.keys())[0]]
-            self.pixmap = pixmap
-            self.image_index = 0
-            self.updatePixmap()
+        if category not in MarkerItem.PathsByCategory.keys():
             warnings.warn("No such category of markers: " + category + " is not in MarkerItem.PathsByCategory")
+            category = list(MarkerItem.PathsByCategory.keys())[0]
+            index = 0
 
-    def setSlider(self, slider):
-        self.slider = slider
-        self.size = MarkerItem.max_size * self.slider // 100
-        self.setOffset(-self.size / 2, -self.size / 2)
-        self.updatePixmap()
-        self.updateNamePosition()
+        icon = icon_catalog.icon(category, index)
+        if icon is None:
+            available = icon_catalog.available(category)
+            if available:
+                warnings.warn("IndexError: Index out of range in this category")
+                index, icon = available[0]
+            else:
+                # The marker keeps its index and is drawn as a placeholder until the folder has icons again
+                warnings.warn("No icons in the folder of category " + category + ": " +
+                              MarkerItem.PathsByCategory[category])
 
-    def updatePixmap(self):
-        super().setPixmap(self.pixmap.scaled(self.size, self.size, Qt.AspectRatioMode.KeepAspectRatio,
-                                             Qt.TransformationMode.SmoothTransformation))
+        self.store.setImage(self.row, category, index)
+        self.icon = icon
+        self.update()
 
     def setName(self, text):
-        self.name = text
-        self.name_textItem.setText(self.name)
-        self.updateNamePosition()
-
-    def updateNamePosition(self):
-        # Position the name item underneath the marker item
-        name_x = -self.name_textItem.boundingRect().width() / 2
-        name_y = self.size / 2
-        self.name_textItem.setPos(name_x, name_y)
+        self.store.setName(self.row, text)
+        self.labelChanged()
 
     def setShowing(self, showing):
-        self.showing = showing
-        self.name_textItem.setVisible(showing)
+        self.store.setShowing(self.row, showing)
+        self.labelChanged()
 
     def setTextColor(self, color):
-        self.color = color
-        self.name_textItem.setBrush(QBrush(self.color))
-        if self.color in [QColor("black"), QColor("red"), QColor("blue"), QColor("green"), QColor("purple")]:
-            self.name_textItem.setPen(QPen(QColor("white"), 0.6))
-        else:
-            self.name_textItem.setPen(QPen(QColor("black"), 0.6))
+        self.store.colors[self.row] = color.rgba()
+        self.labelChanged()
 
     def setMovable(self, movable):
         if movable:
-            self.setFlags(self.flags() | QGraphicsPixmapItem.ItemIsMovable)
+            self.setFlags(self.flags() | QGraphicsItem.ItemIsMovable)
         else:
-            self.setFlags(self.flags() & ~QGraphicsPixmapItem.ItemIsMovable)
+            self.setFlags(self.flags() & ~QGraphicsItem.ItemIsMovable)
+
+
+def labelPath(text):
+    # The outlined text is laid out once, centered below the origin
+    metrics = QFontMetricsF(MarkerItem.font)
+    width = metrics.horizontalAdvance(text)
+    path = QPainterPath()
+    path.addText(-width / 2, metrics.ascent(), MarkerItem.font, text)
+    return path, QRectF(-width / 2, 0, width, metrics.height()).adjusted(-1, -1, 1, 1)
+
+
+# Text colors that get a white outline, light text gets a black one
+DARK_LABEL_COLORS = frozenset(QColor(name).rgba() for name in ("black", "red", "blue", "green", "purple"))
+
+
+def labelStyle(color):
+    pen = QPen(Qt.GlobalColor.white if color.rgba() in DARK_LABEL_COLORS else Qt.GlobalColor.black, 0.6)
+    return pen, QBrush(color)
+
+
+def drawMarker(painter, pixmap, size, label=None):
+    # Draws an icon centered on the origin with its longer side at size, and the (path, pen, brush) label below it.
+    # Shared by MarkerItem and the image export, returns the rectangle of the icon
+    scale = size / max(pixmap.width(), pixmap.height(), 1)
+    target = QRectF(0, 0, pixmap.width() * scale, pixmap.height() * scale)
+    target.moveCenter(QPointF(0, 0))
+    painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+
+    if label is not None:
+        # Position the name underneath the marker icon
+        path, pen, brush = label
+        painter.translate(0, size / 2)
+        painter.setPen(pen)
+        painter.setBrush(brush)
+        painter.drawPath(path)
+        painter.translate(0, -size / 2)
+    return target
+
+
+# Process-wide icon catalog and cache shared by every marker and the marker panel
+icon_catalog = IconCatalog(MarkerItem.PathsByCategory)
+icon_cache = IconCache(MarkerItem.PathsByCategory)
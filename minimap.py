@@ -0,0 +1,183 @@
+import math
+from collections import OrderedDict
+
+from PySide6.QtCore import QPointF, QRectF, QSize, Qt, Signal
+from PySide6.QtGui import QColor, QImage, QPainter, QPen
+from PySide6.QtWidgets import QSizePolicy, QWidget
+
+from fogOfWar import FogMask
+from imageLoader import MapImageItem
+from perfTrace import perf_trace
+from tilePyramid import TiledMapItem
+
+
+class Minimap(QWidget):
+    # Longest side of the downscaled map copies
+    image_size = 256
+    # Downscaled copies kept for recently shown maps
+    max_images = 8
+    # Cells of the marker density overlay along the longest side of the map
+    density_cells = 64
+
+    # Scene point the view should be centered on
+    navigateRequested = Signal(QPointF)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self.scene = None
+        self.picture_item = None
+        self.map_path = None
+        self.view_rect = QRectF()
+
+        # Map path -> downscaled QPixmap, ordered from least to most recently used
+        self.images = OrderedDict()
+        # Density and fog drawn at the size of the downscaled map, redrawn when the scene version changes
+        self.overlay = None
+        self.overlay_version = None
+
+        self.setMinimumSize(160, 80)
+        self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Preferred)
+        self.setCursor(Qt.CursorShape.PointingHandCursor)
+
+    def sizeHint(self):
+        return QSize(240, 160)
+
+    def setMap(self, scene, picture_item, map_path):
+        self.scene = scene
+        self.picture_item = picture_item
+        self.map_path = map_path
+        self.overlay_version = None
+        self.update()
+
+    def invalidateImage(self):
+        # The map item got a better pixmap, like the full image after the preview
+        self.images.pop(self.map_path, None)
+        self.update()
+
+    def setViewRect(self, rect):
+        # Called on every pan and zoom step, only this widget is repainted
+        self.view_rect = QRectF(rect)
+        self.update()
+
+    def mapRect(self):
+        return self.picture_item.boundingRect() if self.picture_item is not None else QRectF()
+
+    def image(self):
+        # The coarsest tile of a pyramid, or the map pixmap scaled down once; full resolution pixels are not read
+        # again while the map is shown
+        pixmap = self.images.get(self.map_path)
+        if pixmap is not None:
+            self.images.move_to_end(self.map_path)
+            return pixmap
+        if isinstance(self.picture_item, TiledMapItem):
+            pyramid = self.picture_item.pyramid
+            source = self.picture_item.cache.tile(pyramid.levelCount() - 1, 0, 0)
+        elif isinstance(self.picture_item, MapImageItem) and self.picture_item.pixmap is not None:
+            source = self.picture_item.pixmap
+        else:
+            return None
+        with perf_trace.section("minimap_image"):
+            pixmap = source.scaled(self.image_size, self.image_size, Qt.AspectRatioMode.KeepAspectRatio,
+                                   Qt.TransformationMode.SmoothTransformation)
+        self.images[self.map_path] = pixmap
+        while len(self.images) > self.max_images:
+            self.images.popitem(last=False)
+        return pixmap
+
+    def updateOverlay(self, size):
+        if self.overlay is not None and self.overlay_version == self.scene.version and self.overlay.size() == size:
+            return
+        with perf_trace.section("minimap_overlay"):
+            self.overlay = self.drawOverlay(size)
+        self.overlay_version = self.scene.version
+
+    def drawOverlay(self, size):
+        # Marker counts come from a coarse level of the cluster grid, the fog from the states of its tiles
+        map_rect = self.mapRect()
+        image = QImage(size, QImage.Format.Format_ARGB32_Premultiplied)
+        image.fill(Qt.GlobalColor.transparent)
+        if map_rect.isEmpty():
+            return image
+        scale = size.width() / map_rect.width()
+        painter = QPainter(image)
+        painter.scale(scale, size.height() / map_rect.height())
+
+        grid = self.scene.cluster_grid
+        fog = self.scene.fog
+        level = grid.levelForScale(1.0, max(map_rect.width(), map_rect.height()) / self.density_cells)
+        cell = grid.cellSize(level)
+        clusters = grid.clustersInRect(level, map_rect)
+        if clusters:
+            top = math.log2(1 + max(count for count, _, _ in clusters))
+            for count, x, y in clusters:
+                if fog is not None and not fog.isRevealed(x, y):
+                    continue
+                alpha = int(40 + 160 * math.log2(1 + count) / top)
+                painter.fillRect(QRectF(math.floor(x / cell) * cell, math.floor(y / cell) * cell, cell, cell),
+                                 QColor(255, 80, 0, alpha))
+
+        if fog is not None:
+            painter.setOpacity(self.scene.fog_layer.opacity())
+            for tile in fog.tilesIn(map_rect):
+                state = fog.state(tile)
+                target = fog.tileRect(tile).intersected(map_rect)
+                if state == FogMask.FOGGED:
+                    painter.fillRect(target, Qt.GlobalColor.black)
+                elif state == FogMask.MIXED:
+                    source = QRectF((target.topLeft() - fog.tileRect(tile).topLeft()) / fog.resolution,
+                                    target.size() / fog.resolution)
+                    painter.drawPixmap(target, fog.pixmap(tile), source)
+        painter.end()
+        return image
+
+    def targetRect(self):
+        # Where the map is drawn in the widget, centered and keeping its aspect ratio
+        map_rect = self.mapRect()
+        if map_rect.isEmpty():
+            return QRectF()
+        size = map_rect.size().scaled(self.width() - 4, self.height() - 4, Qt.AspectRatioMode.KeepAspectRatio)
+        return QRectF((self.width() - size.width()) / 2, (self.height() - size.height()) / 2, size.width(),
+                      size.height())
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().window())
+        target = self.targetRect()
+        if self.scene is None or target.isEmpty():
+            return
+        pixmap = self.image()
+        if pixmap is None:
+            painter.fillRect(target, QColor(200, 200, 200))
+        else:
+            painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+            painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+        self.updateOverlay(target.size().toSize())
+        painter.drawImage(target.topLeft(), self.overlay)
+
+        # The part of the map the view shows
+        map_rect = self.mapRect()
+        scale = target.width() / map_rect.width()
+        view = QRectF(target.left() + self.view_rect.left() * scale, target.top() + self.view_rect.top() * scale,
+                      self.view_rect.width() * scale, self.view_rect.height() * scale)
+        painter.setClipRect(target)
+        painter.setPen(QPen(QColor(255, 255, 255), 2))
+        painter.drawRect(view.intersected(target.adjusted(1, 1, -1, -1)))
+        painter.setPen(QPen(QColor(0, 0, 0), 1))
+        painter.drawRect(view.intersected(target.adjusted(1, 1, -1, -1)))
+
+    def navigate(self, position):
+        target = self.targetRect()
+        if target.isEmpty():
+            return
+        scale = self.mapRect().width() / target.width()
+        self.navigateRequested.emit(QPointF((position.x() - target.left()) * scale,
+                                            (position.y() - target.top()) * scale))
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.MouseButton.LeftButton:
+            self.navigate(event.position())
+
+    def mouseMoveEvent(self, event):
+        if event.buttons() & Qt.MouseButton.LeftButton:
+            self.navigate(event.position())
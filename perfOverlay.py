@@ -0,0 +1,91 @@
+import time
+
+from PySide6.QtCore import Qt, QTimer
+from PySide6.QtWidgets import QLabel
+
+from markerLabels import label_cache
+from markers import icon_cache
+from perfTrace import perf_trace
+from tilePyramid import TiledMapItem
+
+
+class PerfOverlay(QLabel):
+    # Refresh period of the overlay text
+    interval = 500
+    # Entry points shown with their last duration
+    entry_points = ["new_map", "load_data", "save_file", "zoom_image", "set_marker_size", "place_new_marker",
+                    "marker_panel", "update_view", "icon_load", "icon_scale", "label_render", "tile_load"]
+
+    def __init__(self, window):
+        # A child of the view and not of its viewport, so scrolling the viewport does not move it
+        super().__init__(window.graphics_view)
+        self.window = window
+
+        self.setTextFormat(Qt.TextFormat.PlainText)
+        self.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents)
+        self.setStyleSheet("background-color: rgba(20, 20, 20, 190); color: white; padding: 6px;"
+                           "font-family: monospace; font-size: 11px;")
+        self.move(8, 8)
+        self.hide()
+
+        # Set when the overlay switched tracing on, so hiding it switches tracing off again
+        self.owns_trace = False
+        self.last_paints = 0
+        self.last_time = time.perf_counter()
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(self.interval)
+        self.timer.timeout.connect(self.refresh)
+
+    def setActive(self, active):
+        # Tracing only runs while the overlay is shown, unless it was switched on from outside
+        if active:
+            self.owns_trace = not perf_trace.enabled
+            perf_trace.setEnabled(True)
+            self.refresh()
+            self.show()
+            self.raise_()
+            self.timer.start()
+        else:
+            self.timer.stop()
+            self.hide()
+            if self.owns_trace:
+                perf_trace.setEnabled(False)
+
+    def refresh(self):
+        stats = perf_trace.stats()
+        lines = []
+
+        paint = stats.get("paint")
+        if paint is not None:
+            now = time.perf_counter()
+            fps = (paint['count'] - self.last_paints) / max(now - self.last_time, 1e-6)
+            self.last_paints = paint['count']
+            self.last_time = now
+            lines.append("paint  %6.1f ms  mean %6.1f  max %6.1f  %5.1f fps" %
+                         (paint['last_ms'], paint['mean_ms'], paint['max_ms'], fps))
+
+        scene = self.window.graphics_scene
+        lines.append("markers %d  marker items %d  scene items %d" %
+                     (scene.markerCount(), len(scene.items_by_row), len(scene.items())))
+
+        icons = icon_cache.stats()
+        lines.append("icon cache  %5.1f%% hits  %d pixmaps  %.1f MB" %
+                     (100 * icons['hit_rate'], icons['entries'], icons['bytes'] / 2 ** 20))
+        labels = label_cache.stats()
+        lines.append("label cache %5.1f%% hits  %d labels  %.1f MB  %d drawn" %
+                     (100 * labels['hit_rate'], labels['entries'], labels['bytes'] / 2 ** 20,
+                      len(scene.label_layer.visible)))
+        if isinstance(self.window.picture_item, TiledMapItem):
+            tiles = self.window.picture_item.cache.stats()
+            lines.append("tile cache  %5.1f%% hits  %d tiles  %.1f MB" %
+                         (100 * tiles['hit_rate'], tiles['entries'], tiles['bytes'] / 2 ** 20))
+
+        for name in self.entry_points:
+            entry = stats.get(name)
+            if entry is not None:
+                lines.append("%-16s %8.1f ms  max %8.1f  x%d" %
+                             (name, entry['last_ms'], entry['max_ms'], entry['count']))
+
+        self.setText("\n".join(lines))
+        self.adjustSize()
@@ -0,0 +1,109 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+class NullSection:
+    # Returned by PerfTrace.section while tracing is off, entering and leaving it does nothing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Section:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.trace.add(self.name, self.start, time.perf_counter_ns() - self.start)
+        return False
+
+
+class PerfTrace:
+    # Most recent events kept for the JSON trace, older ones only count towards the totals
+    max_events = 100000
+
+    null_section = NullSection()
+
+    def __init__(self):
+        # Checked by every instrumented call before anything else, the only cost while tracing is off
+        self.enabled = False
+
+        # name -> [count, total ns, max ns, last ns]
+        self.totals = {}
+        self.events = deque(maxlen=self.max_events)
+        self.origin = time.perf_counter_ns()
+        self.lock = threading.Lock()
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.lock:
+            self.totals.clear()
+            self.events.clear()
+            self.origin = time.perf_counter_ns()
+
+    def section(self, name):
+        # with perf_trace.section("name"): ...
+        if not self.enabled:
+            return PerfTrace.null_section
+        return Section(self, name)
+
+    def add(self, name, start, duration):
+        with self.lock:
+            entry = self.totals.get(name)
+            if entry is None:
+                entry = self.totals[name] = [0, 0, 0, 0]
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+            entry[3] = duration
+            self.events.append((name, start, duration, threading.get_ident()))
+
+    def stats(self):
+        # name -> count and times in milliseconds
+        with self.lock:
+            return {name: {'count': count, 'total_ms': total / 1e6, 'mean_ms': total / count / 1e6,
+                           'max_ms': longest / 1e6, 'last_ms': last / 1e6}
+                    for name, (count, total, longest, last) in self.totals.items()}
+
+    def dump(self, path):
+        # Chrome trace event format, opens in chrome://tracing and Perfetto
+        with self.lock:
+            events = [{'name': name, 'ph': 'X', 'ts': (start - self.origin) / 1000, 'dur': duration / 1000,
+                       'pid': os.getpid(), 'tid': thread} for name, start, duration, thread in self.events]
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'traceEvents': events, 'stats': self.stats()}, file)
+
+
+def timed(name):
+    # Decorator for the entry points of the app, records every call while tracing is on
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not perf_trace.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                perf_trace.add(name, start, time.perf_counter_ns() - start)
+        return wrapper
+    return decorator
+
+
+# Process-wide trace, switched on by the performance overlay or the IMAP_TRACE environment variable
+perf_trace = PerfTrace()
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+
+
+class PixmapCache:
+    # Least recently used pixmaps are dropped once the cache holds more than max_bytes
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+        # key -> QPixmap, ordered from least to most recently used
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def pixmapBytes(pixmap):
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+    def get(self, key):
+        # None on a miss, the caller then renders the pixmap and inserts it
+        pixmap = self.entries.get(key)
+        if pixmap is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return pixmap
+
+    def insert(self, key, pixmap):
+        self.entries[key] = pixmap
+        self.total_bytes += self.pixmapBytes(pixmap)
+
+        # Evict least recently used pixmaps, always keeping the one just inserted
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= self.pixmapBytes(evicted)
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes
+        }
@@ -0,0 +1,359 @@
+import codecs
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
+import struct
+import uuid
+import zlib
+
+from PySide6.QtGui import QColor
+
+# Layout of a project file:
+#   magic, format version
+#   chunks of (tag, payload length, payload), the image chunk always comes first
+#   tails of a document chunk, the binary chunks saved with it and a SAVE chunk holding the offset of the document
+#   chunk. Saving appends a tail and leaves the image where it is, the last tail with its SAVE chunk is the project;
+#   projects written before tails were appended have a single tail without SAVE
+MAGIC = b"IMAPPROJ"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sH")
+CHUNK_HEADER = struct.Struct("<4sQ")
+IMAGE_HEADER = struct.Struct("<32sH")
+
+IMAGE_TAG = b"IMGE"
+DOCUMENT_TAG = b"DOCU"
+SAVE_TAG = b"SAVE"
+SAVE_PAYLOAD = struct.Struct("<Q")
+
+# Version of the JSON document holding the markers
+DOCUMENT_VERSION = 1
+
+images_dir = "cache/images"
+# Older tails are left in the file until they take more than this, or a quarter of the image, then the project is
+# written again without them, so copying the image is paid for by many cheap saves
+max_dead_bytes = 16 * 1024 * 1024
+
+
+def fileHash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def readHeader(file):
+    header = file.read(HEADER.size)
+    if len(header) != HEADER.size:
+        raise ValueError("Not an Interactive Map project")
+    magic, version = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("Not an Interactive Map project")
+    if version > FORMAT_VERSION:
+        raise ValueError("Project was saved by a newer version of Interactive Map")
+
+
+def readTail(file):
+    # Where the project is in the file: {'image': (offset, length) of the image chunk payload, 'chunks': [(tag,
+    # offset, length)] of the last saved tail, 'start' and 'end' of that tail}. Older tails are skipped, and so is
+    # a tail whose append was cut short, which may end in the middle of a chunk
+    size = os.fstat(file.fileno()).st_size
+    readHeader(file)
+    image = saved = current = None
+    tails = 0
+    while True:
+        start = file.tell()
+        chunk_header = file.read(CHUNK_HEADER.size)
+        if len(chunk_header) != CHUNK_HEADER.size:
+            break
+        tag, length = CHUNK_HEADER.unpack(chunk_header)
+        offset = start + CHUNK_HEADER.size
+        if offset + length > size:
+            break
+        if tag == IMAGE_TAG and image is None and tails == 0:
+            image = (offset, length)
+        elif tag == DOCUMENT_TAG:
+            if current is not None and tails == 1 and saved is None:
+                # A project from before tails were appended, its only tail has no SAVE chunk
+                saved = current
+            current = {'chunks': [], 'start': start}
+            tails += 1
+        elif tag == SAVE_TAG:
+            if current is not None and length == SAVE_PAYLOAD.size and \
+                    SAVE_PAYLOAD.unpack(file.read(length))[0] == current['start']:
+                current['end'] = offset + length
+                saved = current
+            current = None
+        if current is not None:
+            current['chunks'].append((tag, offset, length))
+            current['end'] = offset + length
+        file.seek(offset + length)
+    if current is not None and tails == 1 and saved is None:
+        saved = current
+    if image is None or saved is None:
+        raise ValueError("Project file is incomplete")
+    return dict(saved, image=image)
+
+
+def storedImageHash(path):
+    # Hash of the image already stored in an existing project and the tail of the project, or None
+    try:
+        with open(path, 'rb') as file:
+            tail = readTail(file)
+            file.seek(tail['image'][0])
+            digest, _ = IMAGE_HEADER.unpack(file.read(IMAGE_HEADER.size))
+            return digest.hex(), tail
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def writeChunk(file, tag, payload):
+    file.write(CHUNK_HEADER.pack(tag, len(payload)))
+    file.write(payload)
+
+
+def writeDocument(file, document):
+    # The markers are compressed as they are serialized, so they may be any iterable of records
+    # and are never held in memory as one JSON string
+    start = file.tell()
+    file.write(CHUNK_HEADER.pack(DOCUMENT_TAG, 0))
+    compressor = zlib.compressobj()
+    pending = []
+    pending_size = 0
+
+    def put(text):
+        nonlocal pending_size
+        pending.append(text)
+        pending_size += len(text)
+        if pending_size >= 1024 * 1024:
+            file.write(compressor.compress("".join(pending).encode('utf-8')))
+            pending.clear()
+            pending_size = 0
+
+    put("{")
+    for index, (key, value) in enumerate(document.items()):
+        put(("," if index else "") + json.dumps(key) + ":")
+        if key == 'markers':
+            put("[")
+            for count, record in enumerate(value):
+                put(("," if count else "") + json.dumps(record, separators=(',', ':')))
+            put("]")
+        else:
+            put(json.dumps(value, separators=(',', ':')))
+    put("}")
+    file.write(compressor.compress("".join(pending).encode('utf-8')))
+    file.write(compressor.flush())
+
+    end = file.tell()
+    file.seek(start)
+    file.write(CHUNK_HEADER.pack(DOCUMENT_TAG, end - start - CHUNK_HEADER.size))
+    file.seek(end)
+
+
+def writeTail(file, document, chunks):
+    writeDocument(file, document)
+    for tag, payload in chunks:
+        writeChunk(file, tag, payload)
+
+
+def saveProject(path, image_path, image_hash, document, chunks=()):
+    document = dict(document, version=DOCUMENT_VERSION)
+
+    stored = storedImageHash(path)
+    if stored is not None and stored[0] == image_hash:
+        image_offset, image_length = stored[1]['image']
+        dead = stored[1]['start'] - (image_offset + image_length)
+        if dead <= max(max_dead_bytes, image_length // 4):
+            appendTail(path, stored[1]['end'], document, chunks)
+            return
+
+    # The project is written next to the old one and replaces it whole, a crash leaves one of the two intact
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        if stored is not None and stored[0] == image_hash:
+            # The image is already in the project, its chunk is copied from there without reading the map again
+            with open(path, 'rb') as project_file:
+                remaining = stored[1]['image'][0] + stored[1]['image'][1]
+                while remaining:
+                    data = project_file.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        raise IOError("Project ends inside the map image: " + path)
+                    file.write(data)
+                    remaining -= len(data)
+        else:
+            # Otherwise the original image bytes are copied as they are, never re-encoded
+            extension = os.path.splitext(image_path)[1].lstrip('.').lower().encode('utf-8')
+            file.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+            file.write(CHUNK_HEADER.pack(IMAGE_TAG, IMAGE_HEADER.size + len(extension) + os.path.getsize(image_path)))
+            file.write(IMAGE_HEADER.pack(bytes.fromhex(image_hash), len(extension)))
+            file.write(extension)
+            with open(image_path, 'rb') as image_file:
+                shutil.copyfileobj(image_file, file, 1024 * 1024)
+        start = file.tell()
+        writeTail(file, document, chunks)
+        writeChunk(file, SAVE_TAG, SAVE_PAYLOAD.pack(start))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def appendTail(path, end, document, chunks):
+    # The image and the last saved tail stay untouched, a crash while appending leaves a tail without its SAVE
+    # chunk, which is cut off by the next save
+    with open(path, 'r+b') as file:
+        file.seek(end)
+        file.truncate()
+        writeTail(file, document, chunks)
+        file.flush()
+        os.fsync(file.fileno())
+        # The tail only counts once all of it is on disk
+        writeChunk(file, SAVE_TAG, SAVE_PAYLOAD.pack(end))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def loadProject(path):
+    image_path = None
+    image_hash = None
+    document = None
+    chunks = {}
+
+    with open(path, 'rb') as file:
+        try:
+            tail = readTail(file)
+            offset, length = tail['image']
+            file.seek(offset)
+            digest, extension_length = IMAGE_HEADER.unpack(file.read(IMAGE_HEADER.size))
+            extension = file.read(extension_length).decode('utf-8')
+            image_hash = digest.hex()
+            image_path = extractImage(file, image_hash, extension, length - IMAGE_HEADER.size - extension_length)
+            for tag, offset, length in tail['chunks']:
+                file.seek(offset)
+                if tag == DOCUMENT_TAG:
+                    document = json.loads(zlib.decompress(file.read(length)).decode('utf-8'))
+                else:
+                    # Binary sections are handed over as they are, unknown ones are simply kept around
+                    chunks[tag] = file.read(length)
+        except (struct.error, zlib.error) as error:
+            # Damaged projects fail like any other invalid one
+            raise ValueError("Project file is damaged: " + str(error))
+
+    if image_path is None or document is None:
+        raise ValueError("Project file is incomplete")
+    if document.get('version', 0) > DOCUMENT_VERSION:
+        raise ValueError("Project was saved by a newer version of Interactive Map")
+
+    return {'image_path': image_path, 'image_hash': image_hash, 'document': document, 'chunks': chunks}
+
+
+def binaryChunks(path):
+    # Binary sections of a project, tag -> payload, read without extracting the image
+    chunks = {}
+    with open(path, 'rb') as file:
+        for tag, offset, length in readTail(file)['chunks']:
+            if tag != DOCUMENT_TAG:
+                file.seek(offset)
+                chunks[tag] = file.read(length)
+    return chunks
+
+
+def documentText(path):
+    # Yields the JSON document of a project in decompressed pieces, for reading projects too large to load at once
+    with open(path, 'rb') as file:
+        for tag, offset, length in readTail(file)['chunks']:
+            if tag == DOCUMENT_TAG:
+                file.seek(offset)
+                decompressor = zlib.decompressobj()
+                decoder = codecs.getincrementaldecoder('utf-8')()
+                remaining = length
+                while remaining:
+                    block = file.read(min(remaining, 1024 * 1024))
+                    if not block:
+                        raise ValueError("Project file is truncated")
+                    remaining -= len(block)
+                    yield decoder.decode(decompressor.decompress(block))
+                yield decoder.decode(decompressor.flush(), final=True)
+                return
+    raise ValueError("Project file is incomplete")
+
+
+def extractImage(file, image_hash, extension, length):
+    # Images are extracted once per content hash and then shared by every project using them
+    os.makedirs(images_dir, exist_ok=True)
+    image_path = os.path.join(images_dir, image_hash + "." + extension)
+    if not os.path.exists(image_path) or os.path.getsize(image_path) != length:
+        temp_path = image_path + ".tmp"
+        with open(temp_path, 'wb') as image_file:
+            remaining = length
+            while remaining:
+                block = file.read(min(remaining, 1024 * 1024))
+                if not block:
+                    raise ValueError("Project file is truncated")
+                image_file.write(block)
+                remaining -= len(block)
+        os.replace(temp_path, image_path)
+    return image_path
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    # Old .dat files are pickles, only the few classes they are made of may be created while reading them
+    allowed = {("PySide6.QtCore", "QPointF"), ("PySide6.QtGui", "QColor")}
+
+    def find_class(self, module, name):
+        if (module, name) in self.allowed:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError("Forbidden object in data file: " + module + "." + name)
+
+
+def loadLegacyData(path):
+    with open(path, 'rb') as file:
+        try:
+            data = LegacyUnpickler(io.BytesIO(file.read())).load()
+        except (pickle.UnpicklingError, EOFError, ImportError, IndexError) as error:
+            raise ValueError("Not a valid data file: " + str(error))
+    try:
+        return legacyProject(path, data)
+    except (KeyError, TypeError, AttributeError) as error:
+        raise ValueError("Not a valid data file: " + repr(error))
+
+
+def legacyProject(path, data):
+    from markers import icon_catalog
+
+    image_path = None
+    records = []
+    # Category -> icon files in the order their indices were saved in
+    legacy_icons = {}
+    for item_dict in reversed(data):
+        if item_dict['type'] == 'Marker':
+            color = item_dict['color']
+            category = item_dict['typeInd']
+            if category not in legacy_icons:
+                legacy_icons[category] = icon_catalog.legacyIcons(category)
+            icons = legacy_icons[category]
+            image_index = item_dict['imgInd']
+            records.append({
+                'id': uuid.uuid4().int >> 65,
+                'x': item_dict['pos'].x(),
+                'y': item_dict['pos'].y(),
+                'category': category,
+                # The icon id is stored, so the marker keeps its icon whatever index the catalog gives it
+                'icon': icons[image_index] if isinstance(image_index, int) and 0 <= image_index < len(icons) else None,
+                'imgInd': image_index,
+                'name': item_dict['name'],
+                'desc': item_dict['desc'],
+                'showing': item_dict['showing'],
+                'color': QColor(color).name(QColor.NameFormat.HexArgb)
+            })
+        elif item_dict['type'] == 'Image':
+            image_path = item_dict['imgPath']
+            # Image paths were stored relative to the working directory the file was saved from
+            if not os.path.isabs(image_path) and not os.path.exists(image_path):
+                image_path = os.path.join(os.path.dirname(path), os.path.basename(image_path))
+
+    if image_path is None:
+        raise ValueError("Data file has no map image")
+    return {'image_path': image_path, 'image_hash': None, 'document': {'markers': records}, 'chunks': {}}
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import time
+
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QImage
+
+
+class RecentMaps:
+    # Projects and map images opened lately, newest first, with a thumbnail of the map and the view they were left
+    # at, so reopening one shows it right away
+    max_entries = 10
+    thumbnail_size = 256
+    directory = "cache/recent"
+
+    def __init__(self, directory=None):
+        self.directory = directory or RecentMaps.directory
+        # Read on first use, nothing is touched on disk while the window starts
+        self.entries = None
+
+    def indexPath(self):
+        return os.path.join(self.directory, "recent.json")
+
+    def thumbnailPath(self, path):
+        return os.path.join(self.directory, hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest() + ".png")
+
+    def load(self):
+        if self.entries is not None:
+            return self.entries
+        self.entries = []
+        try:
+            with open(self.indexPath(), 'r', encoding='utf-8') as file:
+                entries = json.load(file)
+            self.entries = [entry for entry in entries if isinstance(entry, dict) and 'path' in entry]
+        except (OSError, ValueError):
+            pass
+        return self.entries
+
+    def existing(self):
+        # Entries whose file is still there, moved or deleted maps are left out of the menu but not forgotten
+        return [entry for entry in self.load() if os.path.exists(entry['path'])]
+
+    def entry(self, path):
+        path = os.path.abspath(path)
+        for entry in self.load():
+            if entry['path'] == path:
+                return entry
+        return None
+
+    def thumbnail(self, path):
+        image = QImage(self.thumbnailPath(path))
+        return None if image.isNull() else image
+
+    def remember(self, path, map_path, map_size, scale, center, thumbnail=None):
+        # Moves the map to the top of the list; the thumbnail is a pixmap or image of the whole map, any size
+        path = os.path.abspath(path)
+        entries = [entry for entry in self.load() if entry['path'] != path]
+        entries.insert(0, {'path': path, 'map_path': os.path.abspath(map_path), 'size': list(map_size),
+                           'scale': scale, 'center': list(center), 'opened': time.time()})
+        for entry in entries[self.max_entries:]:
+            self.removeThumbnail(entry['path'])
+        self.entries = entries[:self.max_entries]
+
+        os.makedirs(self.directory, exist_ok=True)
+        if thumbnail is not None and not thumbnail.isNull():
+            thumbnail = thumbnail.scaled(self.thumbnail_size, self.thumbnail_size, Qt.AspectRatioMode.KeepAspectRatio,
+                                         Qt.TransformationMode.SmoothTransformation)
+            thumbnail.save(self.thumbnailPath(path), "PNG")
+        self.save()
+
+    def forget(self, path):
+        path = os.path.abspath(path)
+        self.entries = [entry for entry in self.load() if entry['path'] != path]
+        self.removeThumbnail(path)
+        self.save()
+
+    def removeThumbnail(self, path):
+        try:
+            os.remove(self.thumbnailPath(path))
+        except OSError:
+            pass
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.indexPath() + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.entries, file, indent=1)
+        os.replace(temp_path, self.indexPath())
@@ -0,0 +1,60 @@
+from PySide6.QtCore import QEvent, QObject, QTimer, Signal
+from PySide6.QtGui import QPainter
+from PySide6.QtWidgets import QGraphicsView
+
+
+class RenderQuality(QObject):
+    # Quiet time after the last input before the view is repainted in full quality
+    settle_delay = 150
+    quality_hints = QPainter.RenderHint.Antialiasing | QPainter.RenderHint.SmoothPixmapTransform
+
+    # Emitted when the view went back to full quality, after the last interaction stopped
+    settled = Signal()
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+
+        # A mostly static map with a few moving items: panning scrolls the pixels already on screen and only
+        # paints the uncovered strip, edits repaint only the rects of the items that changed. The map is an item and
+        # not the background, a background cache would only be redrawn on every zoom step
+        view.setViewportUpdateMode(QGraphicsView.ViewportUpdateMode.SmartViewportUpdate)
+        # Item bounding rects already leave room for antialiased edges
+        view.setOptimizationFlag(QGraphicsView.OptimizationFlag.DontAdjustForAntialiasing)
+        view.setRenderHints(self.quality_hints)
+
+        self.interacting = False
+        self.dragging = False
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.settle_delay)
+        self.timer.timeout.connect(self.settle)
+
+        view.viewport().installEventFilter(self)
+
+    def eventFilter(self, watched, event):
+        # A drag lasts from press to release, even while the mouse rests in between; a click alone changes nothing
+        if event.type() == QEvent.Type.MouseButtonPress:
+            self.dragging = True
+        elif event.type() == QEvent.Type.MouseMove and self.dragging:
+            self.interact()
+        elif event.type() == QEvent.Type.MouseButtonRelease:
+            self.dragging = False
+        return False
+
+    def interact(self):
+        # Called for every pan or zoom step, drawing stays fast until the input stops
+        if not self.interacting:
+            self.interacting = True
+            self.view.setRenderHints(QPainter.RenderHint(0))
+        self.timer.start()
+
+    def settle(self):
+        if self.dragging:
+            self.timer.start()
+            return
+        self.interacting = False
+        self.view.setRenderHints(self.quality_hints)
+        self.settled.emit()
+        self.view.viewport().update()
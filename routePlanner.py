@@ -0,0 +1,321 @@
+import heapq
+import math
+import os
+
+import numpy
+from PySide6.QtCore import QPointF, QRectF, Qt
+from PySide6.QtGui import QColor, QFont, QImage, QImageReader, QPainter, QPainterPath, QPen
+from PySide6.QtWidgets import QGraphicsItem
+
+from perfTrace import perf_trace
+from tilePyramid import TilePyramid
+
+# Colors of typical map terrain and the cost of crossing it, relative to open ground. Every cell of the grid takes
+# the cost of the color nearest to it; water is expensive rather than impassable, so a route always exists
+TERRAIN_COSTS = [
+    ((40, 70, 140), 12.0),     # deep water
+    ((120, 170, 210), 8.0),    # shallow water
+    ((140, 170, 90), 1.0),     # grassland
+    ((50, 90, 40), 2.0),       # forest
+    ((220, 200, 150), 1.5),    # sand, parchment
+    ((130, 125, 120), 4.0),    # mountains
+    ((90, 70, 50), 3.0),       # rough ground, hills
+    ((240, 240, 240), 3.0),    # snow
+]
+
+SQRT2 = math.sqrt(2)
+NEIGHBOURS = ((0, 1, 1.0), (0, -1, 1.0), (1, 0, 1.0), (-1, 0, 1.0), (1, 1, SQRT2), (1, -1, SQRT2), (-1, 1, SQRT2),
+              (-1, -1, SQRT2))
+
+
+class TerrainGrid:
+    # Cells along the longest side of the map
+    grid_size = 768
+    # Fine cells per side of a cell of the coarse level that guides the search
+    coarse_factor = 8
+    cache_dir = "cache/terrain"
+    # The heuristic is weighted so the search heads for the goal instead of trying every route of the same length,
+    # routes may come out this much longer than the shortest one but are far quicker to find
+    weight = 1.1
+
+    def __init__(self, costs, cell_size):
+        # Cost per map pixel of every cell, rows by columns
+        self.costs = costs
+        self.cell_size = cell_size
+        self.rows, self.columns = costs.shape
+        # The search reads single cells, which is much faster from a flat list than from an array
+        self.flat = costs.ravel().tolist()
+        self.min_cost = float(costs.min())
+
+        # Coarse level: the cheapest cell of each block, so distances over it never overestimate the fine ones
+        factor = self.coarse_factor
+        padded = numpy.pad(costs, ((0, -self.rows % factor), (0, -self.columns % factor)), mode='edge')
+        self.coarse = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor) \
+            .min(axis=(1, 3))
+        self.coarse_rows, self.coarse_columns = self.coarse.shape
+        self.coarse_flat = self.coarse.ravel().tolist()
+
+    @staticmethod
+    def load(image_path, image_hash):
+        # Built once per image content and kept on disk
+        cell_size = TerrainGrid.cellSizeOf(image_path)
+        path = os.path.join(TerrainGrid.cache_dir, "%s_%d.npy" % (image_hash, TerrainGrid.grid_size))
+        if os.path.exists(path):
+            try:
+                return TerrainGrid(numpy.load(path), cell_size)
+            except (OSError, ValueError):
+                pass
+        with perf_trace.section("terrain_build"):
+            costs = TerrainGrid.buildCosts(image_path, cell_size)
+        os.makedirs(TerrainGrid.cache_dir, exist_ok=True)
+        temp_path = path + ".tmp.npy"
+        numpy.save(temp_path, costs)
+        os.replace(temp_path, path)
+        return TerrainGrid(costs, cell_size)
+
+    @staticmethod
+    def cellSizeOf(image_path):
+        size = QImageReader(image_path).size()
+        return max(1, math.ceil(max(size.width(), size.height()) / TerrainGrid.grid_size))
+
+    @staticmethod
+    def buildCosts(image_path, cell_size):
+        size = QImageReader(image_path).size()
+        columns = math.ceil(size.width() / cell_size)
+        rows = math.ceil(size.height() / cell_size)
+        # Pixels are classified at twice the grid resolution and averaged, so thin features still add some cost
+        image = TerrainGrid.readScaled(image_path, 2 * columns, 2 * rows)
+        image = image.convertToFormat(QImage.Format.Format_RGB888)
+        pixels = numpy.frombuffer(image.constBits(), numpy.uint8).reshape(image.height(), image.bytesPerLine())
+        pixels = pixels[:, :image.width() * 3].reshape(image.height(), image.width(), 3).astype(numpy.float32)
+
+        palette = numpy.array([color for color, _ in TERRAIN_COSTS], numpy.float32)
+        cost_of_color = numpy.array([cost for _, cost in TERRAIN_COSTS], numpy.float32)
+        distances = ((pixels[:, :, None, :] - palette[None, None, :, :]) ** 2).sum(axis=3)
+        costs = cost_of_color[distances.argmin(axis=2)]
+        return costs.reshape(rows, 2, columns, 2).mean(axis=(1, 3)).astype(numpy.float32)
+
+    @staticmethod
+    def readScaled(image_path, width, height):
+        # Very large maps are read from a level of their tile pyramid, so the full resolution is never decoded
+        if TilePyramid.needsTiling(image_path):
+            pyramid = TilePyramid(image_path)
+            if pyramid.isBuilt():
+                level = pyramid.levelCount() - 1
+                while level > 0 and (pyramid.level_sizes[level][0] < width or
+                                     pyramid.level_sizes[level][1] < height):
+                    level -= 1
+                level_width, level_height = pyramid.level_sizes[level]
+                image = QImage(level_width, level_height, QImage.Format.Format_RGB32)
+                painter = QPainter(image)
+                columns, rows = pyramid.tileGrid(level)
+                for row in range(rows):
+                    for column in range(columns):
+                        rect = pyramid.tileRect(level, column, row, in_level=True)
+                        painter.drawImage(rect.topLeft(), QImage(pyramid.tilePath(level, column, row)))
+                painter.end()
+                return image.scaled(width, height, Qt.AspectRatioMode.IgnoreAspectRatio,
+                                    Qt.TransformationMode.SmoothTransformation)
+
+        reader = QImageReader(image_path)
+        reader.setAutoTransform(True)
+        # JPEG decoders scale while decoding, other formats are scaled after it
+        reader.setScaledSize(reader.size().scaled(width, height, Qt.AspectRatioMode.IgnoreAspectRatio))
+        QImageReader.setAllocationLimit(0)
+        image = reader.read()
+        if image.isNull():
+            raise IOError("Could not read " + image_path + ": " + reader.errorString())
+        return image
+
+    def cellOf(self, point):
+        column = min(max(int(point.x() // self.cell_size), 0), self.columns - 1)
+        row = min(max(int(point.y() // self.cell_size), 0), self.rows - 1)
+        return row * self.columns + column
+
+    def coarseDistances(self, goal):
+        # Dijkstra over the coarse level from the block of the goal: cost of every block to it in map pixels, and the
+        # next block on the way there
+        columns = self.coarse_columns
+        step = self.cell_size * self.coarse_factor
+        costs = self.coarse_flat
+        start = (goal // self.columns) // self.coarse_factor * columns + (goal % self.columns) // self.coarse_factor
+        distances = [math.inf] * len(costs)
+        distances[start] = 0.0
+        following = [None] * len(costs)
+        queue = [(0.0, start)]
+        while queue:
+            distance, block = heapq.heappop(queue)
+            if distance > distances[block]:
+                continue
+            row, column = divmod(block, columns)
+            for d_row, d_column, length in NEIGHBOURS:
+                next_row = row + d_row
+                next_column = column + d_column
+                if 0 <= next_row < self.coarse_rows and 0 <= next_column < columns:
+                    neighbour = next_row * columns + next_column
+                    total = distance + (costs[block] + costs[neighbour]) / 2 * length * step
+                    if total < distances[neighbour]:
+                        distances[neighbour] = total
+                        following[neighbour] = block
+                        heapq.heappush(queue, (total, neighbour))
+        return distances, following
+
+    def corridor(self, start, following):
+        # Blocks along the coarse route and the ones around it, the fine search does not leave them
+        columns = self.coarse_columns
+        block = (start // self.columns) // self.coarse_factor * columns + (start % self.columns) // self.coarse_factor
+        blocks = set()
+        while block is not None:
+            row, column = divmod(block, columns)
+            for next_row in range(max(row - 1, 0), min(row + 2, self.coarse_rows)):
+                for next_column in range(max(column - 1, 0), min(column + 2, columns)):
+                    blocks.add(next_row * columns + next_column)
+            block = following[block]
+        return blocks
+
+    def route(self, start, goal):
+        # A* over the fine cells around the coarse route, returns a Route in map coordinates
+        with perf_trace.section("route_search"):
+            return self.search(self.cellOf(start), self.cellOf(goal), start, goal)
+
+    def search(self, start, goal, start_point, goal_point):
+        columns = self.columns
+        rows = self.rows
+        costs = self.flat
+        cell = self.cell_size
+        factor = self.coarse_factor
+        coarse_columns = self.coarse_columns
+        last_row = self.coarse_rows - 1
+        last_column = coarse_columns - 1
+        coarse, following = self.coarseDistances(goal)
+        corridor = self.corridor(start, following)
+        min_step = cell * self.min_cost
+        weight = self.weight
+        goal_row, goal_column = divmod(goal, columns)
+
+        def heuristic(index):
+            # The coarse distance interpolated between block centers, a heuristic that is flat over a block would
+            # make the search fill it; near the goal the octile distance over the cheapest terrain takes over
+            row, column = divmod(index, columns)
+            d_row = abs(row - goal_row)
+            d_column = abs(column - goal_column)
+            direct = (max(d_row, d_column) + (SQRT2 - 1) * min(d_row, d_column)) * min_step
+            y = min(max((row - (factor - 1) / 2) / factor, 0), last_row)
+            x = min(max((column - (factor - 1) / 2) / factor, 0), last_column)
+            top = int(y)
+            left = int(x)
+            bottom = min(top + 1, last_row)
+            right = min(left + 1, last_column)
+            y -= top
+            x -= left
+            estimate = (coarse[top * coarse_columns + left] * (1 - x) + coarse[top * coarse_columns + right] * x) * \
+                (1 - y) + (coarse[bottom * coarse_columns + left] * (1 - x) +
+                           coarse[bottom * coarse_columns + right] * x) * y
+            return max(direct, estimate)
+
+        best = {start: 0.0}
+        parents = {start: None}
+        closed = set()
+        # Ties go to the cell furthest along, so open ground is not searched in a wide front
+        queue = [(heuristic(start), 0.0, start)]
+        while queue:
+            _, distance, index = heapq.heappop(queue)
+            if index == goal:
+                break
+            if index in closed:
+                continue
+            closed.add(index)
+            distance = -distance
+            row, column = divmod(index, columns)
+            for d_row, d_column, length in NEIGHBOURS:
+                next_row = row + d_row
+                next_column = column + d_column
+                if 0 <= next_row < rows and 0 <= next_column < columns and \
+                        (next_row // factor) * coarse_columns + next_column // factor in corridor:
+                    neighbour = next_row * columns + next_column
+                    if neighbour in closed:
+                        continue
+                    total = distance + (costs[index] + costs[neighbour]) / 2 * length * cell
+                    if total < best.get(neighbour, math.inf):
+                        best[neighbour] = total
+                        parents[neighbour] = index
+                        heapq.heappush(queue, (total + weight * heuristic(neighbour), -total, neighbour))
+
+        cells = []
+        index = goal
+        while index is not None:
+            cells.append(index)
+            index = parents.get(index)
+        cells.reverse()
+        points = [start_point] + [QPointF((index % columns + 0.5) * cell, (index // columns + 0.5) * cell)
+                                  for index in cells[1:-1]] + [goal_point]
+        return Route(simplify(points, cells, columns), best.get(goal, math.inf), len(best))
+
+
+def simplify(points, cells, columns):
+    # Keeps the points where the direction between grid cells changes
+    if len(cells) < 3:
+        return points
+    kept = [points[0]]
+    for position in range(1, len(cells) - 1):
+        before = divmod(cells[position], columns)
+        after = divmod(cells[position + 1], columns)
+        previous = divmod(cells[position - 1], columns)
+        if (before[0] - previous[0], before[1] - previous[1]) != (after[0] - before[0], after[1] - before[1]):
+            kept.append(points[position])
+    kept.append(points[-1])
+    return kept
+
+
+class Route:
+    def __init__(self, points, cost, visited):
+        self.points = points
+        # Length weighted by terrain, in map pixels of open ground
+        self.cost = cost
+        # Cells the search touched, for profiling
+        self.visited = visited
+        self.length = sum(math.hypot(b.x() - a.x(), b.y() - a.y()) for a, b in zip(points, points[1:]))
+
+
+class RouteItem(QGraphicsItem):
+    # The route as a line over the map, with its distance at screen size next to its end
+
+    def __init__(self, route, text):
+        super().__init__()
+        self.path = QPainterPath(route.points[0])
+        for point in route.points[1:]:
+            self.path.lineTo(point)
+        self.end = route.points[-1]
+        self.text = text
+        self.font = QFont("Arial Black", 10)
+        self.setAcceptedMouseButtons(Qt.MouseButton.NoButton)
+        # Above the fog, below the markers
+        self.setZValue(0.8)
+
+    def boundingRect(self):
+        # The label is drawn at screen size, the margin covers it at any zoom that shows markers
+        return self.path.boundingRect().adjusted(-2000, -2000, 2000, 2000)
+
+    def paint(self, painter, option, widget=None):
+        # Cosmetic pens keep the same width on screen at any zoom, a white outline under the dashes
+        pen = QPen(QColor(255, 255, 255), 5, Qt.PenStyle.SolidLine, Qt.PenCapStyle.RoundCap, Qt.PenJoinStyle.RoundJoin)
+        pen.setCosmetic(True)
+        painter.setPen(pen)
+        painter.drawPath(self.path)
+        pen = QPen(QColor(200, 30, 30), 3, Qt.PenStyle.DashLine, Qt.PenCapStyle.RoundCap, Qt.PenJoinStyle.RoundJoin)
+        pen.setCosmetic(True)
+        painter.setPen(pen)
+        painter.drawPath(self.path)
+
+        end = painter.worldTransform().map(self.end)
+        painter.save()
+        painter.resetTransform()
+        painter.setFont(self.font)
+        rect = painter.fontMetrics().boundingRect(self.text).adjusted(-6, -3, 6, 3)
+        rect.moveTopLeft(end.toPoint() + QPointF(12, 12).toPoint())
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(QColor(255, 255, 255, 220))
+        painter.drawRoundedRect(QRectF(rect), 4, 4)
+        painter.setPen(QColor(0, 0, 0))
+        painter.drawText(QRectF(rect), Qt.AlignmentFlag.AlignCenter, self.text)
+        painter.restore()
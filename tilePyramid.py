@@ -0,0 +1,233 @@
+import hashlib
+import json
+import math
+import os
+
+from PySide6.QtCore import QRect, QRectF, Qt
+from PySide6.QtGui import QImage, QImageIOHandler, QImageReader, QPainter, QPixmap
+from PySide6.QtWidgets import QGraphicsItem
+
+from perfTrace import perf_trace
+from pixmapCache import PixmapCache
+
+
+class TilePyramid:
+    # Images with a side longer than this are shown through the pyramid instead of a single pixmap
+    threshold = 8192
+    tile_size = 512
+    cache_dir = "cache/tiles"
+    # The full resolution is decoded in strips of about this many bytes, when the format can read part of an image
+    strip_bytes = 128 * 1024 * 1024
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+        # Read the dimensions from the header only, without decoding the image
+        reader = QImageReader(file_path)
+        size = reader.size()
+        self.width = size.width()
+        self.height = size.height()
+
+        # Level 0 is the full resolution, every next level halves both sides until the map fits in one tile
+        self.level_sizes = [(self.width, self.height)]
+        while max(self.level_sizes[-1]) > self.tile_size:
+            width, height = self.level_sizes[-1]
+            self.level_sizes.append((max(1, math.ceil(width / 2)), max(1, math.ceil(height / 2))))
+
+        self.directory = os.path.join(TilePyramid.cache_dir, self.cacheKey())
+        # Keep transparency of PNG maps, everything else is stored as smaller JPEG tiles
+        self.format = "png" if file_path.lower().endswith(".png") else "jpg"
+
+    @staticmethod
+    def needsTiling(file_path):
+        size = QImageReader(file_path).size()
+        return max(size.width(), size.height()) > TilePyramid.threshold
+
+    def cacheKey(self):
+        # Tiles are reused as long as the same file is not modified
+        stat = os.stat(self.file_path)
+        key = f"{os.path.abspath(self.file_path)}|{stat.st_size}|{stat.st_mtime_ns}|{self.tile_size}"
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def levelCount(self):
+        return len(self.level_sizes)
+
+    def isBuilt(self):
+        return os.path.exists(os.path.join(self.directory, "meta.json"))
+
+    def build(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Large maps are far above Qt's default allocation limit
+        QImageReader.setAllocationLimit(0)
+
+        # Rows of every level flow down from strips of the full resolution, so only a strip and a few rows of tiles
+        # per level are in memory at a time
+        levels = [{'row': 0, 'tiles': None, 'pending': None} for _ in self.level_sizes]
+        for strip, last in self.readStrips():
+            self.addRows(levels, 0, strip, last)
+
+        # The meta file is written last, so an interrupted build is started over
+        with open(os.path.join(self.directory, "meta.json"), 'w', encoding='utf-8') as file:
+            json.dump({'source': os.path.abspath(self.file_path), 'width': self.width, 'height': self.height,
+                       'tile_size': self.tile_size, 'levels': self.level_sizes}, file)
+
+    def readStrips(self):
+        # Yields (image of full resolution rows, whether they are the last ones) from the top down
+        reader = QImageReader(self.file_path)
+        reader.setAutoTransform(True)
+        strip_height = max(self.tile_size, self.strip_bytes // (4 * self.width) // self.tile_size * self.tile_size)
+        # Formats that cannot read part of an image, and rotated photos, are decoded in one piece
+        if not reader.supportsOption(QImageIOHandler.ImageOption.ClipRect) or \
+                reader.transformation() != QImageIOHandler.Transformation.TransformationNone:
+            strip_height = self.height
+        for top in range(0, self.height, strip_height):
+            if strip_height < self.height:
+                reader = QImageReader(self.file_path)
+                reader.setClipRect(QRect(0, top, self.width, min(strip_height, self.height - top)))
+            image = reader.read()
+            if image.isNull():
+                raise IOError("Could not read " + self.file_path + ": " + reader.errorString())
+            yield image, top + strip_height >= self.height
+
+    def addRows(self, levels, level, image, last):
+        # Whole rows of tiles are saved as soon as the level has them, pairs of rows are halved into the next level
+        state = levels[level]
+        width, height = self.level_sizes[level]
+        columns, _ = self.tileGrid(level)
+        tiles = stackImages(state['tiles'], image)
+        available = 0 if tiles is None else tiles.height()
+        top = 0
+        while available - top >= self.tile_size or (last and available > top):
+            rows = min(self.tile_size, available - top)
+            for column in range(columns):
+                rect = QRect(column * self.tile_size, top, min(self.tile_size, width - column * self.tile_size), rows)
+                path = self.tilePath(level, column, state['row'])
+                if not tiles.copy(rect).save(path, self.format.upper(), 90):
+                    raise IOError("Could not write the map tile " + path)
+            state['row'] += 1
+            top += rows
+        state['tiles'] = tiles.copy(0, top, width, available - top) if available > top else None
+
+        if level + 1 == len(levels):
+            return
+        pending = stackImages(state['pending'], image)
+        rows = 0 if pending is None else pending.height() if last else pending.height() // 2 * 2
+        scaled = None
+        if rows:
+            source = pending if rows == pending.height() else pending.copy(0, 0, width, rows)
+            scaled = source.scaled(self.level_sizes[level + 1][0], math.ceil(rows / 2),
+                                   Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation)
+            pending = pending.copy(0, rows, width, pending.height() - rows) if rows < pending.height() else None
+        state['pending'] = pending
+        if scaled is not None or last:
+            self.addRows(levels, level + 1, scaled, last)
+
+    def tileGrid(self, level):
+        width, height = self.level_sizes[level]
+        return math.ceil(width / self.tile_size), math.ceil(height / self.tile_size)
+
+    def tilePath(self, level, column, row):
+        return os.path.join(self.directory, f"{level}_{column}_{row}.{self.format}")
+
+    def levelScale(self, level):
+        # Size of one level pixel in full resolution pixels along each axis
+        width, height = self.level_sizes[level]
+        return self.width / width, self.height / height
+
+    def levelForScale(self, scale):
+        # Pick the coarsest level that still has at least one level pixel per screen pixel
+        if scale <= 0:
+            return self.levelCount() - 1
+        level = int(math.floor(math.log2(1 / scale))) if scale < 1 else 0
+        return max(0, min(level, self.levelCount() - 1))
+
+    def tilesInRect(self, level, rect):
+        # Tiles of the level intersecting the rectangle given in full resolution coordinates
+        scale_x, scale_y = self.levelScale(level)
+        columns, rows = self.tileGrid(level)
+        span_x = self.tile_size * scale_x
+        span_y = self.tile_size * scale_y
+        first_column = max(0, int(rect.left() // span_x))
+        last_column = min(columns - 1, int(rect.right() // span_x))
+        first_row = max(0, int(rect.top() // span_y))
+        last_row = min(rows - 1, int(rect.bottom() // span_y))
+        return [(column, row) for row in range(first_row, last_row + 1)
+                for column in range(first_column, last_column + 1)]
+
+    def tileRect(self, level, column, row, in_level=False):
+        # Edge tiles are smaller than tile_size, the rect is in full resolution coordinates unless in_level is set
+        scale_x, scale_y = (1, 1) if in_level else self.levelScale(level)
+        width, height = self.level_sizes[level]
+        tile_width = min(self.tile_size, width - column * self.tile_size)
+        tile_height = min(self.tile_size, height - row * self.tile_size)
+        return QRectF(column * self.tile_size * scale_x, row * self.tile_size * scale_y,
+                      tile_width * scale_x, tile_height * scale_y)
+
+
+def stackImages(top, bottom):
+    # The rows of bottom below those of top, either may be None
+    if top is None or bottom is None:
+        return bottom if top is None else top
+    image = QImage(top.width(), top.height() + bottom.height(), top.format())
+    painter = QPainter(image)
+    painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+    painter.drawImage(0, 0, top)
+    painter.drawImage(0, top.height(), bottom)
+    painter.end()
+    return image
+
+
+class TileCache(PixmapCache):
+    # Budget for decoded tiles kept in memory
+    max_bytes = 256 * 1024 * 1024
+
+    def __init__(self, pyramid, max_bytes=max_bytes):
+        super().__init__(max_bytes)
+        # Keyed by (level, column, row)
+        self.pyramid = pyramid
+
+    def tile(self, level, column, row):
+        key = (level, column, row)
+        pixmap = self.get(key)
+        if pixmap is not None:
+            return pixmap
+
+        with perf_trace.section("tile_load"):
+            pixmap = QPixmap(self.pyramid.tilePath(level, column, row))
+        self.insert(key, pixmap)
+        return pixmap
+
+
+class TiledMapItem(QGraphicsItem):
+    # Drop-in replacement of the map QGraphicsPixmapItem; its local coordinates are full resolution pixels
+
+    def __init__(self, pyramid):
+        super().__init__()
+
+        self.pyramid = pyramid
+        self.cache = TileCache(pyramid)
+        self.level = pyramid.levelCount() - 1
+
+        # Paint only receives the exposed part of the map
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.pyramid.width, self.pyramid.height)
+
+    def setViewScale(self, scale, visible_rect, interactive=False):
+        # Called when the zoom of the view changes, loads the tiles of the new level that are in view.
+        # While zooming in the loaded coarser level is stretched, finer tiles are only loaded once zooming stops
+        level = self.pyramid.levelForScale(scale)
+        if interactive:
+            level = max(level, self.level)
+        if level != self.level:
+            self.level = level
+            self.update()
+        for column, row in self.pyramid.tilesInRect(self.level, visible_rect.intersected(self.boundingRect())):
+            self.cache.tile(self.level, column, row)
+
+    def paint(self, painter, option, widget=None):
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        for column, row in self.pyramid.tilesInRect(self.level, exposed):
+            pixmap = self.cache.tile(self.level, column, row)
+            painter.drawPixmap(self.pyramid.tileRect(self.level, column, row), pixmap, QRectF(pixmap.rect()))